@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Minimal client for ASCOM Alpaca devices (e.g. the dome).  One
+requests.Session (which keeps its connections alive) is shared by all devices
+on a server, every request has a timeout, and several properties can be read
+at once in parallel.  Properties which change slowly (e.g. athome, slaved)
+can be cached for a few seconds so they are not read every cycle.
+"""
+
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+##-------------------------------------------------------------------------
+## Pooled Sessions
+##-------------------------------------------------------------------------
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(address, pool_size=8):
+    '''Return the shared Session for the Alpaca server at address.'''
+    with sessions_lock:
+        if address not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            sessions[address] = session
+        return sessions[address]
+
+
+class AlpacaError(Exception):
+    pass
+
+
+##-------------------------------------------------------------------------
+## Alpaca Device
+##-------------------------------------------------------------------------
+class AlpacaDevice(object):
+    '''An Alpaca device, e.g. AlpacaDevice('dome', 0).
+
+    get(name) reads one property.  get_many(names) reads several in parallel
+    and returns {name: value} for those which succeeded, along with
+    {name: error} for those which did not.  Properties listed in ttl (name:
+    seconds) are served from a cache until they are that old.
+    '''
+    client_id = 1
+    transaction_ids = itertools.count(1)
+
+    def __init__(self, device_type, number=0, address='127.0.0.1:11111',
+                 timeout=2., ttl=None, max_workers=8):
+        self.url = f'http://{address}/api/v1/{device_type}/{number}'
+        self.session = get_session(address, pool_size=max_workers)
+        self.timeout = timeout
+        self.ttl = ttl if ttl is not None else {}
+        ## name: (time read, value)
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='alpaca')
+
+    def get(self, name):
+        '''Read the named property, from the cache if it is fresh enough.'''
+        if name in self.ttl:
+            with self.lock:
+                cached = self.cache.get(name, None)
+            if cached is not None and time.time() - cached[0] < self.ttl[name]:
+                return cached[1]
+        params = {'ClientID': self.client_id,
+                  'ClientTransactionID': next(self.transaction_ids)}
+        r = self.session.get(f'{self.url}/{name}', params=params,
+                             timeout=self.timeout)
+        r.raise_for_status()
+        j = r.json()
+        if j.get('ErrorNumber', 0) != 0:
+            raise AlpacaError(f"{name}: {j.get('ErrorMessage', '')} ({j['ErrorNumber']})")
+        value = j['Value']
+        if name in self.ttl:
+            with self.lock:
+                self.cache[name] = (time.time(), value)
+        return value
+
+    def get_many(self, names):
+        '''Read the named properties in parallel.  Returns (values, errors),
+        dicts keyed by property name.
+        '''
+        futures = {name: self.executor.submit(self.get, name) for name in names}
+        values = {}
+        errors = {}
+        for name, future in futures.items():
+            try:
+                values[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+        return values, errors
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Warm-start astrometry.  Consecutive frames of the same target are only a few
+arcseconds apart, so the last good WCS solution for a target is kept and used
+to seed the next solve (astrometry.net's solve-field, verifying the previous
+solution first and then searching only a small patch of sky around it).  A
+blind solve is only needed when the seeded solve fails.
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import numpy as np
+from astropy import units as u
+from astropy import coordinates as c
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+##-------------------------------------------------------------------------
+## WCS Cache
+##-------------------------------------------------------------------------
+class WCSCache(object):
+    '''Last good WCS solution for each (telescope, target name).  Entries
+    older than max_age are ignored so that a target re-visited on another
+    night (or after the telescope has been re-homed) is solved blind.
+    '''
+    def __init__(self, max_age=tdelta(0, 3*60*60)):
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, telescope, target, date=None):
+        if not target:
+            return None
+        with self.lock:
+            entry = self.entries.get((telescope, target), None)
+        if entry is None:
+            return None
+        if date is not None and abs(date - entry['date']) > self.max_age:
+            return None
+        return entry
+
+    def put(self, telescope, target, wcs, header_pointing, date):
+        if not target or wcs is None or header_pointing is None:
+            return
+        with self.lock:
+            self.entries[(telescope, target)] = {'wcs': wcs,
+                                                 'header_pointing': header_pointing,
+                                                 'date': date,
+                                                }
+
+
+## Shared by measure_image and the batch tools which call it.
+wcs_cache = WCSCache()
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def wcs_center(wcs, shape):
+    '''Sky coordinate of the center pixel of an image with this WCS.'''
+    ny, nx = shape
+    ra, dec = wcs.all_pix2world([[nx/2., ny/2.]], 0)[0]
+    return c.SkyCoord(ra, dec, unit=u.deg, frame='icrs')
+
+
+def predicted_center(seed, header_pointing, shape):
+    '''Where the seed solution says the center of this frame should be,
+    offset by any change in the commanded (header) pointing since the seed
+    frame was taken (e.g. dithers).
+    '''
+    center = wcs_center(seed['wcs'], shape)
+    dra = (header_pointing.ra - seed['header_pointing'].ra).wrap_at(180*u.deg)
+    ddec = header_pointing.dec - seed['header_pointing'].dec
+    return c.SkyCoord(center.ra + dra, center.dec + ddec, frame='icrs')
+
+
+##-------------------------------------------------------------------------
+## Seeded Solve
+##-------------------------------------------------------------------------
+def seeded_solve(data, seed, header_pointing, pixel_scale,
+                 downsample=2, SIPorder=4, radius=0.5, cpulimit=30):
+    '''Solve the image in data using astrometry.net's solve-field, verifying
+    the seed solution first and otherwise searching only within radius (deg)
+    of the predicted field center at the known pixel scale.  Returns a WCS
+    or None if the seeded solve failed.
+    '''
+    center = predicted_center(seed, header_pointing, data.shape)
+    scale = pixel_scale.to(u.arcsec/u.pix).value
+    with tempfile.TemporaryDirectory(prefix='vysos_wcs_') as tmpdir:
+        imagefile = os.path.join(tmpdir, 'image.fits')
+        seedfile = os.path.join(tmpdir, 'seed.wcs')
+        fits.PrimaryHDU(data=np.asarray(data, dtype=np.float32)).writeto(imagefile)
+        fits.PrimaryHDU(header=seed['wcs'].to_header(relax=True)).writeto(seedfile)
+        cmd = ['solve-field', '--overwrite', '--no-plots',
+               '--dir', tmpdir,
+               '--new-fits', 'none',
+               '--verify', seedfile,
+               '--ra', f'{center.ra.deg:.5f}',
+               '--dec', f'{center.dec.deg:.5f}',
+               '--radius', f'{radius:.2f}',
+               '--scale-units', 'arcsecperpix',
+               '--scale-low', f'{0.9*scale:.4f}',
+               '--scale-high', f'{1.1*scale:.4f}',
+               '--downsample', f'{downsample:d}',
+               '--tweak-order', f'{SIPorder:d}',
+               '--cpulimit', f'{cpulimit:d}',
+               imagefile]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=cpulimit+30)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        wcsfile = os.path.join(tmpdir, 'image.wcs')
+        if not os.path.exists(os.path.join(tmpdir, 'image.solved'))\
+           or not os.path.exists(wcsfile):
+            return None
+        return WCS(fits.getheader(wcsfile))
+
+
+def solve_astrometry(im, telescope, target, date, pixel_scale, cache=wcs_cache,
+                     downsample=2, SIPorder=4):
+    '''Solve astrometry for a SIDRE image, trying a seeded solve from the WCS
+    cache first and only falling back to SIDRE's blind solve if that fails.
+    Returns True if the warm (seeded) path produced the solution.
+    '''
+    warm = False
+    seed = None
+    if cache is not None and pixel_scale is not None:
+        seed = cache.get(telescope, target, date=date)
+    if seed is not None:
+        im.log.info('Attempting astrometry seeded by previous solution')
+        try:
+            wcs = seeded_solve(im.ccd.data, seed, im.header_pointing,
+                               pixel_scale, downsample=downsample,
+                               SIPorder=SIPorder)
+        except Exception as e:
+            im.log.warning(f'  Seeded solve failed: {e}')
+            wcs = None
+        if wcs is not None:
+            im.ccd.wcs = wcs
+            im.ccd.header.update(wcs.to_header(relax=True))
+            im.wcs_pointing = wcs_center(wcs, im.ccd.data.shape)
+            warm = True
+            im.log.info('  Seeded solve succeeded')
+        else:
+            im.log.info('  Seeded solve failed, solving blind')
+    if not warm:
+        im.solve_astrometry(downsample=downsample, SIPorder=SIPorder)
+
+    if cache is not None and getattr(im, 'wcs_pointing', None) is not None:
+        cache.put(telescope, target, getattr(im.ccd, 'wcs', None),
+                  im.header_pointing, date)
+    return warm
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+In-memory cache of master calibration frames.  The masters for a night are
+looked up (and if necessary built) once, decoded to NumPy arrays, and then
+reused for every frame of that night instead of being re-read from disk.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from astropy.io import fits
+
+import SIDRE
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def night_key(date):
+    '''Reduce a datetime, astropy Time, or date string to a YYYYMMDDUT string
+    so that all frames from one UT date share a cache entry.
+    '''
+    date = getattr(date, 'datetime', date)
+    if isinstance(date, datetime):
+        return date.strftime('%Y%m%dUT')
+    return str(date)[:10].replace('-', '')
+
+
+def missing(master):
+    '''get_master returns None, False, or an empty string when there is no
+    master for that date.
+    '''
+    return master is None or master is False or (isinstance(master, str)
+                                                  and master == '')
+
+
+def decode_master(master):
+    '''Masters given as a file name are read once in to a NumPy array, other
+    objects (arrays or CCDData) are kept as they are.
+    '''
+    if isinstance(master, (str, os.PathLike)):
+        master = fits.getdata(master)
+    return master
+
+
+def master_nbytes(master):
+    data = getattr(master, 'data', master)
+    return int(getattr(data, 'nbytes', 0))
+
+
+##-------------------------------------------------------------------------
+## Calibration Cache
+##-------------------------------------------------------------------------
+class CalibrationCache(object):
+    '''LRU cache of master calibration frames keyed by telescope, UT date, and
+    calibration type.  Entries are evicted in least recently used order when
+    there are more than maxentries of them or, if maxbytes is set, when their
+    total size exceeds maxbytes.
+    '''
+    def __init__(self, maxentries=4, maxbytes=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, telescope, date, type='Bias', make=None):
+        '''Return the master of the given type for this telescope and date.
+        On a miss the master is found with SIDRE.utils.get_master and, if it
+        does not exist and make is given, built by calling make(date) first.
+        Returns None if no master could be found.
+        '''
+        key = (telescope, night_key(date), type)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        master = SIDRE.utils.get_master(date, type=type)
+        if missing(master) and make is not None:
+            make(date)
+            master = SIDRE.utils.get_master(date, type=type)
+        if missing(master):
+            return None
+        master = decode_master(master)
+        self.put(key, master)
+        return master
+
+    def put(self, key, master):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= master_nbytes(self.entries.pop(key))
+            self.entries[key] = master
+            self.nbytes += master_nbytes(master)
+            self.evict()
+
+    def evict(self):
+        ## Always keep the most recently added entry, even if it alone is
+        ## larger than maxbytes.
+        while len(self.entries) > 1 and (len(self.entries) > self.maxentries
+              or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            key, master = self.entries.popitem(last=False)
+            self.nbytes -= master_nbytes(master)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+## Shared by measure_image and the batch tools which call it.  Worker
+## processes each get their own copy.
+master_cache = CalibrationCache()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Report files in a directory as soon as they have been completely written.
+On Linux, inotify close-after-write events are used (via the optional
+inotify_simple package).  Otherwise the directory is polled.  In both cases
+a file is only reported once it has stopped changing, so files which are
+still being written are not picked up early.
+"""
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class DirectoryWatcher(object):
+    '''Watch path for files whose names match the compiled regex match.
+
+    wait() blocks for up to timeout seconds and returns the names of files
+    which are ready: closed after writing and quiet for close_settle
+    seconds, or (if no close event is seen, e.g. when polling) unchanged
+    for settle seconds.  Files already in the directory when the watcher
+    starts are reported on the first call to wait().
+    '''
+    def __init__(self, path, match, settle=5., close_settle=1.,
+                 poll_interval=2., use_inotify=True, logger=None):
+        self.path = path
+        self.match = match
+        self.settle = settle
+        self.close_settle = close_settle
+        self.poll_interval = poll_interval
+        self.logger = logger
+        ## name: [last change time, closed after write, (size, mtime)]
+        self.pending = {}
+        ## (size, mtime) of files already reported, used when polling
+        self.reported = {}
+        self.last_poll = 0
+
+        self.inotify = None
+        if use_inotify is True and INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO
+                                             | flags.CREATE | flags.MODIFY)
+            except OSError as e:
+                if self.logger: self.logger.warning(f'inotify unavailable: {e}')
+                self.inotify = None
+        if self.logger:
+            mode = 'inotify events' if self.inotify is not None else 'polling'
+            self.logger.info(f'Watching {path} using {mode}')
+
+        ## Files which are already present
+        now = time.time()
+        for name, stat in self.scan().items():
+            age = now - stat[1]
+            self.pending[name] = [now - age, age > self.settle, stat]
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def scan(self):
+        '''Return {name: (size, mtime)} for matching files in the directory.'''
+        stats = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if self.match.match(entry.name) and entry.is_file():
+                        stat = entry.stat()
+                        stats[entry.name] = (stat.st_size, stat.st_mtime)
+        except FileNotFoundError:
+            pass
+        return stats
+
+    def touch(self, name, closed=False):
+        entry = self.pending.setdefault(name, [0, False, None])
+        entry[0] = time.time()
+        entry[1] = closed
+
+    def read_events(self, timeout):
+        if self.inotify is not None:
+            for event in self.inotify.read(timeout=int(timeout*1000)):
+                if not self.match.match(event.name):
+                    continue
+                closed = bool(event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO))
+                self.touch(event.name, closed=closed)
+        else:
+            time.sleep(max(0, min(timeout, self.last_poll + self.poll_interval
+                                           - time.time())))
+            self.last_poll = time.time()
+            for name, stat in self.scan().items():
+                if self.reported.get(name, None) == stat:
+                    continue
+                entry = self.pending.get(name, None)
+                if entry is None or entry[2] != stat:
+                    self.touch(name)
+                    self.pending[name][2] = stat
+
+    def wait(self, timeout=1.):
+        '''Wait up to timeout seconds and return a list of ready files.'''
+        self.read_events(timeout)
+        now = time.time()
+        ready = []
+        for name, (changed, closed, stat) in list(self.pending.items()):
+            quiet = now - changed
+            if (closed and quiet >= self.close_settle) or quiet >= self.settle:
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    del self.pending[name]
+                    continue
+                if stat.st_size == 0:
+                    continue
+                ready.append(name)
+                self.reported[name] = (stat.st_size, stat.st_mtime)
+                del self.pending[name]
+        return ready
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Sun and Moon ephemeris for the observatory, precomputed once per UT date.
+
+A day's table holds the Sun and Moon altitudes and the Moon's phase on a
+fine time grid (00:00 to 24:00 UT) computed with pyephem.  Tables are cached
+on disk (so each is only computed once per machine) and in memory (so
+repeated lookups by the status page and dashboards are just interpolations).
+Rise, set, and twilight times are found where the tabulated altitudes cross
+the relevant level.
+"""
+
+import os
+import threading
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import numpy as np
+import ephem
+
+
+##-------------------------------------------------------------------------
+## Observatory and Table Properties
+##-------------------------------------------------------------------------
+observatory = {'lon': "-155:34:33.9",
+               'lat': "+19:32:09.66",
+               'elevation': 3400.0,
+               'temp': 10.0,
+               'pressure': 680.0,
+              }
+
+## Twilight levels for the Sun's center (degrees).  Sunrise and sunset (and
+## moonrise and moonset) are when the upper limb crosses the horizon.
+twilight_levels = {'civil': -6., 'nautical': -12., 'astronomical': -18.}
+
+cache_dir = os.path.expanduser(os.path.join('~', '.vysos', 'ephemeris'))
+table_version = 1
+epoch = dt(1970, 1, 1)
+
+tables = {}
+tables_lock = threading.Lock()
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def to_seconds(when):
+    '''Convert a (naive, UT) datetime to seconds since 1970-01-01.'''
+    return (when - epoch).total_seconds()
+
+
+def to_datetime(seconds):
+    return epoch + tdelta(0, float(seconds))
+
+
+def to_datetime64(seconds):
+    '''Convert an array of seconds since 1970-01-01 to datetime64[us].'''
+    microseconds = np.round(np.asarray(seconds)*1e6).astype(np.int64)
+    return microseconds.astype('datetime64[us]')
+
+
+def find_crossings(t, y, level):
+    '''Find where y (sampled at times t) crosses level, by linear
+    interpolation between the samples which bracket each crossing.  Returns
+    (rising, setting), the arrays of times at which y goes above and below
+    level.
+    '''
+    d = np.asarray(y) - level
+    i = np.nonzero((d[:-1] < 0) != (d[1:] < 0))[0]
+    frac = d[i]/(d[i] - d[i+1])
+    times = t[i] + frac*(t[i+1] - t[i])
+    rising = d[i+1] > d[i]
+    return times[rising], times[~rising]
+
+
+def sky_condition(sun_alt):
+    '''Describe the sky given the Sun's altitude in degrees.'''
+    if sun_alt <= -18:
+        return 'night'
+    elif sun_alt <= -12:
+        return 'astronomical twilight'
+    elif sun_alt <= -6:
+        return 'nautical twilight'
+    elif sun_alt <= 0:
+        return 'civil twilight'
+    else:
+        return 'day'
+
+
+def compute_table(date, spacing=120):
+    '''Compute the table for the UT date (a datetime at 00:00 UT) with
+    samples every spacing seconds.  Returns a dict of arrays.
+    '''
+    Observatory = ephem.Observer()
+    for key, value in observatory.items():
+        setattr(Observatory, key, value)
+    TheSun = ephem.Sun()
+    TheMoon = ephem.Moon()
+
+    t = to_seconds(date) + np.arange(0, 24*60*60 + spacing, spacing)
+    table = {'time': t}
+    for name in ['sun_alt', 'sun_limb', 'moon_alt', 'moon_limb', 'moon_phase']:
+        table[name] = np.zeros(len(t))
+    for i, seconds in enumerate(t):
+        Observatory.date = ephem.Date(to_datetime(seconds))
+        TheSun.compute(Observatory)
+        TheMoon.compute(Observatory)
+        table['sun_alt'][i] = TheSun.alt
+        table['sun_limb'][i] = TheSun.alt + TheSun.radius
+        table['moon_alt'][i] = TheMoon.alt
+        table['moon_limb'][i] = TheMoon.alt + TheMoon.radius
+        table['moon_phase'][i] = TheMoon.phase
+    for name in ['sun_alt', 'sun_limb', 'moon_alt', 'moon_limb']:
+        table[name] *= 180./np.pi
+    return table
+
+
+##-------------------------------------------------------------------------
+## Ephemeris Table for One UT Date
+##-------------------------------------------------------------------------
+class DayEphemeris(object):
+    '''Sun and Moon ephemeris for the UT date of date, loaded from the disk
+    cache if possible and computed (and cached) otherwise.
+    '''
+    def __init__(self, date, spacing=120, cache_dir=cache_dir):
+        self.date = dt(date.year, date.month, date.day)
+        self.spacing = spacing
+        filename = f"{self.date.strftime('%Y%m%dUT')}_{spacing}s_v{table_version}.npz"
+        cache_file = os.path.join(cache_dir, filename) if cache_dir else None
+        self.table = None
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as npz:
+                    self.table = {name: npz[name] for name in npz.files}
+            except:
+                self.table = None
+        if self.table is None:
+            self.table = compute_table(self.date, spacing=spacing)
+            if cache_file is not None:
+                try:
+                    if not os.path.exists(cache_dir):
+                        os.makedirs(cache_dir)
+                    tmpfile = f"{cache_file}.{os.getpid()}.npz"
+                    np.savez(tmpfile, **self.table)
+                    os.replace(tmpfile, cache_file)
+                except OSError:
+                    pass
+
+    def value(self, name, when):
+        '''Interpolate the named column (e.g. sun_alt, moon_phase) at when.'''
+        return float(np.interp(to_seconds(when), self.table['time'],
+                               self.table[name]))
+
+    def series(self, name, start=None, end=None):
+        '''Return (datetime64 array, array) of the named column between start
+        and end.
+        '''
+        t = self.table['time']
+        w = np.ones(len(t), dtype=bool)
+        if start is not None:
+            w &= (t >= to_seconds(start))
+        if end is not None:
+            w &= (t <= to_seconds(end))
+        return to_datetime64(t[w]), self.table[name][w]
+
+    def crossings(self, name, level):
+        '''Return (rising, setting) lists of datetimes at which the named
+        column crosses level.
+        '''
+        rising, setting = find_crossings(self.table['time'], self.table[name],
+                                         level)
+        return [to_datetime(x) for x in rising], [to_datetime(x) for x in setting]
+
+    def twilights(self, midnight=None):
+        '''Return the sunset, sunrise, and twilight times of the night which
+        includes midnight (by default 10:00 UT, local midnight in Hawaii), as a
+        dict with keys like sunset and evening_nautical_twilight.
+        '''
+        if midnight is None:
+            midnight = self.date + tdelta(0, 10*60*60)
+        levels = [('sun_limb', 0., 'sunset', 'sunrise')]
+        for name, level in twilight_levels.items():
+            levels.append(('sun_alt', level, f'evening_{name}_twilight',
+                           f'morning_{name}_twilight'))
+        result = {}
+        for column, level, evening, morning in levels:
+            rising, setting = self.crossings(column, level)
+            setting = [x for x in setting if x < midnight]
+            rising = [x for x in rising if x > midnight]
+            result[evening] = setting[-1] if len(setting) > 0 else None
+            result[morning] = rising[0] if len(rising) > 0 else None
+        return result
+
+
+def day(when):
+    '''Return the (memoized) DayEphemeris for the UT date of when.'''
+    key = when.strftime('%Y%m%d')
+    with tables_lock:
+        if key not in tables:
+            tables[key] = DayEphemeris(when)
+        return tables[key]
+
+
+def next_crossing(when, name, level, direction, maxdays=3):
+    '''Return the first time after when at which the named column crosses
+    level going up (direction='rising') or down ('setting').
+    '''
+    for i in range(maxdays):
+        rising, setting = day(when + tdelta(i)).crossings(name, level)
+        events = {'rising': rising, 'setting': setting}[direction]
+        events = [x for x in events if x > when]
+        if len(events) > 0:
+            return events[0]
+    return None
+
+
+##-------------------------------------------------------------------------
+## Current Sun and Moon Information
+##-------------------------------------------------------------------------
+def sun_and_moon(when=None):
+    '''Return (sun, moon) dicts with the altitude, next rise and set times,
+    and a description of the current state (plus the Moon's phase) at when
+    (by default now).
+    '''
+    if when is None:
+        when = dt.utcnow()
+    table = day(when)
+    sun = {}
+    sun['alt'] = table.value('sun_alt', when)
+    sun['set'] = next_crossing(when, 'sun_limb', 0, 'setting')
+    sun['rise'] = next_crossing(when, 'sun_limb', 0, 'rising')
+    sun['now'] = sky_condition(sun['alt'])
+
+    moon = {}
+    moon['phase'] = table.value('moon_phase', when)
+    moon['alt'] = table.value('moon_alt', when)
+    moon['set'] = next_crossing(when, 'moon_limb', 0, 'setting')
+    moon['rise'] = next_crossing(when, 'moon_limb', 0, 'rising')
+    if moon['alt'] > 0:
+        moon['now'] = 'up'
+    else:
+        moon['now'] = 'down'
+    return sun, moon
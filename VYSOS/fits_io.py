@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Selective reads of .fts and .fts.fz frames.  Uncompressed data are memory
+mapped (without scaling, so only the pages which are touched get read) and
+compressed data are read through the tile-aware section interface, so only
+the tiles covering the requested pixels get decompressed.  This is used by
+the stages which only need part of a frame (the watcher reads headers, the
+pre-screen a subsample and a band of rows), so they cost well below a full
+read.  The full measurement still reads the frame through SIDRE.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def image_hdu(hdul):
+    '''Return the first 2D image HDU (compressed or not) in an HDUList.'''
+    for hdu in hdul:
+        if hdu.is_image and hdu.header.get('NAXIS', 0) == 2:
+            return hdu
+    raise OSError(f'No 2D image found in {hdul.filename()}')
+
+
+def scale(raw, header):
+    '''Apply BSCALE and BZERO to unscaled data, returning float32.'''
+    data = raw.astype(np.float32)
+    bscale = header.get('BSCALE', 1.)
+    bzero = header.get('BZERO', 0.)
+    if bscale != 1.:
+        data *= bscale
+    if bzero != 0.:
+        data += bzero
+    return data
+
+
+def open_frame(file):
+    '''Open a frame for selective reads.  Use as a context manager.  Data
+    are not scaled, see scale().
+    '''
+    return fits.open(file, memmap=True, do_not_scale_image_data=True)
+
+
+##-------------------------------------------------------------------------
+## Selective Reads
+##-------------------------------------------------------------------------
+def read_header(file):
+    '''Read only the header of the image HDU.'''
+    with open_frame(file) as hdul:
+        return image_hdu(hdul).header.copy()
+
+
+def read_region(file, rows, columns):
+    '''Read data[rows, columns] (both slices) as float32, decompressing only
+    the tiles which overlap the region.  Returns (header, data).
+    '''
+    with open_frame(file) as hdul:
+        hdu = image_hdu(hdul)
+        header = hdu.header.copy()
+        if isinstance(hdu, fits.CompImageHDU):
+            data = scale(hdu.section[rows, columns], header)
+        else:
+            data = scale(hdu.data[rows, columns], header)
+    return header, data
+
+
+def read_subsample(file, stride=16, nbands=8):
+    '''Read a sparse, evenly spread subsample of the pixels as float32.
+    Returns (header, subsample).
+
+    Uncompressed frames are sampled every stride'th pixel in each direction
+    straight from the memory map.  Compressed frames are stored in row
+    tiles, so a strided read would still decompress every tile; instead
+    nbands bands of stride rows, evenly spaced down the frame, are read and
+    sampled every stride'th pixel along the row.
+    '''
+    with open_frame(file) as hdul:
+        hdu = image_hdu(hdul)
+        header = hdu.header.copy()
+        if isinstance(hdu, fits.CompImageHDU):
+            ny = header['NAXIS2']
+            starts = np.linspace(0, max(ny-stride, 0), nbands).astype(int)
+            bands = [hdu.section[start:start+stride, ::stride]
+                     for start in np.unique(starts)]
+            subsample = scale(np.vstack(bands), header)
+        else:
+            subsample = scale(hdu.data[::stride, ::stride], header)
+    return header, subsample
@@ -10,17 +10,100 @@ import datetime
 import re
 import numpy as np
 import pymongo
-import requests
-import json
+import threading
+from collections import deque
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
 
 import win32com.client
 import pywintypes
+import pythoncom
+
+from VYSOS.alpaca import AlpacaDevice
 
 # import mongoengine as me
 # from VYSOS.schema import telstatus
 
 
+##-------------------------------------------------------------------------
+## Background Sampling of Averaged Values
+##-------------------------------------------------------------------------
+class DeviceSampler(object):
+    '''Reads a device every interval seconds in a background thread and keeps
+    the last nsamples readings, so values which are averaged over several
+    readings (e.g. the RCOS temperatures) do not hold up the status cycle.
+
+    connect() is called in the sampler's own thread (COM objects must be used
+    from the thread which created them) and returns the handle passed to
+    read(handle), which returns a dict of values.  If a read fails, the
+    device is connected again before the next one.
+    '''
+    def __init__(self, name, connect, read, logger, interval=1., nsamples=5):
+        self.name = name
+        self.connect = connect
+        self.read = read
+        self.logger = logger
+        self.interval = interval
+        self.samples = deque(maxlen=nsamples)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.failing = False
+        self.thread = threading.Thread(target=self.run, name=f'sample_{name}',
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pythoncom.CoInitialize()
+        handle = None
+        try:
+            while not self.stopped.is_set():
+                tick = time.time()
+                try:
+                    if handle is None:
+                        handle = self.connect()
+                    sample = self.read(handle)
+                except:
+                    handle = None
+                    if not self.failing:
+                        self.logger.warning(f'Sampling {self.name} failed: {sys.exc_info()[0].__name__}')
+                    self.failing = True
+                else:
+                    if self.failing:
+                        self.logger.info(f'Sampling {self.name} recovered')
+                    self.failing = False
+                    with self.lock:
+                        self.samples.append((tick, sample))
+                self.stopped.wait(max(0, tick + self.interval - time.time()))
+        finally:
+            pythoncom.CoUninitialize()
+
+    def recent(self):
+        '''Return the samples (dicts) taken in the last nsamples intervals.'''
+        oldest = time.time() - (self.samples.maxlen + 1)*self.interval
+        with self.lock:
+            return [sample for tick, sample in self.samples if tick >= oldest]
+
+    def stop(self):
+        self.stopped.set()
+
+
+def take_samples(connect, read, nsamples, interval):
+    '''Take nsamples readings interval seconds apart in the calling thread,
+    for use when there is no DeviceSampler running.
+    '''
+    handle = connect()
+    samples = []
+    for i in range(nsamples):
+        try:
+            samples.append(read(handle))
+        except:
+            pass
+        if i < nsamples-1:
+            time.sleep(interval)
+    return samples
+
+
 ##-------------------------------------------------------------------------
 ## Get AAGSolo Network Share aag_sld.dat file
 ##-------------------------------------------------------------------------
@@ -94,29 +177,40 @@ def get_telescope_info(status, logger):
 ##-------------------------------------------------------------------------
 ## Query ASCOM Focuser for Position, Temperature, Fan State
 ##-------------------------------------------------------------------------
-def get_focuser_info(status, logger):
-    logger.info('Getting ASCOM focuser status')
+def connect_focuser():
+    FocusMax = win32com.client.Dispatch("FocusMax.Focuser")
+    if not FocusMax.Link:
+        FocusMax.Link = True
+    return FocusMax
+
+
+def read_focuser(FocusMax):
+    sample = {'temperature': float(FocusMax.Temperature)}
     try:
-        FocusMax = win32com.client.Dispatch("FocusMax.Focuser")
-        if not FocusMax.Link:
-            try:
-                FocusMax.Link = True
-            except:
-                logger.error('Could not start FocusMax ASCOM link.')
-        logger.debug('  Connected to FocusMax')
+        sample['position'] = int(FocusMax.Position)
     except:
-        logger.error('Could not connect to FocusMax ASCOM object.')
-        return status
+        pass
+    return sample
+
 
-    ## Get Average of 3 Temperature Readings
-    FocusMax_Temps = []
-    for i in range(0,3,1):
+def get_focuser_info(status, logger, sampler=None):
+    '''Median of 3 temperature readings and the latest position, from the
+    sampler if one is running and otherwise read now.
+    '''
+    logger.info('Getting ASCOM focuser status')
+    if sampler is not None:
+        samples = sampler.recent()
+    else:
         try:
-            newtemp = float(FocusMax.Temperature)
-            logger.debug('  Queried FocusMax temperature = {:.1f}'.format(newtemp))
-            FocusMax_Temps.append(newtemp)
+            samples = take_samples(connect_focuser, read_focuser, 3, 0)
+            logger.debug('  Connected to FocusMax')
         except:
-            pass
+            logger.error('Could not connect to FocusMax ASCOM object.')
+            return status
+
+    FocusMax_Temps = [x['temperature'] for x in samples]
+    for newtemp in FocusMax_Temps:
+        logger.debug('  Queried FocusMax temperature = {:.1f}'.format(newtemp))
     if len(FocusMax_Temps) > 0:
         ## Filter out bad values
         median_temp = np.median(FocusMax_Temps)
@@ -124,11 +218,10 @@ def get_focuser_info(status, logger):
             status['focuser_temperature'] = median_temp
             logger.debug('  FocusMax temperature = {:.1f} {}'.format(status['focuser_temperature'], 'C'))
     ## Get Position
-    try:
-        status['focuser_position'] = int(FocusMax.Position)
+    positions = [x['position'] for x in samples if 'position' in x]
+    if len(positions) > 0:
+        status['focuser_position'] = positions[-1]
         logger.debug('  FocusMax position = {:d}'.format(status['focuser_position']))
-    except:
-        pass
 
     return status
 
@@ -136,53 +229,49 @@ def get_focuser_info(status, logger):
 ##-------------------------------------------------------------------------
 ## Query RCOS TCC
 ##-------------------------------------------------------------------------
-def get_RCOS_info(status, logger):
+def connect_RCOS():
+    RCOST = win32com.client.Dispatch("RCOS_AE.Temperature")
+    RCOSF = win32com.client.Dispatch("RCOS_AE.Focuser")
+    return RCOST, RCOSF
+
+
+def read_RCOS(handle):
+    '''One reading of the RCOS TCC.  Temperatures (F) outside the plausible
+    range are returned as NaN.
+    '''
+    RCOST, RCOSF = handle
+    sample = {}
+    for name, value in [('truss', RCOST.AmbientTemp),
+                        ('primary', RCOST.PrimaryTemp),
+                        ('secondary', RCOST.SecondaryTemp)]:
+        sample[name] = value if (value > 20 and value < 120) else float('nan')
+    sample['fan'] = RCOST.FanSpeed
+    sample['position'] = RCOSF.Position
+    return sample
+
+
+def get_RCOS_info(status, logger, sampler=None):
+    '''Medians of 5 readings (taken a second apart) of the RCOS TCC, from
+    the sampler if one is running and otherwise read now.
+    '''
     logger.info('Getting RCOS TCC status')
-    try:
-        RCOST = win32com.client.Dispatch("RCOS_AE.Temperature")
-        RCOSF = win32com.client.Dispatch("RCOS_AE.Focuser")
-        logger.debug('  Connected to RCOS focuser')
-    except:
-        logger.error('Could not connect to RCOS ASCOM object.')
-        return status
-
-    ## Get Average of 5 Temperature Readings
-    RCOS_Truss_Temps = []
-    RCOS_Primary_Temps = []
-    RCOS_Secondary_Temps = []
-    RCOS_Fan_Speeds = []
-    RCOS_Focus_Positions = []
-    logger.debug('  {:>7s}, {:>7s}, {:>7s}, {:>7s}, {:>5s}'.format('Truss', 'Pri', 'Sec', 'Fan', 'Foc'))
-    for i in range(0,5,1):
+    if sampler is not None:
+        samples = sampler.recent()
+    else:
         try:
-            new_Truss_Temp = RCOST.AmbientTemp
-            if new_Truss_Temp > 20 and new_Truss_Temp < 120:
-                RCOS_Truss_Temps.append(new_Truss_Temp)
-            else:
-                new_Truss_Temp = float('nan')
-
-            new_Pri_Temp = RCOST.PrimaryTemp
-            if new_Pri_Temp > 20 and new_Pri_Temp < 120:
-                RCOS_Primary_Temps.append(new_Pri_Temp)
-            else:
-                new_Pri_Temp = float('nan')
-
-            new_Sec_Temp = RCOST.SecondaryTemp
-            if new_Sec_Temp > 20 and new_Sec_Temp < 120:
-                RCOS_Secondary_Temps.append(new_Sec_Temp)
-            else:
-                new_Sec_Temp = float('nan')
-
-            new_Fan_Speed = RCOST.FanSpeed
-            RCOS_Fan_Speeds.append(new_Fan_Speed)
-
-            new_Focus_Pos = RCOSF.Position
-            RCOS_Focus_Positions.append(new_Focus_Pos)
-
-            logger.debug('  {:5.1f} F, {:5.1f} F, {:5.1f} F, {:5.0f} %, {:5d}'.format(new_Truss_Temp, new_Pri_Temp, new_Sec_Temp, new_Fan_Speed, new_Focus_Pos))
+            samples = take_samples(connect_RCOS, read_RCOS, 5, 1)
+            logger.debug('  Connected to RCOS focuser')
         except:
-            pass
-        time.sleep(1)
+            logger.error('Could not connect to RCOS ASCOM object.')
+            return status
+
+    logger.debug('  {:>7s}, {:>7s}, {:>7s}, {:>7s}, {:>5s}'.format('Truss', 'Pri', 'Sec', 'Fan', 'Foc'))
+    for x in samples:
+        logger.debug('  {:5.1f} F, {:5.1f} F, {:5.1f} F, {:5.0f} %, {:5d}'.format(x['truss'], x['primary'], x['secondary'], x['fan'], x['position']))
+    RCOS_Truss_Temps = [x['truss'] for x in samples if not np.isnan(x['truss'])]
+    RCOS_Primary_Temps = [x['primary'] for x in samples if not np.isnan(x['primary'])]
+    RCOS_Secondary_Temps = [x['secondary'] for x in samples if not np.isnan(x['secondary'])]
+    RCOS_Fan_Speeds = [x['fan'] for x in samples]
     if len(RCOS_Truss_Temps) >= 3:
         status['truss_temperature'] = (float(np.median(RCOS_Truss_Temps)) - 32.)/1.8
         logger.debug('  RCOS temperature (truss) = {:.1f} {}'.format(
@@ -235,29 +324,75 @@ def control_by_web(status, logger):
 ##-------------------------------------------------------------------------
 ## Query ASCOM Alpaca Server for Dome Info
 ##-------------------------------------------------------------------------
+## One client per dome, kept for the life of the process.  Whether the dome is
+## at home or slaved rarely changes, so those are only read every 30 seconds.
+domes = {}
+
 def get_dome_info(status, logger, number=0):
     commands = ['connected', 'shutterstatus', 'atpark', 'athome', 'azimuth',
                 'slaved', 'slewing']
 
     logger.info(f'Getting Dome Status')
+    if number not in domes:
+        domes[number] = AlpacaDevice('dome', number, timeout=2.,
+                                     ttl={'athome': 30, 'slaved': 30})
+    values, errors = domes[number].get_many(commands)
     for command in commands:
-        url = f'http://127.0.0.1:11111/api/v1/dome/{number}/{command}'
-        try:
-            r = requests.get(url)
-            j = json.loads(r.text)
-            value = j['Value']
-        except:
+        if command in errors:
             logger.warning(f'  Failed to get dome status: {command}')
+            continue
+        value = values[command]
+        logger.debug(f'  {command} = {value}')
+        if command == 'azimuth':
+            status[f"dome_{command}"] = float(value)
         else:
-            logger.debug(f'  {command} = {value}')
-            if command == 'azimuth':
-                status[f"dome_{command}"] = float(value)
-            else:
-                status[f"dome_{command}"] = value
+            status[f"dome_{command}"] = value
     return status
 
 
-def get_status_and_log(telescope, logger):
+##-------------------------------------------------------------------------
+## Query All Devices Concurrently
+##-------------------------------------------------------------------------
+## One thread per device, each with COM initialized for its apartment
+query_pool = ThreadPoolExecutor(max_workers=6, thread_name_prefix='status',
+                                initializer=pythoncom.CoInitialize)
+## Most recent query of each device: future
+running = {}
+
+
+def query_devices(queries, logger):
+    '''Run the queries, a list of (name, function, timeout) where function
+    takes (status, logger), at the same time.  Each query fills in its own
+    dict and the results of those which finish within their timeout (in
+    seconds) are merged and returned.  A query which timed out is not
+    started again until it has finished, so a hung device ties up at most
+    one thread.
+    '''
+    started = {}
+    for name, query, timeout in queries:
+        previous = running.get(name, None)
+        if previous is not None and not previous.done():
+            logger.warning(f'{name} query from a previous cycle has not returned')
+            continue
+        result = {}
+        running[name] = query_pool.submit(query, result, logger)
+        started[name] = (running[name], result, time.time() + timeout)
+
+    status = {}
+    for name, (future, result, deadline) in started.items():
+        try:
+            future.result(timeout=max(0, deadline - time.time()))
+        except FutureTimeout:
+            logger.warning(f'{name} query timed out')
+            continue
+        except:
+            logger.warning(f'{name} query failed: {sys.exc_info()[0].__name__}')
+            continue
+        status.update(result)
+    return status
+
+
+def get_status_and_log(telescope, logger, samplers=None):
 
     ##-------------------------------------------------------------------------
     ## Get Status Info
@@ -267,12 +402,18 @@ def get_status_and_log(telescope, logger):
     status = {'telescope': telescope,
               'date':datetime.datetime.utcnow()
              }
-    get_AAGSolo(status, logger)
-    status = get_telescope_info(status, logger)
-    status = get_focuser_info(status, logger)
-    status = get_dome_info(status, logger)
+    ## Averaged values come from the samplers (if running), so each of these
+    ## should take no longer than a single read of the device
+    if samplers is None:
+        samplers = {}
+    queries = [('AAG', get_AAGSolo, 5),
+               ('ACP', get_telescope_info, 10),
+               ('focuser', lambda x, l: get_focuser_info(x, l, samplers.get('focuser', None)), 5),
+               ('dome', get_dome_info, 5),
+              ]
     if telescope == 'V20':
-        status = get_RCOS_info(status, logger)
+        queries.append(('RCOS', lambda x, l: get_RCOS_info(x, l, samplers.get('RCOS', None)), 7))
+    status.update(query_devices(queries, logger))
 
     ##-------------------------------------------------------------------------
     ## Write to Mongo
@@ -318,6 +459,9 @@ if __name__ == '__main__':
         type=str, dest="telescope", default='V20',
         choices=['V5', 'V20'], required=False,
         help="The telescope system we are querying.")
+    parser.add_argument("-i", "--interval",
+        type=float, dest="interval", default=10., required=False,
+        help="Seconds between status records (default = 10)")
     args = parser.parse_args()
 
     telescope = args.telescope
@@ -342,10 +486,28 @@ if __name__ == '__main__':
         LogConsoleHandler.setFormatter(LogFormat)
         logger.addHandler(LogConsoleHandler)
 
+    ## Sample the values which are averaged over several readings in the
+    ## background, at their own cadence
+    samplers = {'focuser': DeviceSampler('focuser', connect_focuser,
+                                         read_focuser, logger,
+                                         interval=1, nsamples=3)}
+    if telescope == 'V20':
+        samplers['RCOS'] = DeviceSampler('RCOS', connect_RCOS, read_RCOS,
+                                         logger, interval=1, nsamples=5)
+    ## Let them collect a full set of readings before the first record
+    time.sleep(max([x.samples.maxlen*x.interval for x in samplers.values()]))
+
     logger.info(f'Getting status values for {telescope}')
     run = True
+    next_cycle = time.time()
     while run:
-        get_status_and_log(telescope, logger)
+        get_status_and_log(telescope, logger, samplers=samplers)
 #         run = False
         logging.shutdown()
-        time.sleep(20)
+        ## Keep a steady cadence, skipping cycles if one ran long
+        next_cycle += args.interval
+        if next_cycle < time.time():
+            missed = int((time.time() - next_cycle)/args.interval) + 1
+            logger.warning(f'Status cycle ran long, skipping {missed} cycle(s)')
+            next_cycle += missed*args.interval
+        time.sleep(max(0, next_cycle - time.time()))
@@ -5,585 +5,876 @@ import time
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
 import logging
+import warnings
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.dates import HourLocator, MinuteLocator, DateFormatter
 plt.style.use('classic')
 import pymongo
 
-import ephem
 from astropy.io import ascii
 import astropy.units as u
-from astropy.table import Table, Column, Row
-from astropy.modeling import models, fitting
-from astropy import stats
+from astropy.table import Table, Column, Row, vstack
 
 from VYSOS import Telescope, weather_limits
+from VYSOS import ephemeris
+from VYSOS.timeseries import load_columns, decimate
 
 
 ##-----------------------------------------------------------------------------
-## Function: sigma_clipping_line_fit
+## Sigma Clipped Line Fits (closed form, many lines at once)
 ##-----------------------------------------------------------------------------
+class FittedLine(object):
+    '''A straight line which can be called like an astropy Linear1D model.
+    '''
+    def __init__(self, slope, intercept):
+        self.slope = slope
+        self.intercept = intercept
+
+    def __call__(self, x):
+        return self.slope*np.asarray(x) + self.intercept
+
+
+def line_fit(x, y, use, intercept_fixed=False, intercept0=0):
+    '''Least squares fit of a line to each row of x and y, using only the
+    points where use is True.  Returns (slopes, intercepts).
+    '''
+    w = use.astype(float)
+    x = np.where(use, x, 0)
+    y = np.where(use, y, 0)
+    if intercept_fixed is True:
+        intercepts = np.full(len(x), float(intercept0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slopes = np.sum(w*x*(y-intercept0), axis=1)/np.sum(w*x*x, axis=1)
+        return slopes, intercepts
+    Sw = np.sum(w, axis=1)
+    Sx = np.sum(w*x, axis=1)
+    Sy = np.sum(w*y, axis=1)
+    Sxx = np.sum(w*x*x, axis=1)
+    Sxy = np.sum(w*x*y, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (Sw*Sxy - Sx*Sy)/(Sw*Sxx - Sx*Sx)
+        intercepts = (Sy - slopes*Sx)/Sw
+    return slopes, intercepts
+
+
+def row_medians(values):
+    '''Median of the finite values in each row (NaN sorts to the end, so
+    this is quicker than np.nanmedian).
+    '''
+    ordered = np.sort(values, axis=1)
+    n = np.sum(np.isfinite(values), axis=1)
+    last = ordered.shape[1] - 1
+    lo = np.take_along_axis(ordered, np.clip((n-1)//2, 0, last)[:,None], axis=1)[:,0]
+    hi = np.take_along_axis(ordered, np.clip(n//2, 0, last)[:,None], axis=1)[:,0]
+    return np.where(n > 0, 0.5*(lo + hi), np.nan)
+
+
+def clipped_std(values, use, sigma=3, maxiters=5):
+    '''Standard deviation of each row of values (where use is True) after
+    iterative sigma clipping about the median, as in astropy's
+    sigma_clipped_stats.
+    '''
+    values = np.where(use, values, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for iteration in range(maxiters):
+            median = row_medians(values)
+            std = np.nanstd(values, axis=1)
+            clip = np.abs(values - median[:,None]) > sigma*std[:,None]
+            if not np.any(clip):
+                break
+            values = np.where(clip, np.nan, values)
+        return np.nanstd(values, axis=1)
+
+
+def sigma_clipping_line_fits(xdata, ydata, nsigma=3, maxiter=7, maxcleanfrac=0.3,
+                             intercept_fixed=False, intercept0=0, log=None):
+    '''Sigma clipping line fit to each row of the 2D arrays xdata and ydata
+    (rows may be padded with NaN).  Returns (slopes, intercepts).
+
+    Each row is fitted, the points within nsigma of the line are kept, and the
+    fit is repeated on the kept points, adding any new points within nsigma
+    each time.  Iteration stops (and the previous fit is used) for a row once
+    more than maxcleanfrac of its points are rejected or the scatter grows.
+    '''
+    x = np.atleast_2d(np.asarray(xdata, dtype=float))
+    y = np.atleast_2d(np.asarray(ydata, dtype=float))
+    valid = np.isfinite(x) & np.isfinite(y)
+    npoints = np.sum(valid, axis=1)
+    single = (len(x) == 1)
+    if log and single: log.debug(f'  npoints = {npoints[0]}')
+
+    slopes, intercepts = line_fit(x, y, valid, intercept_fixed=intercept_fixed,
+                                  intercept0=intercept0)
+    deltas = y - (slopes[:,None]*x + intercepts[:,None])
+    std = clipped_std(deltas, valid)
+    cleaned = valid & (np.abs(deltas) < nsigma*std[:,None])
+    if log and single: log.debug(f'  fitted slope = {slopes[0]:3g}')
+    if log and single: log.debug(f'  std = {std[0]:4g}')
+    if log and single: log.debug(f'  n_cleaned = {np.sum(cleaned)}')
+
+    active = np.ones(len(x), dtype=bool)
+    for iteration in range(1, maxiter+1):
+        last_std = std
+        new_slopes, new_intercepts = line_fit(x, y, cleaned,
+                                              intercept_fixed=intercept_fixed,
+                                              intercept0=intercept0)
+        deltas = y - (new_slopes[:,None]*x + new_intercepts[:,None])
+        new_std = clipped_std(deltas, valid)
+        new_cleaned = cleaned | (valid & (np.abs(deltas) < nsigma*new_std[:,None]))
+        too_many = np.sum(valid & ~new_cleaned, axis=1)/npoints > maxcleanfrac
+        worse = new_std > last_std
+        if log and single and too_many[0] and active[0]:
+            log.debug(f'  Exceeded maxcleanfrac of {maxcleanfrac}')
+        elif log and single and worse[0] and active[0]:
+            log.debug(f'  StdDev increased')
+        active = active & ~too_many & ~worse
+        slopes = np.where(active, new_slopes, slopes)
+        intercepts = np.where(active, new_intercepts, intercepts)
+        std = np.where(active, new_std, std)
+        cleaned = np.where(active[:,None], new_cleaned, cleaned)
+        if not np.any(active):
+            break
+        if log and single: log.debug(f'  {iteration} fitted slope = {slopes[0]:3g}')
+        if log and single: log.debug(f'  {iteration} std = {std[0]:4g}')
+        if log and single: log.debug(f'  {iteration} n_cleaned = {np.sum(cleaned)}')
+
+    return slopes, intercepts
+
+
 def sigma_clipping_line_fit(xdata, ydata, nsigma=3, maxiter=7, maxcleanfrac=0.3,
                             intercept_fixed=False, intercept0=0, slope0=1,
                             log=None):
         if log: log.debug('  Running sigma_clipping_line_fit')
-        npoints = len(xdata)
-        if log: log.debug(f'  npoints = {npoints}')
-        fit = fitting.LinearLSQFitter()
-        line_init = models.Linear1D(slope=slope0, intercept=intercept0)
-        line_init.intercept.fixed = intercept_fixed
-        fitted_line = fit(line_init, xdata, ydata)
-        deltas = ydata - fitted_line(xdata)
-        mean, median, std = stats.sigma_clipped_stats(deltas)
-        cleaned = np.array(abs(deltas) < nsigma*std)
-#         if log: log.debug(cleaned)
-        if log: log.debug(f'  fitted slope = {fitted_line.slope.value:3g}')
-        if log: log.debug(f'  std = {std:4g}')
-        if log: log.debug(f'  n_cleaned = {np.sum(cleaned)}')
-        for iteration in range(1, maxiter+1):
-            last_std = std
-            new_fit = fit(line_init, xdata[cleaned], ydata[cleaned])
-            deltas = ydata - new_fit(xdata)
-            mean, median, std = stats.sigma_clipped_stats(deltas)
-            cleaned = cleaned | np.array(abs(deltas) < nsigma*std)
-            if np.sum(~cleaned)/npoints > maxcleanfrac:
-                if log: log.debug(f'  Exceeded maxcleanfrac of {maxcleanfrac}')
-                return fitted_line
-            if std > last_std:
-                if log: log.debug(f'  StdDev increased')
-                return fitted_line
-            else:
-                fitted_line = new_fit
-#             if log: log.debug(cleaned)
-            if log: log.debug(f'  {iteration} fitted slope = {fitted_line.slope.value:3g}')
-            if log: log.debug(f'  {iteration} std = {std:4g}')
-            if log: log.debug(f'  {iteration} n_cleaned = {np.sum(cleaned)}')
-
-        return fitted_line
+        slopes, intercepts = sigma_clipping_line_fits([xdata], [ydata],
+                                 nsigma=nsigma, maxiter=maxiter,
+                                 maxcleanfrac=maxcleanfrac,
+                                 intercept_fixed=intercept_fixed,
+                                 intercept0=intercept0, log=log)
+        return FittedLine(slopes[0], intercepts[0])
 
 
 def query_mongo(db, collection, query):
     if collection == 'weather':
         names=('date', 'temp', 'clouds', 'wind', 'gust', 'rain', 'safe')
-        dtype=(dt, np.float, np.float, np.float, np.float, np.int, np.bool)
+        dtype=('datetime64', float, float, float, float, int, bool)
     elif collection == 'V20status':
         names=('date', 'focuser_temperature', 'primary_temperature',
                'secondary_temperature', 'truss_temperature',
                'focuser_position', 'fan_speed',
                'alt', 'az', 'RA', 'DEC', 
               )
-        dtype=(dt, np.float, np.float, np.float, np.float, np.int, np.int,
-               np.float, np.float, np.float, np.float)
+        dtype=('datetime64', float, float, float, float, int, int,
+               float, float, float, float)
     elif collection == 'V5status':
         names=('date', 'focuser_temperature', 'focuser_position',
                'alt', 'az', 'RA', 'DEC', 
               )
-        dtype=(dt, np.float, np.float, np.float, np.float, np.float, np.float)
+        dtype=('datetime64', float, float, float, float, float, float)
     elif collection == 'images':
         names=('date', 'telescope', 'moon_separation', 'perr_arcmin',
                'airmass', 'FWHM_pix', 'ellipticity', 'throughput', 'filter')
-        dtype=(dt, 'a3', np.float, np.float, np.float, np.float, np.float,
-               np.float, 'a3')
+        dtype=('datetime64', str, float, float, float, float, float,
+               float, str)
+
+    columns = load_columns(db[collection], query, names, dtype, sort='date')
+    return Table(columns, names=names)
+
+
+def limit_categories(values, label):
+    '''Split values in to safe, warning, and unsafe (returned as arrays of
+    indices) using the weather limits for label.
+    '''
+    limits = weather_limits[label]
+    values = np.array(values)
+    if label == 'Rain':
+        wsafe = np.where(values > limits[0])[0]
+        wwarn = np.where((values <= limits[0]) & (values > limits[1]))[0]
+        wunsafe = np.where(values <= limits[1])[0]
+    else:
+        wsafe = np.where(values < limits[0])[0]
+        wwarn = np.where((values >= limits[0]) & (values < limits[1]))[0]
+        wunsafe = np.where(values >= limits[1])[0]
+    return wsafe, wwarn, wunsafe
 
-    result = Table(names=names, dtype=dtype)
-    for entry in db[collection].find(query):
-        insert = {}
-        for name in names:
-            if name in entry.keys():
-                insert[name] = entry[name]
-        result.add_row(insert)
-    return result
 
+##-----------------------------------------------------------------------------
+## Nightly Summary Plot
+##-----------------------------------------------------------------------------
+class NightPlot(object):
+    '''The nightly summary plot for one telescope and UT date.
+
+    The figure and its artists are kept, so that a long running process can
+    call refresh() to fetch only the status and weather documents which are
+    newer than the last refresh, update the lines with set_data, and save the
+    figure again without rebuilding it.
+    '''
+    def __init__(self, date_string, telescope, l, fit_airmass=False,
+                 destination_path='/var/www/nights/'):
+        self.date_string = date_string
+        self.telescope = telescope
+        self.l = l
+        self.fit_airmass = fit_airmass
+        self.tel = Telescope(telescope)
+        self.start = dt.strptime(date_string, '%Y%m%dUT')
+        self.end = self.start + tdelta(1)
+        night_plot_file_name = '{}_{}.png'.format(date_string, telescope)
+        self.night_plot_file = os.path.join(os.path.abspath(destination_path),
+                                            night_plot_file_name)
+
+        ## Sunrise, sunset, and twilight times from the ephemeris table
+        self.ephem_table = ephemeris.day(self.start)
+        self.twilights = self.ephem_table.twilights()
+        self.plot_start = self.twilights['sunset'] - tdelta(0, 1.5*60*60)
+        self.plot_end = self.twilights['sunrise'] + tdelta(0, 1800)
+
+        ## Size of the figure and the width (in pixels) of the time series
+        ## panels, which the telemetry is decimated to
+        self.figsize = (13, 9.5)
+        self.dpi = 100
+        self.npixels = int(0.465*self.figsize[0]*self.dpi)
+
+        self.db = None
+        self.images = None
+        self.status = None
+        self.weather = None
+        self.figure = None
+        self.axes = {}
+        self.lines = {}
 
-def make_plots(date_string, telescope, l, fit_airmass=False):
-    l.info(f"Making Nightly Plots for {telescope} on {date_string}")
-    telname = {'V20':'VYSOS-20', 'V5':'VYSOS-5'}
-
-    hours = HourLocator(byhour=range(24), interval=1)
-    mins = MinuteLocator(range(0,60,15))
-
-    start = dt.strptime(date_string, '%Y%m%dUT')
-    end = start + tdelta(1)
-    night_plot_file_name = '{}_{}.png'.format(date_string, telescope)
-    hours_fmt = DateFormatter('%H')
-
-    if end > dt.utcnow():
-        end = dt.utcnow()
-
-    ##------------------------------------------------------------------------
-    ## Set up pathnames and filenames
-    ##------------------------------------------------------------------------
-    tel = Telescope(telescope)
-    destination_path = os.path.abspath('/var/www/nights/')
-    night_plot_file = os.path.join(destination_path, night_plot_file_name)
-
-    ##------------------------------------------------------------------------
-    ## Use pyephem determine sunrise and sunset times
-    ##------------------------------------------------------------------------
-    Observatory = ephem.Observer()
-    Observatory.lon = "-155:34:33.9"
-    Observatory.lat = "+19:32:09.66"
-    Observatory.elevation = 3400.0
-    Observatory.temp = 10.0
-    Observatory.pressure = 680.0
-    Observatory.date = start.strftime('%Y/%m/%d 10:00:00')
-
-    Observatory.horizon = '0.0'
-    sunset  = Observatory.previous_setting(ephem.Sun()).datetime()
-    sunrise = Observatory.next_rising(ephem.Sun()).datetime()
-    Observatory.horizon = '-6.0'
-    evening_civil_twilight = Observatory.previous_setting(ephem.Sun(),
-                             use_center=True).datetime()
-    morning_civil_twilight = Observatory.next_rising(ephem.Sun(),
-                             use_center=True).datetime()
-    Observatory.horizon = '-12.0'
-    evening_nautical_twilight = Observatory.previous_setting(ephem.Sun(),
-                                use_center=True).datetime()
-    morning_nautical_twilight = Observatory.next_rising(ephem.Sun(),
-                                use_center=True).datetime()
-    Observatory.horizon = '-18.0'
-    evening_astronomical_twilight = Observatory.previous_setting(ephem.Sun(),
-                                    use_center=True).datetime()
-    morning_astronomical_twilight = Observatory.next_rising(ephem.Sun(),
-                                    use_center=True).datetime()
-
-    plot_start = sunset - tdelta(0, 1.5*60*60)
-    plot_end = sunrise + tdelta(0, 1800)
-
-    ##------------------------------------------------------------------------
-    ## Get weather, telescope status, and image data from database
-    ##------------------------------------------------------------------------
-    client = pymongo.MongoClient(tel.mongo_address, tel.mongo_port)
-    db = client[tel.mongo_db]
-    
-    l.info(f"Querying database for images")
-    query_dict = {'date': {'$gt':start, '$lt':end}, 'telescope':telescope }
-    images = query_mongo(db, 'images', query_dict)
-    l.info(f"  Found {len(images)} image entries")
-    
-    l.info(f"Querying database for {telescope}status")
-    query_dict = {'date': {'$gt':start, '$lt':end}}
-    status = query_mongo(db, f'{telescope}status', query_dict)
-    l.info(f"  Found {len(status)} status entries")
-
-    l.info(f"Querying database for weather")
-    weather = query_mongo(db, 'weather', query_dict)
-    l.info(f"  Found {len(weather)} weather entries")
-
-    if len(images) == 0 and len(status) == 0:
-        return
-
-    ##------------------------------------------------------------------------
-    ## Make Nightly Sumamry Plot (show only night time)
-    ##------------------------------------------------------------------------
-    time_ticks_values = np.arange(sunset.hour,sunrise.hour+1)
-    
-    if telescope == "V20":
-        plot_positions = [ ( [0.000, 0.755, 0.465, 0.245], [0.535, 0.760, 0.465, 0.240] ),
-                           ( [0.000, 0.550, 0.465, 0.180], [0.535, 0.570, 0.465, 0.160] ),
-                           ( [0.000, 0.490, 0.465, 0.050], [0.535, 0.315, 0.465, 0.240] ),
-                           ( [0.000, 0.210, 0.465, 0.250], [0.535, 0.000, 0.465, 0.265] ),
-                           ( [0.000, 0.000, 0.465, 0.200], None                         ) ]
-    elif telescope == "V5":
-        plot_positions = [ ( [0.000, 0.755, 0.465, 0.245], [0.535, 0.760, 0.465, 0.240] ),
-                           ( None                        , [0.535, 0.570, 0.465, 0.160] ),
-                           ( None                        , [0.535, 0.315, 0.465, 0.240] ),
-                           ( [0.000, 0.440, 0.465, 0.250], [0.535, 0.000, 0.465, 0.265] ),
-                           ( [0.000, 0.165, 0.465, 0.250], None                         ) ]
-
-
-    l.info("Writing Output File: {}".format(night_plot_file_name))
-    dpi=100
-    Figure = plt.figure(figsize=(13,9.5), dpi=dpi)
-
-    ##------------------------------------------------------------------------
-    ## Temperatures
-    ##------------------------------------------------------------------------
-    t = plt.axes(plot_positions[0][0])
-    plt.title(f"Temperatures for {telescope} on the Night of {date_string}")
-    l.info('Adding temperature plot')
-
-    l.debug('  Adding ambient temp to plot')
-    t.plot_date(weather['date'], weather['temp']*9/5+32, 'k-',
-                     markersize=2, markeredgewidth=0, drawstyle="default",
-                     label="Outside Temp")
-    l.debug('  Adding focuser temp to plot')
-
-    if telescope == 'V5':
-        t.plot_date(status['date'], status['focuser_temperature'], 'y-',
-                         markersize=2, markeredgewidth=0,
-                         label="Focuser Temp")
-    elif telescope == 'V20':
+    ##-------------------------------------------------------------------------
+    ## Fetch Data
+    ##-------------------------------------------------------------------------
+    def fetch(self):
+        '''Query the database for data not already loaded.  Status and weather
+        are fetched incrementally (only documents newer than the last ones
+        loaded).  Image results may be written out of order, so the night's
+        images (at most a few hundred) are fetched again each time.  Returns
+        the number of new documents.
+        '''
+        l = self.l
+        if self.db is None:
+            client = pymongo.MongoClient(self.tel.mongo_address, self.tel.mongo_port)
+            self.db = client[self.tel.mongo_db]
+        nnew = 0
+        l.info(f"Querying database for images")
+        query_dict = {'date': {'$gt':self.start, '$lt':self.end},
+                      'telescope':self.telescope }
+        images = query_mongo(self.db, 'images', query_dict)
+        nnew += len(images) - (len(self.images) if self.images is not None else 0)
+        self.images = images
+        l.info(f"  Found {len(self.images)} image entries")
+
+        for name, collection in [('status', f'{self.telescope}status'),
+                                 ('weather', 'weather')]:
+            l.info(f"Querying database for {collection}")
+            table = getattr(self, name)
+            since = self.start
+            if table is not None:
+                dates = np.array(table['date'])
+                dates = dates[~np.isnat(dates)]
+                if len(dates) > 0:
+                    since = dates.max().astype(dt)
+            query_dict = {'date': {'$gt':since, '$lt':self.end}}
+            new = query_mongo(self.db, collection, query_dict)
+            if table is None:
+                table = new
+            elif len(new) > 0:
+                table = vstack([table, new])
+            setattr(self, name, table)
+            nnew += len(new)
+            l.info(f"  Found {len(new)} new {collection} entries")
+        return nnew
+
+    ##-------------------------------------------------------------------------
+    ## Data for Each Line on the Plot
+    ##-------------------------------------------------------------------------
+    def series(self):
+        '''Return {name: (x, y)} for each of the lines on the plot.'''
+        l = self.l
+        images, status, weather = self.images, self.status, self.weather
+        s = {}
+        self.fit_labels = {}
+
+        ## Temperatures
+        s['outside_temp'] = (weather['date'], weather['temp']*9/5+32)
+        if self.telescope == 'V5':
+            s['focuser_temp'] = (status['date'], status['focuser_temperature'])
+        elif self.telescope == 'V20':
+            for name in ['focuser', 'primary', 'secondary', 'truss']:
+                s[f'{name}_temp'] = (status['date'],
+                                     status[f'{name}_temperature']*9/5+32)
+
+        ## Temperature differences and fan state (V20 only)
+        if self.telescope == 'V20':
+            for name in ['focuser', 'primary', 'secondary', 'truss']:
+                s[f'{name}_diff'] = (status['date'], np.full(len(status), np.nan))
+            ## Outside temperature at the time of each status entry, with both
+            ## time axes measured from the same origin
+            t0 = np.datetime64(self.start, 'us')
+            tw = (np.array(weather['date']) - t0)/np.timedelta64(1, 's')
+            temp = np.array(weather['temp'])
+            use = np.isfinite(tw) & np.isfinite(temp)
+            if np.any(use) and len(status) > 0:
+                ts = (np.array(status['date']) - t0)/np.timedelta64(1, 's')
+                outside = np.interp(ts, tw[use], temp[use])
+                for name in ['focuser', 'primary', 'secondary', 'truss']:
+                    diff = np.array(status[f'{name}_temperature']) - outside
+                    s[f'{name}_diff'] = (status['date'], 9/5*diff)
+            s['fan'] = (status['date'], status['fan_speed'])
+
+        ## Image quality
+        fwhm = np.array(images['FWHM_pix'])
+        if self.telescope == 'V20':
+            fwhm = fwhm * self.tel.pixel_scale.to(u.arcsec/u.pix).value
+        s['fwhm'] = (images['date'], fwhm)
+        s['ellipticity'] = (images['date'], images['ellipticity'])
+
+        ## Weather, colored by the weather limits
+        for name, column, label in [('clouds', 'clouds', 'Cloudiness (C)'),
+                                    ('rain', 'rain', 'Rain'),
+                                    ('wind', 'wind', 'Wind (kph)')]:
+            categories = limit_categories(weather[column], label)
+            for category, w in zip(['safe', 'warn', 'unsafe'], categories):
+                s[f'{name}_{category}'] = (weather['date'][w], weather[column][w])
+
+        ## Throughput vs. airmass
+        bands = []
+        if self.telescope == 'V20':
+            bands.append(('i', images[(images['filter'] == 'PSi') & (images['throughput'] > 0)]))
+            bands.append(('r', images[(images['filter'] == 'PSr') & (images['throughput'] > 0)]))
+        else:
+            bands.append(('r', images[images['throughput'] > 0]))
+        for band, band_images in bands:
+            airmass = np.array(band_images['airmass'])
+            zero_point = np.array(band_images['throughput'])
+            s[f'throughput_{band}'] = (airmass, zero_point)
+            s[f'fit_{band}'] = ([], [])
+            if len(band_images) > 1:
+                l.info(f'  Found {len(band_images)} {band}-band images')
+            if self.fit_airmass is True and len(band_images) > 1\
+               and (max(airmass)-min(airmass)) > 0.5:
+                l.info('  Fitting airmass term')
+                fitted_line = sigma_clipping_line_fit(airmass, zero_point, log=l)
+                mag_per_airmass = 2.512*np.log10(fitted_line(1)/fitted_line(0))
+                s[f'fit_{band}'] = (airmass, fitted_line(airmass))
+                self.fit_labels[band] = f"{band}-band Airmass Term: {mag_per_airmass:.3f} mag"
+                l.info(f'  {band}-band Airmass Term = {mag_per_airmass:.3f} mag per airmass')
+                l.info(f'  {band}-band Throughput at airmass = 0 is {fitted_line(0):.3f}')
+                l.info(f'  {band}-band Throughput at airmass = 1 is {fitted_line(1):.3f}')
+
+        ## Status and weather are logged far more often than there are pixels
+        ## across a panel, so keep only the extremes in each column of pixels
+        for name in s.keys():
+            if name in ['fwhm', 'ellipticity'] or name.startswith('throughput_')\
+               or name.startswith('fit_'):
+                continue
+            s[name] = decimate(*s[name], self.plot_start, self.plot_end,
+                               self.npixels)
+        return s
+
+    def add_line(self, axes, name, fmt, **kwargs):
+        x, y = self.data[name]
+        self.lines[name], = axes.plot(x, y, fmt, **kwargs)
+
+    def overplot_twilights(self):
+        tw = self.twilights
+        spans = [('sunset', 'evening_civil_twilight', 0.1),
+                 ('evening_civil_twilight', 'evening_nautical_twilight', 0.2),
+                 ('evening_nautical_twilight', 'evening_astronomical_twilight', 0.3),
+                 ('evening_astronomical_twilight', 'morning_astronomical_twilight', 0.5),
+                 ('morning_astronomical_twilight', 'morning_nautical_twilight', 0.3),
+                 ('morning_nautical_twilight', 'morning_civil_twilight', 0.2),
+                 ('morning_civil_twilight', 'sunrise', 0.1),
+                ]
+        for begin, end, alpha in spans:
+            plt.axvspan(tw[begin], tw[end], ymin=0, ymax=1, color='blue',
+                        alpha=alpha)
+
+    ##-------------------------------------------------------------------------
+    ## Build the Figure
+    ##-------------------------------------------------------------------------
+    def draw(self):
+        l = self.l
+        telescope = self.telescope
+        date_string = self.date_string
+        plot_start, plot_end = self.plot_start, self.plot_end
+        hours = HourLocator(byhour=range(24), interval=1)
+        hours_fmt = DateFormatter('%H')
+        self.data = self.series()
+
+        if telescope == "V20":
+            plot_positions = [ ( [0.000, 0.755, 0.465, 0.245], [0.535, 0.760, 0.465, 0.240] ),
+                               ( [0.000, 0.550, 0.465, 0.180], [0.535, 0.570, 0.465, 0.160] ),
+                               ( [0.000, 0.490, 0.465, 0.050], [0.535, 0.315, 0.465, 0.240] ),
+                               ( [0.000, 0.210, 0.465, 0.250], [0.535, 0.000, 0.465, 0.265] ),
+                               ( [0.000, 0.000, 0.465, 0.200], None                         ) ]
+        elif telescope == "V5":
+            plot_positions = [ ( [0.000, 0.755, 0.465, 0.245], [0.535, 0.760, 0.465, 0.240] ),
+                               ( None                        , [0.535, 0.570, 0.465, 0.160] ),
+                               ( None                        , [0.535, 0.315, 0.465, 0.240] ),
+                               ( [0.000, 0.440, 0.465, 0.250], [0.535, 0.000, 0.465, 0.265] ),
+                               ( [0.000, 0.165, 0.465, 0.250], None                         ) ]
+
+        self.figure = plt.figure(figsize=self.figsize, dpi=self.dpi)
+
+        ##------------------------------------------------------------------------
+        ## Temperatures
+        ##------------------------------------------------------------------------
+        t = plt.axes(plot_positions[0][0])
+        plt.title(f"Temperatures for {telescope} on the Night of {date_string}")
+        l.info('Adding temperature plot')
+
+        l.debug('  Adding ambient temp to plot')
+        self.add_line(t, 'outside_temp', 'k-',
+                      markersize=2, markeredgewidth=0, drawstyle="default",
+                      label="Outside Temp")
         l.debug('  Adding focuser temp to plot')
-        t.plot_date(status['date'], status['focuser_temperature']*9/5+32, 'y-',
-                         markersize=2, markeredgewidth=0,
-                         label="Focuser Temp")
-        l.debug('  Adding primary temp to plot')
-        t.plot_date(status['date'], status['primary_temperature']*9/5+32, 'r-',
-                         markersize=2, markeredgewidth=0,
-                         label="Primary Temp")
-        l.debug('  Adding secondary temp to plot')
-        t.plot_date(status['date'], status['secondary_temperature']*9/5+32, 'g-',
-                         markersize=2, markeredgewidth=0,
-                         label="Secondary Temp")
-        l.debug('  Adding truss temp to plot')
-        t.plot_date(status['date'], status['truss_temperature']*9/5+32, 'k-',
-                         alpha=0.5,
-                         markersize=2, markeredgewidth=0,
-                         label="Truss Temp")
-
-    plt.xlim(plot_start, plot_end)
-    plt.ylim(28,87)
-    t.xaxis.set_major_locator(hours)
-    t.xaxis.set_major_formatter(hours_fmt)
-
-    ## Overplot Twilights
-    plt.axvspan(sunset, evening_civil_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.1)
-    plt.axvspan(evening_civil_twilight, evening_nautical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(evening_nautical_twilight, evening_astronomical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(evening_astronomical_twilight, morning_astronomical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.5)
-    plt.axvspan(morning_astronomical_twilight, morning_nautical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(morning_nautical_twilight, morning_civil_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(morning_civil_twilight, sunrise,
-                ymin=0, ymax=1, color='blue', alpha=0.1)
-
-    plt.legend(loc='best', prop={'size':10})
-    plt.ylabel("Temperature (F)")
-    plt.grid(which='major', color='k')
-
-    ##------------------------------------------------------------------------
-    ## Temperature Differences (V20 Only)
-    ##------------------------------------------------------------------------
-    if telescope == "V20" :
-        l.info('Adding temperature difference plot')
-        d = plt.axes(plot_positions[1][0])
-
-        from scipy import interpolate
-        xw = [(x-weather['date'][0]).total_seconds() for x in weather['date']]
-        outside = interpolate.interp1d(xw, weather['temp'],
-                                       fill_value='extrapolate')
-        xs = [(x-status['date'][0]).total_seconds() for x in status['date']]
-
-        pdiff = status['primary_temperature'] - outside(xs)
-        d.plot_date(status['date'], 9/5*pdiff, 'r-',
-                         markersize=2, markeredgewidth=0,
-                         label="Primary")
-        sdiff = status['secondary_temperature'] - outside(xs)
-        d.plot_date(status['date'], 9/5*sdiff, 'g-',
-                         markersize=2, markeredgewidth=0,
-                         label="Secondary")
-        fdiff = status['focuser_temperature'] - outside(xs)
-        d.plot_date(status['date'], 9/5*fdiff, 'y-',
-                         markersize=2, markeredgewidth=0,
-                         label="Focuser")
-        tdiff = status['truss_temperature'] - outside(xs)
-        d.plot_date(status['date'], 9/5*tdiff, 'k-', alpha=0.5,
-                         markersize=2, markeredgewidth=0,
-                         label="Truss")
-        d.plot_date(status['date'], [0]*len(status), 'k-')
+        self.add_line(t, 'focuser_temp', 'y-',
+                      markersize=2, markeredgewidth=0,
+                      label="Focuser Temp")
+        if telescope == 'V20':
+            l.debug('  Adding primary temp to plot')
+            self.add_line(t, 'primary_temp', 'r-',
+                          markersize=2, markeredgewidth=0,
+                          label="Primary Temp")
+            l.debug('  Adding secondary temp to plot')
+            self.add_line(t, 'secondary_temp', 'g-',
+                          markersize=2, markeredgewidth=0,
+                          label="Secondary Temp")
+            l.debug('  Adding truss temp to plot')
+            self.add_line(t, 'truss_temp', 'k-',
+                          alpha=0.5,
+                          markersize=2, markeredgewidth=0,
+                          label="Truss Temp")
+
         plt.xlim(plot_start, plot_end)
-        plt.ylim(-7,17)
-        d.xaxis.set_major_locator(hours)
-        d.xaxis.set_major_formatter(hours_fmt)
-        d.xaxis.set_ticklabels([])
-        plt.ylabel("Difference (F)")
-        plt.grid(which='major', color='k')
-#         plt.legend(loc='best', prop={'size':10})
+        plt.ylim(28,87)
+        t.xaxis.set_major_locator(hours)
+        t.xaxis.set_major_formatter(hours_fmt)
+
+        ## Overplot Twilights
+        self.overplot_twilights()
 
+        plt.legend(loc='best', prop={'size':10})
+        plt.ylabel("Temperature (F)")
+        plt.grid(which='major', color='k')
 
-    ##------------------------------------------------------------------------
-    ## Fan State/Power (V20 Only)
-    ##------------------------------------------------------------------------
-    if telescope == "V20":
-        l.info('Adding fan state/power plot')
-        f = plt.axes(plot_positions[2][0])
-        f.plot_date(status['date'], status['fan_speed'], 'b-', \
-                             label="Mirror Fans")
+        ##------------------------------------------------------------------------
+        ## Temperature Differences (V20 Only)
+        ##------------------------------------------------------------------------
+        if telescope == "V20" :
+            l.info('Adding temperature difference plot')
+            d = plt.axes(plot_positions[1][0])
+            self.add_line(d, 'primary_diff', 'r-',
+                          markersize=2, markeredgewidth=0,
+                          label="Primary")
+            self.add_line(d, 'secondary_diff', 'g-',
+                          markersize=2, markeredgewidth=0,
+                          label="Secondary")
+            self.add_line(d, 'focuser_diff', 'y-',
+                          markersize=2, markeredgewidth=0,
+                          label="Focuser")
+            self.add_line(d, 'truss_diff', 'k-', alpha=0.5,
+                          markersize=2, markeredgewidth=0,
+                          label="Truss")
+            d.axhline(0, color='k')
+            plt.xlim(plot_start, plot_end)
+            plt.ylim(-7,17)
+            d.xaxis.set_major_locator(hours)
+            d.xaxis.set_major_formatter(hours_fmt)
+            d.xaxis.set_ticklabels([])
+            plt.ylabel("Difference (F)")
+            plt.grid(which='major', color='k')
+#             plt.legend(loc='best', prop={'size':10})
+
+        ##------------------------------------------------------------------------
+        ## Fan State/Power (V20 Only)
+        ##------------------------------------------------------------------------
+        if telescope == "V20":
+            l.info('Adding fan state/power plot')
+            f = plt.axes(plot_positions[2][0])
+            self.add_line(f, 'fan', 'b-', label="Mirror Fans")
+            plt.xlim(plot_start, plot_end)
+            plt.ylim(-10,110)
+            f.xaxis.set_major_locator(hours)
+            f.xaxis.set_major_formatter(hours_fmt)
+            f.xaxis.set_ticklabels([])
+            plt.yticks(np.linspace(0,100,3,endpoint=True))
+            plt.ylabel('Fan (%)')
+            plt.grid(which='major', color='k')
+
+        ##------------------------------------------------------------------------
+        ## FWHM
+        ##------------------------------------------------------------------------
+        l.info('Adding FWHM plot')
+        f = plt.axes(plot_positions[3][0])
+        plt.title(f"Image Quality for {telescope} on the Night of {date_string}")
+        self.add_line(f, 'fwhm', 'ko',
+                      markersize=3, markeredgewidth=0,
+                      label="FWHM")
         plt.xlim(plot_start, plot_end)
-        plt.ylim(-10,110)
+        if telescope == 'V20':
+            plt.ylabel(f"FWHM (arcsec)")
+        elif telescope == 'V5':
+            plt.ylabel(f"FWHM (pix)")
+        plt.ylim(0,8)
         f.xaxis.set_major_locator(hours)
         f.xaxis.set_major_formatter(hours_fmt)
         f.xaxis.set_ticklabels([])
-        plt.yticks(np.linspace(0,100,3,endpoint=True))
-        plt.ylabel('Fan (%)')
         plt.grid(which='major', color='k')
 
-    ##------------------------------------------------------------------------
-    ## FWHM
-    ##------------------------------------------------------------------------
-    l.info('Adding FWHM plot')
-    f = plt.axes(plot_positions[3][0])
-    plt.title(f"Image Quality for {telescope} on the Night of {date_string}")
-
-    fwhm = images['FWHM_pix']
-    if telescope == 'V20':
-        fwhm *= u.pix * tel.pixel_scale
-    f.plot_date(images['date'], fwhm, 'ko',
-                     markersize=3, markeredgewidth=0,
-                     label="FWHM")
-    plt.xlim(plot_start, plot_end)
-    if telescope == 'V20':
-        plt.ylabel(f"FWHM (arcsec)")
-    elif telescope == 'V5':
-        plt.ylabel(f"FWHM (pix)")
-    plt.ylim(0,8)
-    f.xaxis.set_major_locator(hours)
-    f.xaxis.set_major_formatter(hours_fmt)
-    f.xaxis.set_ticklabels([])
-    plt.grid(which='major', color='k')
-
-    ##------------------------------------------------------------------------
-    ## ellipticity
-    ##------------------------------------------------------------------------
-    l.info('Adding ellipticity plot')
-    e = plt.axes(plot_positions[4][0])
-    e.plot_date(images['date'], images['ellipticity'], 'ko',
-                     markersize=3, markeredgewidth=0,
-                     label="ellipticity")
-    plt.xlim(plot_start, plot_end)
-    plt.ylim(0.95,1.75)
-    e.xaxis.set_major_locator(hours)
-    e.xaxis.set_major_formatter(hours_fmt)
-    plt.ylabel(f"ellipticity")
-    plt.grid(which='major', color='k')
-    plt.xlabel(f"UT Time")
-
-    ##------------------------------------------------------------------------
-    ## Cloudiness
-    ##------------------------------------------------------------------------
-    l.info('Adding cloudiness plot')
-    c = plt.axes(plot_positions[0][1])
-    plt.title(f"Cloudiness")
-    l.debug('  Adding sky temp to plot')
-
-    wsafe = np.where(weather['clouds'] < weather_limits['Cloudiness (C)'][0])[0]
-    wwarn = np.where(np.array(weather['clouds'] >= weather_limits['Cloudiness (C)'][0])\
-                     & np.array(weather['clouds'] < weather_limits['Cloudiness (C)'][1]) )[0]
-    wunsafe = np.where(weather['clouds'] >= weather_limits['Cloudiness (C)'][1])[0]
-    if len(wsafe) > 0:
-        c.plot_date(weather['date'][wsafe], weather['clouds'][wsafe], 'go',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wwarn) > 0:
-        c.plot_date(weather['date'][wwarn], weather['clouds'][wwarn], 'yo',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wunsafe) > 0:
-        c.plot_date(weather['date'][wunsafe], weather['clouds'][wunsafe], 'ro',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-
-    plt.xlim(plot_start, plot_end)
-    plt.ylim(-55,15)
-    c.xaxis.set_major_locator(hours)
-    c.xaxis.set_major_formatter(hours_fmt)
-
-    ## Overplot Twilights
-    plt.axvspan(sunset, evening_civil_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.1)
-    plt.axvspan(evening_civil_twilight, evening_nautical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(evening_nautical_twilight, evening_astronomical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(evening_astronomical_twilight, morning_astronomical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.5)
-    plt.axvspan(morning_astronomical_twilight, morning_nautical_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(morning_nautical_twilight, morning_civil_twilight,
-                ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(morning_civil_twilight, sunrise,
-                ymin=0, ymax=1, color='blue', alpha=0.1)
-
-    plt.ylabel("Cloudiness (C)")
-    plt.grid(which='major', color='k')
-
-    ## Overplot Moon Up Time
-    TheMoon = ephem.Moon()
-    moon_alts = []
-    moon_phases = []
-    moon_time_list = []
-    moon_time = plot_start
-    while moon_time <= plot_end:
-        Observatory.date = moon_time
-        TheMoon.compute(Observatory)
-        moon_time_list.append(moon_time)
-        moon_alts.append(TheMoon.alt * 180. / ephem.pi)
-        moon_phases.append(TheMoon.phase)
-        moon_time += tdelta(0, 60*5)
-    moon_phase = max(moon_phases)
-    moon_fill = moon_phase/100.*0.4+0.05
-
-    mc_axes = c.twinx()
-    mc_axes.set_ylabel('Moon Alt (%.0f%% full)' % moon_phase, color='y')
-    mc_axes.plot_date(moon_time_list, moon_alts, 'y-')
-    mc_axes.xaxis.set_major_locator(hours)
-    mc_axes.xaxis.set_major_formatter(hours_fmt)
-    plt.ylim(0,100)
-    plt.yticks([10,30,50,70,90], color='y')
-    plt.xlim(plot_start, plot_end)
-    plt.fill_between(moon_time_list, 0, moon_alts, where=np.array(moon_alts)>0,
-                     color='yellow', alpha=moon_fill)        
-    plt.ylabel('')
-
-    ##------------------------------------------------------------------------
-    ## Humidity, Wetness, Rain
-    ##------------------------------------------------------------------------
-    l.info('Adding rain plot')
-    r = plt.axes(plot_positions[1][1])
-
-    wsafe = np.where(weather['rain'] > weather_limits['Rain'][0])[0]
-    wwarn = np.where(np.array(weather['rain'] <= weather_limits['Rain'][0])\
-                     & np.array(weather['rain'] > weather_limits['Rain'][1]) )[0]
-    wunsafe = np.where(weather['rain'] <= weather_limits['Rain'][1])[0]
-    if len(wsafe) > 0:
-        r.plot_date(weather['date'][wsafe], weather['rain'][wsafe], 'go',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wwarn) > 0:
-        r.plot_date(weather['date'][wwarn], weather['rain'][wwarn], 'yo',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wunsafe) > 0:
-        r.plot_date(weather['date'][wunsafe], weather['rain'][wunsafe], 'ro',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-
-    plt.xlim(plot_start, plot_end)
-    plt.ylim(-100,3000)
-    r.xaxis.set_major_locator(hours)
-    r.xaxis.set_major_formatter(hours_fmt)
-    r.xaxis.set_ticklabels([])
-    plt.ylabel("Rain")
-    plt.grid(which='major', color='k')
-
-    ##------------------------------------------------------------------------
-    ## Wind Speed
-    ##------------------------------------------------------------------------
-    l.info('Adding wind speed plot')
-    w = plt.axes(plot_positions[2][1])
-
-    wsafe = np.where(weather['wind'] < weather_limits['Wind (kph)'][0])[0]
-    wwarn = np.where(np.array(weather['wind'] >= weather_limits['Wind (kph)'][0])\
-                     & np.array(weather['wind'] < weather_limits['Wind (kph)'][1]) )[0]
-    wunsafe = np.where(weather['wind'] >= weather_limits['Wind (kph)'][1])[0]
-    if len(wsafe) > 0:
-        w.plot_date(weather['date'][wsafe], weather['wind'][wsafe], 'go',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wwarn) > 0:
-        w.plot_date(weather['date'][wwarn], weather['wind'][wwarn], 'yo',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    if len(wunsafe) > 0:
-        w.plot_date(weather['date'][wunsafe], weather['wind'][wunsafe], 'ro',
-                         markersize=2, markeredgewidth=0,
-                         drawstyle="default")
-    windlim_data = list(weather['wind']*1.1)
-    windlim_data.append(65) # minimum limit on plot is 65
-
-    plt.xlim(plot_start, plot_end)
-    plt.ylim(-2,max(windlim_data))
-    w.xaxis.set_major_locator(hours)
-    w.xaxis.set_major_formatter(hours_fmt)
-#     w.xaxis.set_ticklabels([])
-    plt.ylabel("Wind (kph)")
-    plt.grid(which='major', color='k')
-    plt.xlabel(f"UT Time")
-
-    ##------------------------------------------------------------------------
-    ## Extinction vs. Airmass
-    ##------------------------------------------------------------------------
-    l.info('Adding throughput vs. airmass plot')
-    zp = plt.axes(plot_positions[3][1])
-
-    if telescope == 'V20':
-        images_i = images[(images['filter'] == 'PSi') & (images['throughput'] > 0)]
-        if len(images_i) > 1:
-            l.info(f'  Found {len(images_i)} i-band images')
-            airmass = [x['airmass'] for x in images_i if x['throughput'] > 0]
-            zero_point = [x['throughput'] for x in images_i if x['throughput'] > 0]
-            zp.plot(airmass, zero_point, 'ko',
-                    markersize=3, markeredgewidth=0,
-                    label="i-band Throughput")
-            if fit_airmass is True and (max(airmass)-min(airmass)) > 0.5:
-                l.info('  Fitting airmass term')
-                fitted_line = sigma_clipping_line_fit(np.array(airmass),
-                                                      np.array(zero_point), log=l)
-                mag_per_airmass = 2.512*np.log10(fitted_line(1)/fitted_line(0))
-                zp.plot(airmass, fitted_line(airmass), 'k-', alpha=0.2,
-                        label=f"i-band Airmass Term: {mag_per_airmass:.3f} mag")
-                l.info(f'  i-band Airmass Term = {mag_per_airmass:.3f} mag per airmass')
-                l.info(f'  i-band Throughput at airmass = 0 is {fitted_line(0):.3f}')
-                l.info(f'  i-band Throughput at airmass = 1 is {fitted_line(1):.3f}')
-
-    if telescope == 'V20':
-        images_r = images[(images['filter'] == 'PSr') & (images['throughput'] > 0)]
-    else:
-        images_r = images[images['throughput'] > 0]
-    if len(images_r) > 1:
-        l.info(f'  Found {len(images_r)} r-band images')
-        airmass = [x['airmass'] for x in images_r if x['throughput'] > 0]
-        zero_point = [x['throughput'] for x in images_r if x['throughput'] > 0]
-        zp.plot(airmass, zero_point, 'ro',
-                markersize=3, markeredgewidth=0,
-                label="r-band Throughput")
-        if fit_airmass is True and (max(airmass)-min(airmass)) > 0.5:
-            l.info('  Fitting airmass term')
-            fitted_line = sigma_clipping_line_fit(np.array(airmass),
-                                                  np.array(zero_point), log=l)
-            mag_per_airmass = 2.512*np.log10(fitted_line(1)/fitted_line(0))
-            zp.plot(airmass, fitted_line(airmass), 'k-', alpha=0.2,
-                    label=f"r-band Airmass Term: {mag_per_airmass:.3f} mag")
-            l.info(f'  r-band Airmass Term = {mag_per_airmass:.3f} mag per airmass')
-            l.info(f'  r-band Throughput at airmass = 0 is {fitted_line(0):.3f}')
-            l.info(f'  r-band Throughput at airmass = 1 is {fitted_line(1):.3f}')
-
-    plt.xlim(0.95, 2.05)
-    try:
-        ymax = 1.1*max(images[images['throughput'] > 0]['throughput'])
-    except:
-        ymax = 0.13
-    plt.ylim(0,ymax)
-    plt.xlabel(f"Airmass")
-    plt.ylabel(f"Throughput")
-    if telescope == 'V20':
-        plt.legend(loc='best', fontsize=10)
-    plt.grid(color='k')
-
-    ##------------------------------------------------------------------------
-    ## Save Figure
-    ##------------------------------------------------------------------------
-    l.info('Saving figure: {}'.format(night_plot_file))
-    plt.savefig(night_plot_file, dpi=dpi, bbox_inches='tight', pad_inches=0.10)
-    l.info('Done.')
-
-
-def loop_over_nights():
-    date = dt(2018, 1, 1, 1, 0, 0, 0)
-    end = dt(2018, 12, 31, 2, 0, 0, 0)
+        ##------------------------------------------------------------------------
+        ## ellipticity
+        ##------------------------------------------------------------------------
+        l.info('Adding ellipticity plot')
+        e = plt.axes(plot_positions[4][0])
+        self.add_line(e, 'ellipticity', 'ko',
+                      markersize=3, markeredgewidth=0,
+                      label="ellipticity")
+        plt.xlim(plot_start, plot_end)
+        plt.ylim(0.95,1.75)
+        e.xaxis.set_major_locator(hours)
+        e.xaxis.set_major_formatter(hours_fmt)
+        plt.ylabel(f"ellipticity")
+        plt.grid(which='major', color='k')
+        plt.xlabel(f"UT Time")
+
+        ##------------------------------------------------------------------------
+        ## Cloudiness
+        ##------------------------------------------------------------------------
+        l.info('Adding cloudiness plot')
+        c = plt.axes(plot_positions[0][1])
+        plt.title(f"Cloudiness")
+        l.debug('  Adding sky temp to plot')
+        for category, color in [('safe', 'g'), ('warn', 'y'), ('unsafe', 'r')]:
+            self.add_line(c, f'clouds_{category}', f'{color}o',
+                          markersize=2, markeredgewidth=0,
+                          drawstyle="default")
+
+        plt.xlim(plot_start, plot_end)
+        plt.ylim(-55,15)
+        c.xaxis.set_major_locator(hours)
+        c.xaxis.set_major_formatter(hours_fmt)
+
+        ## Overplot Twilights
+        self.overplot_twilights()
+
+        plt.ylabel("Cloudiness (C)")
+        plt.grid(which='major', color='k')
+
+        ## Overplot Moon Up Time
+        moon_times, moon_alts = self.ephem_table.series('moon_alt', plot_start, plot_end)
+        moon_times, moon_phases = self.ephem_table.series('moon_phase', plot_start, plot_end)
+        moon_phase = max(moon_phases)
+        moon_fill = moon_phase/100.*0.4+0.05
+
+        mc_axes = c.twinx()
+        mc_axes.set_ylabel('Moon Alt (%.0f%% full)' % moon_phase, color='y')
+        mc_axes.plot(moon_times, moon_alts, 'y-')
+        mc_axes.xaxis.set_major_locator(hours)
+        mc_axes.xaxis.set_major_formatter(hours_fmt)
+        plt.ylim(0,100)
+        plt.yticks([10,30,50,70,90], color='y')
+        plt.xlim(plot_start, plot_end)
+        plt.fill_between(moon_times, 0, moon_alts, where=moon_alts>0,
+                         color='yellow', alpha=moon_fill)
+        plt.ylabel('')
+
+        ##------------------------------------------------------------------------
+        ## Humidity, Wetness, Rain
+        ##------------------------------------------------------------------------
+        l.info('Adding rain plot')
+        r = plt.axes(plot_positions[1][1])
+        for category, color in [('safe', 'g'), ('warn', 'y'), ('unsafe', 'r')]:
+            self.add_line(r, f'rain_{category}', f'{color}o',
+                          markersize=2, markeredgewidth=0,
+                          drawstyle="default")
+
+        plt.xlim(plot_start, plot_end)
+        plt.ylim(-100,3000)
+        r.xaxis.set_major_locator(hours)
+        r.xaxis.set_major_formatter(hours_fmt)
+        r.xaxis.set_ticklabels([])
+        plt.ylabel("Rain")
+        plt.grid(which='major', color='k')
+
+        ##------------------------------------------------------------------------
+        ## Wind Speed
+        ##------------------------------------------------------------------------
+        l.info('Adding wind speed plot')
+        w = plt.axes(plot_positions[2][1])
+        self.axes['wind'] = w
+        for category, color in [('safe', 'g'), ('warn', 'y'), ('unsafe', 'r')]:
+            self.add_line(w, f'wind_{category}', f'{color}o',
+                          markersize=2, markeredgewidth=0,
+                          drawstyle="default")
+
+        plt.xlim(plot_start, plot_end)
+        w.xaxis.set_major_locator(hours)
+        w.xaxis.set_major_formatter(hours_fmt)
+#         w.xaxis.set_ticklabels([])
+        plt.ylabel("Wind (kph)")
+        plt.grid(which='major', color='k')
+        plt.xlabel(f"UT Time")
+
+        ##------------------------------------------------------------------------
+        ## Extinction vs. Airmass
+        ##------------------------------------------------------------------------
+        l.info('Adding throughput vs. airmass plot')
+        zp = plt.axes(plot_positions[3][1])
+        self.axes['throughput'] = zp
+        if telescope == 'V20':
+            self.add_line(zp, 'throughput_i', 'ko',
+                          markersize=3, markeredgewidth=0,
+                          label="i-band Throughput")
+            self.add_line(zp, 'fit_i', 'k-', alpha=0.2)
+        self.add_line(zp, 'throughput_r', 'ro',
+                      markersize=3, markeredgewidth=0,
+                      label="r-band Throughput")
+        self.add_line(zp, 'fit_r', 'k-', alpha=0.2)
+
+        plt.xlim(0.95, 2.05)
+        plt.xlabel(f"Airmass")
+        plt.ylabel(f"Throughput")
+        plt.grid(color='k')
+        self.set_limits()
+
+    def set_limits(self):
+        '''Set the axis limits and legends which depend on the data.'''
+        windlim_data = list(self.weather['wind']*1.1)
+        windlim_data.append(65) # minimum limit on plot is 65
+        self.axes['wind'].set_ylim(-2,max(windlim_data))
+
+        zp = self.axes['throughput']
+        images = self.images
+        try:
+            ymax = 1.1*max(images[images['throughput'] > 0]['throughput'])
+        except:
+            ymax = 0.13
+        zp.set_ylim(0,ymax)
+        for band in ['i', 'r']:
+            if f'throughput_{band}' not in self.lines:
+                continue
+            if len(self.data[f'throughput_{band}'][0]) < 2:
+                self.lines[f'throughput_{band}'].set_label(f'_{band}-band Throughput')
+            else:
+                self.lines[f'throughput_{band}'].set_label(f'{band}-band Throughput')
+            self.lines[f'fit_{band}'].set_label(self.fit_labels.get(band, '_nolegend_'))
+        if self.telescope == 'V20':
+            zp.legend(loc='best', fontsize=10)
 
     ##-------------------------------------------------------------------------
-    ## Create Logger Object
+    ## Update and Save
     ##-------------------------------------------------------------------------
+    def update(self):
+        '''Recompute the data for each line and update the artists in place.'''
+        self.data = self.series()
+        for name, line in self.lines.items():
+            line.set_data(*self.data[name])
+        self.set_limits()
+
+    def save(self):
+        self.l.info('Saving figure: {}'.format(self.night_plot_file))
+        self.figure.savefig(self.night_plot_file, dpi=self.dpi,
+                            bbox_inches='tight', pad_inches=0.10)
+        self.l.info('Done.')
+
+    def refresh(self):
+        '''Fetch new data and, if there is any, update and save the figure.
+        Returns the number of new documents.
+        '''
+        nnew = self.fetch()
+        if nnew > 0:
+            self.render()
+        return nnew
+
+    def render(self):
+        '''Draw (or update) and save the figure for the data loaded.  Returns
+        False if there is nothing to plot.
+        '''
+        if len(self.images) == 0 and len(self.status) == 0:
+            return False
+        if self.figure is None:
+            self.draw()
+        else:
+            self.update()
+        self.save()
+        return True
+
+    def close(self):
+        if self.figure is not None:
+            plt.close(self.figure)
+            self.figure = None
+
+
+def make_plots(date_string, telescope, l, fit_airmass=False):
+    l.info(f"Making Nightly Plots for {telescope} on {date_string}")
+    night = NightPlot(date_string, telescope, l, fit_airmass=fit_airmass)
+    night.refresh()
+    night.close()
+
+
+def live_plots(telescopes, l, fit_airmass=False, interval=60):
+    '''Keep tonight's plots up to date, refreshing them every interval
+    seconds.
+    '''
+    nights = {}
+    while True:
+        tick = dt.utcnow()
+        date_string = tick.strftime('%Y%m%dUT')
+        for telescope in telescopes:
+            night = nights.get(telescope, None)
+            if night is None or night.date_string != date_string:
+                if night is not None:
+                    night.close()
+                l.info(f"Making Nightly Plots for {telescope} on {date_string}")
+                night = NightPlot(date_string, telescope, l, fit_airmass=fit_airmass)
+                nights[telescope] = night
+            nnew = night.refresh()
+            l.info(f"Refreshed {telescope} plot with {nnew} new documents")
+        elapsed = (dt.utcnow() - tick).total_seconds()
+        l.info(f"Refreshed plots in {elapsed:.1f} s")
+        time.sleep(max(0, interval - elapsed))
+
+
+##-----------------------------------------------------------------------------
+## Render Many Nights in Parallel
+##-----------------------------------------------------------------------------
+## Change this when the plot changes, so that existing plots are redrawn
+plot_version = 3
+
+
+def fingerprint_file(night_plot_file):
+    return os.path.splitext(night_plot_file)[0] + '.fingerprint'
+
+
+def night_fingerprint(telescope, fit_airmass, tables):
+    '''Hash of everything which goes in to a night's plot.'''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{plot_version} {telescope} {fit_airmass}'.encode())
+    for table in tables:
+        for name in table.colnames:
+            h.update(name.encode())
+            h.update(np.ascontiguousarray(table[name]).tobytes())
+    return h.hexdigest()
+
+
+def unchanged(night_plot_file, fingerprint):
+    '''True if the plot exists and was made from data with this fingerprint.
+    '''
+    if not os.path.exists(night_plot_file):
+        return False
+    try:
+        with open(fingerprint_file(night_plot_file)) as FO:
+            return FO.read().strip() == fingerprint
+    except OSError:
+        return False
+
+
+def night_slice(table, start, end):
+    '''Rows of table (sorted by date) with start < date < end.'''
+    dates = np.array(table['date'])
+    i0 = np.searchsorted(dates, np.datetime64(start), side='right')
+    i1 = np.searchsorted(dates, np.datetime64(end), side='left')
+    return table[i0:i1]
+
+
+def render_night(date_string, telescope, images, status, weather, fingerprint,
+                 fit_airmass=False, destination_path='/var/www/nights/'):
+    '''Make one night's plot from prefetched data (runs in a worker process)
+    and record the fingerprint of the data next to it.
+    '''
     l = logging.getLogger('make_nightly_plots')
-    l.setLevel(logging.DEBUG)
-    ## Set up console output
-    LogConsoleHandler = logging.StreamHandler()
-    LogConsoleHandler.setLevel(logging.INFO)
-    LogFormat = logging.Formatter('%(asctime)23s %(levelname)8s: %(message)s')
-    LogConsoleHandler.setFormatter(LogFormat)
-    l.addHandler(LogConsoleHandler)
+    night = NightPlot(date_string, telescope, l, fit_airmass=fit_airmass,
+                      destination_path=destination_path)
+    night.images, night.status, night.weather = images, status, weather
+    made = night.render()
+    night.close()
+    if made:
+        with open(fingerprint_file(night.night_plot_file), 'w') as FO:
+            FO.write(fingerprint)
+    return date_string, telescope, made
+
+
+def batch_nights(start, end, telescopes, l, jobs=4, fit_airmass=False,
+                 force=False, chunk_days=31, destination_path='/var/www/nights/'):
+    '''Make the plots for each night from start to end (inclusive, both
+    YYYYMMDDUT strings) for each telescope, in a pool of jobs processes.
+
+    Data are fetched with one range query per collection for each chunk of
+    chunk_days nights and split in to nights here, so the workers do not
+    query the database.  Nights whose data have not changed since their plot
+    was made are skipped unless force is True.
+    '''
+    first = dt.strptime(start, '%Y%m%dUT')
+    last = dt.strptime(end, '%Y%m%dUT')
+    tel = Telescope(telescopes[0])
+    client = pymongo.MongoClient(tel.mongo_address, tel.mongo_port)
+    db = client[tel.mongo_db]
 
-    while date < end:
-        make_plots(date.strftime('%Y%m%dUT'), 'V20', l)
-        date += tdelta(1,0)
+    nmade = 0
+    nskipped = 0
+    previous = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        chunk_start = first
+        while chunk_start <= last:
+            chunk_end = min(chunk_start + tdelta(chunk_days), last + tdelta(1))
+            l.info(f"Fetching data for {chunk_start.strftime('%Y%m%dUT')} to "
+                   f"{(chunk_end-tdelta(1)).strftime('%Y%m%dUT')}")
+            query_dict = {'date': {'$gt':chunk_start, '$lt':chunk_end}}
+            weather = query_mongo(db, 'weather', query_dict)
+            query_dict['telescope'] = {'$in': telescopes}
+            images = query_mongo(db, 'images', query_dict)
+            del query_dict['telescope']
+            status = {telescope: query_mongo(db, f'{telescope}status', query_dict)
+                      for telescope in telescopes}
+
+            submitted = []
+            night = chunk_start
+            while night < chunk_end:
+                date_string = night.strftime('%Y%m%dUT')
+                night_weather = night_slice(weather, night, night + tdelta(1))
+                night_images = night_slice(images, night, night + tdelta(1))
+                for telescope in telescopes:
+                    night_status = night_slice(status[telescope], night, night + tdelta(1))
+                    tel_images = night_images[night_images['telescope'] == telescope]
+                    if len(tel_images) == 0 and len(night_status) == 0:
+                        continue
+                    fingerprint = night_fingerprint(telescope, fit_airmass,
+                                      [tel_images, night_status, night_weather])
+                    night_plot_file = os.path.join(os.path.abspath(destination_path),
+                                                   f'{date_string}_{telescope}.png')
+                    if force is False and unchanged(night_plot_file, fingerprint):
+                        nskipped += 1
+                        continue
+                    submitted.append(pool.submit(render_night, date_string,
+                                     telescope, tel_images, night_status,
+                                     night_weather, fingerprint,
+                                     fit_airmass=fit_airmass,
+                                     destination_path=destination_path))
+                night += tdelta(1)
+
+            ## Render this chunk while the next one is fetched, but hold no
+            ## more than two chunks of data at once
+            for future in previous:
+                try:
+                    date_string, telescope, made = future.result()
+                    nmade += int(made)
+                except Exception as e:
+                    l.error(f"Failed to make plot: {e}")
+            previous = submitted
+            chunk_start = chunk_end
+        for future in previous:
+            try:
+                date_string, telescope, made = future.result()
+                nmade += int(made)
+            except Exception as e:
+                l.error(f"Failed to make plot: {e}")
+    l.info(f"Made {nmade} plots, skipped {nskipped} unchanged nights")
 
 
 def main():
@@ -601,17 +892,32 @@ def main():
         default=False, help="Be quiet! (No logs < WARNING))")
     parser.add_argument("-l", "--loop",
         action="store_true", dest="loop",
-        default=False, help="Make plots in continuous loop")
+        default=False, help="Keep tonight's plot up to date in a continuous loop")
     parser.add_argument("-a", "--airmass",
         action="store_true", dest="airmass",
         default=False, help="Fit airmass term")
+    parser.add_argument("-f", "--force",
+        action="store_true", dest="force",
+        default=False, help="Remake plots in a date range even if their data are unchanged")
     ## add arguments
+    parser.add_argument("--interval", dest="interval",
+        required=False, type=float, default=60,
+        help="Seconds between refreshes in loop mode (default = 60)")
     parser.add_argument("-t", dest="telescope",
-        required=False, type=str, default='V5',
-        help="Telescope which took the data ('V5' or 'V20')")
+        required=False, type=str, nargs='+', default=['V5'],
+        help="Telescope(s) which took the data ('V5' and/or 'V20')")
     parser.add_argument("-d", dest="date",
         required=False, type=str,
         help="Date of night to plot")
+    parser.add_argument("--start", dest="start",
+        required=False, type=str, default=None,
+        help="First night of a range to plot (YYYYMMDDUT)")
+    parser.add_argument("--end", dest="end",
+        required=False, type=str, default=None,
+        help="Last night of a range to plot (YYYYMMDDUT, default = today)")
+    parser.add_argument("-j", "--jobs", dest="jobs",
+        required=False, type=int, default=4,
+        help="Number of nights to plot at once for a date range (default = 4)")
     args = parser.parse_args()
 
     if args.date is None:
@@ -643,7 +949,17 @@ def main():
 #     LogFileHandler.setFormatter(LogFormat)
 #     l.addHandler(LogFileHandler)
 
-    make_plots(args.date, args.telescope, l, fit_airmass=args.airmass)
+    if args.loop is True:
+        live_plots(args.telescope, l, fit_airmass=args.airmass,
+                   interval=args.interval)
+    elif args.start is not None:
+        if args.end is None:
+            args.end = dt.utcnow().strftime("%Y%m%dUT")
+        batch_nights(args.start, args.end, args.telescope, l, jobs=args.jobs,
+                     fit_airmass=args.airmass, force=args.force)
+    else:
+        for telescope in args.telescope:
+            make_plots(args.date, telescope, l, fit_airmass=args.airmass)
 
 #     if args.loop is True:
 #         while True:
@@ -1,6 +1,7 @@
 import sys
 import os
 from argparse import ArgumentParser
+import time
 import datetime
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
@@ -15,13 +16,14 @@ from matplotlib.dates import HourLocator, MinuteLocator, DateFormatter
 
 import pymongo
 from VYSOS import weather_limits
+from VYSOS.ephemeris import find_crossings
+from VYSOS.timeseries import decimate_indices, RollingBuffer
 
 import astropy.units as u
 from astropy.table import Table, Column
 from astropy.time import Time
 from astropy import coordinates as c
 
-from scipy.signal import argrelmin
 
 import warnings
 from astropy.utils.exceptions import AstropyDeprecationWarning
@@ -50,67 +52,34 @@ def get_twilights(start, end, nsample=256):
         lon=-155.57608,
         height=3400,
     )
-#     delta = (end-start).total_seconds()
-#     time_grid = Time(start) + np.linspace(0, delta, nsample)*u.second
-#     sun = c.get_sun(time_grid[:, None])
-#     altaz_frame = c.AltAz(location=location[None], 
-#                               obstime=time_grid[:,None])
-#     sun_altaz = sun.transform_to(altaz_frame)
-# 
-#     min_idx = np.array([argrelmin(a**2, axis=0, mode='wrap')[0] 
-#                         for a in sun_altaz.alt.degree.T])
-# 
-#     # Now, figure out which of the two sun altitude minima is sunset
-#     # by computing the derivative of altitude w.r.t. time:
-#     sunset_idx = []
-#     good_i = []
-#     for i, idx in enumerate(min_idx):
-#         alt = sun_altaz.alt.degree
-#         try:
-#             sunset_idx.append(idx[np.array([alt[min(j+1, len(alt)-1), i] - alt[max(j-1, 0), i] 
-#                                             for j in idx]) < 0][0])
-#             good_i.append(i)
-#         except IndexError:
-#             continue
-#     
-#     sunset_idx = np.array(sunset_idx)
-#     good_i = np.array(good_i)
-#     
-#     # Convert the UTC sunset time estimates to local times. Here we 
-#     # assume that the time sampling is dense enough that the time of 
-#     # min(alt**2) is close enough to the actual sunset:
-#     sun_time = sun_altaz.obstime.datetime
-#     sunsets = np.array([utc.localize(sun_time[j,i]).astimezone(tzs[i])
-#                         for i, j in zip(good_i, sunset_idx)])
-#     
-#     print(good_i, sunsets)
-
-
-
-
-    from astroplan import Observer
-    obs = Observer(location=location, name='VYSOS',
-                   timezone='US/Hawaii')
-
-    sunset = obs.sun_set_time(Time(start), which='next').datetime
-    sunrise = obs.sun_rise_time(Time(start), which='next').datetime
+    ## Compute the Sun's altitude on a single time grid (one transform) which
+    ## covers at least a day after start, then find when it crosses each
+    ## level by interpolating between the samples which bracket the crossing.
+    ## Like astroplan's defaults, this is for the Sun's center and without
+    ## refraction.
+    span = max((end-start).total_seconds(), 24*60*60) + 60*60
+    seconds = np.linspace(0, span, int(nsample*span/(24*60*60)))
+    time_grid = Time(start) + seconds*u.second
+    altaz_frame = c.AltAz(location=location, obstime=time_grid)
+    sun_alt = c.get_sun(time_grid).transform_to(altaz_frame).alt.degree
+
+    def next_crossing(level, direction):
+        rising, setting = find_crossings(seconds, sun_alt, level)
+        crossings = {'rise': rising, 'set': setting}[direction]
+        if len(crossings) == 0:
+            raise ValueError(f'Sun does not {direction} through {level} deg')
+        return start + tdelta(0, float(crossings[0]))
 
     # Calculate and order twilights and set plotting alpha for each
     twilights = [(start, 'start', 0.0),
-                 (sunset, 'sunset', 0.0),
-                 (obs.twilight_evening_civil(Time(start),
-                                             which='next').datetime, 'ec', 0.1),
-                 (obs.twilight_evening_nautical(Time(start),
-                                                which='next').datetime, 'en', 0.2),
-                 (obs.twilight_evening_astronomical(Time(start),
-                                                    which='next').datetime, 'ea', 0.3),
-                 (obs.twilight_morning_astronomical(Time(start),
-                                                    which='next').datetime, 'ma', 0.5),
-                 (obs.twilight_morning_nautical(Time(start),
-                                                which='next').datetime, 'mn', 0.3),
-                 (obs.twilight_morning_civil(Time(start),
-                                             which='next').datetime, 'mc', 0.2),
-                 (sunrise, 'sunrise', 0.1),
+                 (next_crossing(0, 'set'), 'sunset', 0.0),
+                 (next_crossing(-6, 'set'), 'ec', 0.1),
+                 (next_crossing(-12, 'set'), 'en', 0.2),
+                 (next_crossing(-18, 'set'), 'ea', 0.3),
+                 (next_crossing(-18, 'rise'), 'ma', 0.5),
+                 (next_crossing(-12, 'rise'), 'mn', 0.3),
+                 (next_crossing(-6, 'rise'), 'mc', 0.2),
+                 (next_crossing(0, 'rise'), 'sunrise', 0.1),
                  ]
 
     twilights.sort(key=lambda x: x[0])
@@ -124,10 +93,37 @@ def get_twilights(start, end, nsample=256):
 
 
 
-def plot_weather(date=None, verbose=False):
+def weather_buffers(db, span=tdelta(1)):
+    '''Return rolling buffers of the weather, V5 status, and V5 images
+    collections, for use by plot_weather.
+    '''
+    buffers = {}
+    buffers['weather'] = RollingBuffer(db['weather'],
+                            ('date', 'temp', 'clouds', 'wind', 'rain', 'safe'),
+                            ('datetime64', float, float, float, float, bool),
+                            span=span)
+    buffers['V5status'] = RollingBuffer(db['V5status'],
+                            ('date', 'dome_shutterstatus'),
+                            ('datetime64', int),
+                            span=span)
+    ## Image results are written after the frame is analyzed, so look back
+    ## for late arrivals
+    buffers['images'] = RollingBuffer(db['images'],
+                            ('date', 'filename', 'airmass'),
+                            ('datetime64', str, float),
+                            query={'telescope': 'V5'},
+                            span=span, overlap=tdelta(0, 2*60*60))
+    return buffers
+
+
+def plot_weather(date=None, verbose=False, buffers=None,
+                 destination_path='/var/www/'):
     '''
     Make plot of the last 24 hours of weather or, if keyword date is set, make
-    plot of that UT day's weather.
+    plot of that UT day's weather.  If buffers (from weather_buffers) are
+    given, they are updated with the documents added since the last plot
+    instead of querying the whole day again.  The plot is written to
+    weather.png in destination_path.
     '''
     if not date:
         end = dt.utcnow()
@@ -136,49 +132,39 @@ def plot_weather(date=None, verbose=False):
 
     start = end - tdelta(1,0)
 
-    client = pymongo.MongoClient('localhost', 27017)
-    db = client['vysos']
-    weather = client.vysos['weather']
-    data = [x for x in weather.find({'date': {'$gt': start, '$lt': end}},
-                                    sort=[('date', pymongo.DESCENDING)])]
-    time = np.array([x['date'] for x in data])
+    if buffers is None:
+        client = pymongo.MongoClient('localhost', 27017)
+        buffers = weather_buffers(client.vysos)
+    for name, buffer in buffers.items():
+        nnew = buffer.update(end)
+        if verbose: print(f'{nnew} new {name} entries, {len(buffer)} in buffer')
+    weather = buffers['weather']
+    weather_time = weather['date']
 
-    # Get status collection for roof state
-    v5status_collection = client.vysos['V5status']
-    query_dict = {'date': {'$gt': start, '$lt': end}}
+    # Roof state from the V5 status
 #     shutter_status_values = {0: 'Open', 1: 'Closed', 2: 'Opening',
 #                              3: 'Closing', 4: 'Unknown'}
-    shutter_values = {0: 0, 1: 1, 2: 0, 3: 1, 4: 4}
-    v5status = [x for x in v5status_collection.find(query_dict,
-                           sort=[('date', pymongo.DESCENDING)])]
-    v5_shutter = [shutter_values[int(x['dome_shutterstatus'])] for x in v5status]
-    v5_status_time = np.array([x['date'] for x in v5status])
-
-    # Get images collection
-    images_collection = client.vysos['images']
-    query_dict = {'date': {'$gt': start, '$lt': end}, 'telescope': 'V5'}
-    v5images = [x for x in images_collection.find(query_dict,
-                           sort=[('date', pymongo.DESCENDING)])]
-    v5_image_airmass = []
-    v5_image_time = []
-    v5_cal_time = []
-    v5_flat_time = []
-    for im in v5images:
-        if im['filename'][:7] in ['V5_Bias', 'V5_Dark']:
-            v5_cal_time.append(im['date'])
-        elif im['filename'][:11] == 'V5_AutoFlat':
-            v5_flat_time.append(im['date'])
-        else:
-            if 'airmass' in im.keys():
-                v5_image_time.append(im['date'])
-                v5_image_airmass.append(im['airmass'])
-            else:
-                print(im['filename'])
+    shutter_values = np.array([0, 1, 0, 1, 4])
+    v5status = buffers['V5status']
+    v5_shutter = shutter_values[np.clip(v5status['dome_shutterstatus'], 0, 4)]
+    v5_status_time = v5status['date']
+
+    # V5 images
+    v5images = buffers['images']
+    filename = v5images['filename']
+    cal = np.char.startswith(filename, 'V5_Bias') | np.char.startswith(filename, 'V5_Dark')
+    flat = np.char.startswith(filename, 'V5_AutoFlat')
+    science = ~cal & ~flat & ~np.isnan(v5images['airmass'])
+    v5_image_airmass = v5images['airmass'][science]
+    v5_image_time = v5images['date'][science]
+    v5_cal_time = v5images['date'][cal]
+    v5_flat_time = v5images['date'][flat]
 
     dpi=72
-    fig = plt.figure(figsize=(20,10), dpi=dpi)
+    figsize = (20,10)
+    fig = plt.figure(figsize=figsize, dpi=dpi)
     night_plot_file_name = 'weather.png'
-    destination_path = os.path.abspath('/var/www/')
+    destination_path = os.path.abspath(destination_path)
     night_plot_file = os.path.join(destination_path, night_plot_file_name)
     plot_positions = [ [ [0.060, 0.700, 0.600, 0.200], [0.670, 0.700, 0.320, 0.200] ],
                        [ [0.060, 0.490, 0.600, 0.200], [0.670, 0.490, 0.320, 0.200] ],
@@ -188,14 +174,14 @@ def plot_weather(date=None, verbose=False):
                        [ [0.060, 0.010, 0.600, 0.060], [0.670, 0.010, 0.320, 0.060] ],
                      ]
     labels = ['Outside Temp (F)', 'Cloudiness (C)', 'Wind (kph)', 'Rain', 'Safe', 'V5']
-    data = [ np.array([(float(x['temp'])*1.8+32.) for x in data]),
-             np.array([float(x['clouds']) for x in data]),
-             np.array([float(x['wind']) for x in data]),
-             np.array([float(x['rain']) for x in data]),
-             np.array([float(x['safe']) for x in data]),
-             np.array(v5_shutter),
+    data = [ weather['temp']*1.8+32.,
+             weather['clouds'],
+             weather['wind'],
+             weather['rain'],
+             weather['safe'].astype(float),
+             v5_shutter.astype(float),
            ]
-    times = [time, time, time, time, time, v5_status_time]
+    times = [weather_time]*5 + [v5_status_time]
 
     windlim_data = list(data[2]*1.1) # multiply by 1.1 for plot limit
     windlim_data.append(65) # minimum limit on plot is 65
@@ -207,72 +193,81 @@ def plot_weather(date=None, verbose=False):
               (-0.25,1.1),
             ]
 
+    ## Twilights are the same for every panel, so find them once
+    try:
+        twilights = get_twilights(start, end)
+    except ValueError as e:
+        twilights = []
+#         print('Failed to get twilight info:')
+#         print(e)
+
+    ## Time range of the left (whole day) and right (last 75 minutes) panels
+    windows = [(start, end), (end - tdelta(0,1.25*60*60), end)]
+
     ##-------------------------------------------------------------------------
     ## Loop Over Plots
     ##-------------------------------------------------------------------------
     for i,label in enumerate(labels):
         if verbose: print(label)
-        if label in weather_limits.keys():
-            if label == 'Rain':
-                wsafe = np.where(data[i] > weather_limits[label][0])[0]
-                wwarn = np.where(np.array(data[i] <= weather_limits[label][0])\
-                                 & np.array(data[i] > weather_limits[label][1]) )[0]
-                wunsafe = np.where(data[i] <= weather_limits[label][1])[0]
-            else:
-                wsafe = np.where(data[i] < weather_limits[label][0])[0]
-                wwarn = np.where(np.array(data[i] >= weather_limits[label][0])\
-                                 & np.array(data[i] < weather_limits[label][1]) )[0]
-                wunsafe = np.where(data[i] >= weather_limits[label][1])[0]
-            if verbose: print(len(data[i]), len(wsafe), len(wwarn), len(wunsafe))
-            assert len(data[i]) - len(wsafe) - len(wwarn) - len(wunsafe) == 0
-
-
         for lr in range(2):
             t_axes = plt.axes(plot_positions[i][lr])
+            ## Keep only the highest and lowest point in each column of pixels
+            npixels = int(plot_positions[i][lr][2]*figsize[0]*dpi)
+            k = decimate_indices(times[i], data[i], *windows[lr], npixels)
+            x, y = times[i][k], data[i][k]
+            if verbose: print(f'  {len(data[i])} points decimated to {len(y)}')
+            if label in weather_limits.keys():
+                if label == 'Rain':
+                    wsafe = np.where(y > weather_limits[label][0])[0]
+                    wwarn = np.where(np.array(y <= weather_limits[label][0])\
+                                     & np.array(y > weather_limits[label][1]) )[0]
+                    wunsafe = np.where(y <= weather_limits[label][1])[0]
+                else:
+                    wsafe = np.where(y < weather_limits[label][0])[0]
+                    wwarn = np.where(np.array(y >= weather_limits[label][0])\
+                                     & np.array(y < weather_limits[label][1]) )[0]
+                    wunsafe = np.where(y >= weather_limits[label][1])[0]
+                assert len(y) - len(wsafe) - len(wwarn) - len(wunsafe) == 0
+
             if label in ['Outside Temp (F)', 'Cloudiness (C)', 'Wind (kph)', 'Rain']:
                 ## Overplot Twilights
-                try:
-                    twilights = get_twilights(start, end)
-                    for j in range(len(twilights)-1):
-                        plt.axvspan(twilights[j][0], twilights[j+1][0], ymin=0, ymax=1,
-                                    color='blue', alpha=twilights[j+1][2])
-                except ValueError as e:
-                    pass
-#                     print('Failed to get twilight info:')
-#                     print(e)
+                for j in range(len(twilights)-1):
+                    plt.axvspan(twilights[j][0], twilights[j+1][0], ymin=0, ymax=1,
+                                color='blue', alpha=twilights[j+1][2])
                 ## Plot data
                 if label in weather_limits.keys():
-                    t_axes.plot_date(times[i], data[i], 'ko', label=label,
-                                     markersize=(lr+1)*2, markeredgewidth=0,
-                                     drawstyle="default")
+                    t_axes.plot(x, y, 'ko', label=label,
+                                markersize=(lr+1)*2, markeredgewidth=0,
+                                drawstyle="default")
                     if len(wsafe) > 0:
-                        t_axes.plot_date(times[i][wsafe], data[i][wsafe], 'go',
-                                         markersize=(lr+1)*2, markeredgewidth=0,
-                                         drawstyle="default")
+                        t_axes.plot(x[wsafe], y[wsafe], 'go',
+                                    markersize=(lr+1)*2, markeredgewidth=0,
+                                    drawstyle="default")
                     if len(wwarn) > 0:
-                        t_axes.plot_date(times[i][wwarn], data[i][wwarn], 'yo',
-                                         markersize=(lr+1)*2, markeredgewidth=0,
-                                         drawstyle="default")
+                        t_axes.plot(x[wwarn], y[wwarn], 'yo',
+                                    markersize=(lr+1)*2, markeredgewidth=0,
+                                    drawstyle="default")
                     if len(wunsafe) > 0:
-                        t_axes.plot_date(times[i][wunsafe], data[i][wunsafe], 'ro',
-                                         markersize=(lr+1)*2, markeredgewidth=0,
-                                         drawstyle="default")
+                        t_axes.plot(x[wunsafe], y[wunsafe], 'ro',
+                                    markersize=(lr+1)*2, markeredgewidth=0,
+                                    drawstyle="default")
 
                 else:
-                    t_axes.plot_date(times[i], data[i], 'ko', label=label,
-                                     markersize=4, markeredgewidth=0,
-                                     drawstyle="default")
+                    t_axes.plot(x, y, 'ko', label=label,
+                                markersize=4, markeredgewidth=0,
+                                drawstyle="default")
             if label == 'Safe':
-                plt.fill_between(times[i], -1, data[i], where=np.array(data[i])>0, facecolor='green', alpha=0.6)
-                plt.fill_between(times[i], -1, data[i], where=np.array(data[i])<=0, facecolor='red', alpha=0.6)
+                plt.fill_between(x, -1, y, where=np.array(y)>0, facecolor='green', alpha=0.6)
+                plt.fill_between(x, -1, y, where=np.array(y)<=0, facecolor='red', alpha=0.6)
             if label == 'V5':
-                plt.fill_between(times[i], -1, data[i], where=np.array(data[i])>0, facecolor='k', alpha=0.5)
+                plt.fill_between(x, -1, y, where=np.array(y)>0, facecolor='k', alpha=0.5)
                 plt.plot(v5_image_time, 2-np.array(v5_image_airmass), 'bo', mew=0, ms=3)
                 plt.plot(v5_cal_time, [0.5]*len(v5_cal_time), 'ko', mew=0, ms=3)
                 plt.plot(v5_flat_time, [0.5]*len(v5_flat_time), 'yo', mew=0, ms=3)
             if label == 'Wind (kph)':
                 matime, wind_mavg = moving_averagexy(times[i], data[i], 5)
-                t_axes.plot_date(matime, wind_mavg, 'k-')
+                k = decimate_indices(matime, wind_mavg, *windows[lr], npixels)
+                t_axes.plot(matime[k], wind_mavg[k], 'k-')
             if lr==0:
                 if i==0:
                     plt.title('VYSOS Weather (at {})'.format(end.strftime('%Y/%m/%d %H:%M:%S UT')))
@@ -310,6 +305,23 @@ def plot_weather(date=None, verbose=False):
                 plt.xlabel("UT Time")
 
     plt.savefig(night_plot_file, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+
+
+def loop_weather(db, interval=120, ncycles=None, verbose=False,
+                 destination_path='/var/www/'):
+    '''Plot the weather every interval seconds (forever, or ncycles times),
+    keeping the last day of data in memory and only fetching what is new.
+    '''
+    buffers = weather_buffers(db)
+    cycle = 0
+    while ncycles is None or cycle < ncycles:
+        if cycle > 0:
+            time.sleep(interval)
+        plot_weather(verbose=verbose, buffers=buffers,
+                     destination_path=destination_path)
+        cycle += 1
+    return buffers
 
 
 def main():
@@ -335,12 +347,8 @@ def main():
         args.date = dt.utcnow().strftime("%Y%m%dUT")
 
     if args.loop:
-        while True:
-            ## Set date to tonight
-            now = dt.utcnow()
-            date_string = now.strftime("%Y%m%dUT")
-            plot_weather(verbose=args.verbose)
-            time.sleep(120)
+        client = pymongo.MongoClient('localhost', 27017)
+        loop_weather(client.vysos, verbose=args.verbose)
     else:
         plot_weather(verbose=args.verbose)
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Thin client for the resident measurement server (measure_server.py).  It takes
+the same arguments as measure_image.py, but hands the job to the server so
+that SIDRE, astropy, matplotlib, and pymongo are not imported for every frame.
+If no server is listening, the image is measured in this process instead.
+"""
+
+import sys
+import os
+from argparse import ArgumentParser
+from multiprocessing.connection import Client
+
+
+server_address = ('localhost', 6061)
+server_authkey = b'VYSOS'
+
+
+##-------------------------------------------------------------------------
+## Submit a Job to the Measurement Server
+##-------------------------------------------------------------------------
+def submit(filename, nographics=False, record=True, verbose=False,
+           address=server_address):
+    '''Send a measurement job to the server and wait for the result.  Returns
+    the image_info dict.  Raises ConnectionRefusedError if no server is
+    running and RuntimeError if the measurement failed on the server.  The
+    file name is made absolute here, since the server resolves paths
+    relative to its own working directory.
+    '''
+    filename = os.path.abspath(os.path.expanduser(filename))
+    job = {'filename': filename,
+           'nographics': nographics,
+           'record': record,
+           'verbose': verbose,
+          }
+    with Client(address, authkey=server_authkey) as conn:
+        conn.send(job)
+        reply = conn.recv()
+    if reply['status'] != 'ok':
+        raise RuntimeError(f"Measurement server failed on {filename}: "
+                           f"{reply.get('error', 'unknown error')}")
+    return reply['image_info']
+
+
+def main():
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    parser = ArgumentParser(description="Script to analyze a single FITS image")
+    ## add flags
+    parser.add_argument("-v", "--verbose",
+        action="store_true", dest="verbose",
+        default=False, help="Be verbose! (default = False)")
+    parser.add_argument("-p", "--print",
+        action="store_true", dest="printonly",
+        default=False, help="Print results only, do not record to database.")
+    parser.add_argument("-n", "--no-graphics",
+        action="store_true", dest="nographics",
+        default=False, help="Turn off generation of graphics")
+    ## add arguments
+    parser.add_argument("filename",
+        type=str,
+        help="File Name of Input Image File")
+    args = parser.parse_args()
+
+    try:
+        image_info = submit(args.filename,
+                            nographics=args.nographics,
+                            record=not args.printonly,
+                            verbose=args.verbose)
+    except ConnectionRefusedError:
+        print('No measurement server running, measuring image locally')
+        from measure_image import measure_image
+        image_info = measure_image(args.filename,
+                                   nographics=args.nographics,
+                                   record=not args.printonly,
+                                   verbose=args.verbose)
+    if args.printonly:
+        print(image_info)
+
+
+if __name__ == '__main__':
+    main()
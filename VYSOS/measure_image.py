@@ -9,6 +9,7 @@ import sys
 import os
 from argparse import ArgumentParser
 import re
+import inspect
 from datetime import datetime as dt
 import tempfile
 
@@ -25,6 +26,43 @@ import SIDRE
 
 import pymongo
 
+from VYSOS import Telescope
+from VYSOS.calibration_cache import master_cache
+from VYSOS.astrometry import wcs_cache, solve_astrometry
+from VYSOS.timing import StageTimer
+from VYSOS.result_writer import ResultWriter
+from VYSOS.result_cache import pipeline_key
+from VYSOS.prescreen import prescreen, light_record
+from VYSOS.render import render_pool
+
+
+## Whether this version of SIDRE's bias_correct takes a master_bias (if not,
+## the cached master is subtracted here instead)
+try:
+    bias_correct_takes_master = ('master_bias' in
+        inspect.signature(SIDRE.ScienceImage.bias_correct).parameters)
+except (AttributeError, TypeError, ValueError):
+    bias_correct_takes_master = False
+
+## Parameters which change the results.  These go in to the pipeline key used
+## to decide whether a frame needs to be measured again.
+pipeline_parameters = {'downsample': 2,
+                       'SIPorder': 4,
+                      }
+
+
+##-------------------------------------------------------------------------
+## Record Results
+##-------------------------------------------------------------------------
+def record_image_info(image_info, writer, log=None):
+    if log: log.debug('Adding image info to mongo database')
+    try:
+        writer.write(image_info)
+        if log: log.info(f"  Recorded results for {image_info['filename']}")
+    except:
+        e = sys.exc_info()[0]
+        if log: log.error('Failed to record results')
+        if log: log.error(e)
 
 
 ##-------------------------------------------------------------------------
@@ -34,8 +72,18 @@ def measure_image(file,\
                  verbose=False,\
                  nographics=False,\
                  record=True,\
+                 calibration_cache=master_cache,\
+                 wcs_cache=wcs_cache,\
+                 mongo_address='192.168.1.101',\
+                 mongo_port=27017,\
+                 logdir='/Users/vysosuser/V20Data/AnalysisLogs',\
+                 writer=None,\
+                 jpegdir='/var/www/plots',\
+                 renderer=render_pool,\
+                 data_hash=None,\
                  ):
     tick = dt.utcnow()
+    timer = StageTimer()
     file = os.path.abspath(os.path.expanduser(file))
 
     image_info = {'filename': os.path.basename(file),
@@ -48,19 +96,46 @@ def measure_image(file,\
         pass
     ## Is the image compressed?
     image_info['compressed'] = (os.path.splitext(image_info['filename'])[1] == '.fz')
+    if record and writer is None:
+        writer = ResultWriter(mongo_address, mongo_port)
+
+    ## Pre-screen using only the header and a subsample of the pixels
+    with timer('prescreen'):
+        classification, reason, route, header = prescreen(file)
+    if route == 'skip':
+        return None
+
+    ## Identify the pixels (if the caller hashed them, see
+    ## result_cache.content_hash) and pipeline which produced these results
+    if data_hash is not None:
+        image_info['content_hash'] = data_hash
+    image_info['pipeline_key'] = pipeline_key(SIDRE.version.version,
+                                              pipeline_parameters)
+
+    ## Frames which are not worth a full analysis get a header-only record
+    if route == 'light':
+        light_record(image_info, header, classification, reason)
+        image_info['timings'] = timer.as_dict()
+        if record:
+            record_image_info(image_info, writer)
+        return image_info
+    image_info['prescreen'] = classification
 
     ## Set up logfile name and location
     logfilename = os.path.basename(file).replace(".fts", ".log")
     finddate = re.search('(\d{8})at(\d{6})', logfilename)
     if finddate is not None:
         imageUTdate = f"{finddate.group(1)}UT"
-    if not os.path.exists(os.path.join('/Users/vysosuser/V20Data/AnalysisLogs', imageUTdate)):
-        os.mkdir(os.path.join('/Users/vysosuser/V20Data/AnalysisLogs', imageUTdate))
-    logfile = os.path.join('/Users/vysosuser/V20Data/AnalysisLogs', imageUTdate, logfilename)
+    if not os.path.exists(os.path.join(logdir, imageUTdate)):
+        os.makedirs(os.path.join(logdir, imageUTdate))
+    logfile = os.path.join(logdir, imageUTdate, logfilename)
 
 #     im = SIDRE.ScienceImage(file, logfile=logfile, verbose=verbose)
+    read_start = timer.elapsed()
     with SIDRE.ScienceImage(file, logfile=logfile, verbose=verbose) as im:
-        im.get_header_pointing()
+        timer.add('read', timer.elapsed() - read_start)
+        with timer('header'):
+            im.get_header_pointing()
 
         # Target Name
         image_info['target name'] = im.ccd.header.get('OBJECT', '')
@@ -93,18 +168,42 @@ def measure_image(file,\
             pass
 
 
-        try:
-            if not SIDRE.utils.get_master(im.date, type='Bias'):
-                SIDRE.calibration.make_master_bias(im.date)
-            im.bias_correct()
-        except:
-            pass
-        im.gain_correct()
-        im.create_deviation()
-        im.make_source_mask()
-        im.subtract_background()
-        im.solve_astrometry(downsample=2, SIPorder=4)
-        perr = im.calculate_pointing_error()
+        with timer('bias'):
+            try:
+                master_bias = calibration_cache.get(image_info.get('telescope'),
+                                      im.date, type='Bias',
+                                      make=SIDRE.calibration.make_master_bias)
+                if master_bias is None:
+                    im.bias_correct()
+                elif bias_correct_takes_master:
+                    im.bias_correct(master_bias=master_bias)
+                else:
+                    master = np.asarray(getattr(master_bias, 'data', master_bias),
+                                        dtype=np.float32)
+                    im.ccd.data = im.ccd.data.astype(np.float32) - master
+            except Exception as e:
+                im.log.warning(f'  Bias correction with master bias failed: {e}')
+                im.log.warning('  Falling back to default bias correction')
+                try:
+                    im.bias_correct()
+                except:
+                    pass
+        with timer('gain'):
+            im.gain_correct()
+        with timer('background'):
+            im.create_deviation()
+            im.make_source_mask()
+            im.subtract_background()
+        with timer('astrometry'):
+            tel = Telescope(image_info.get('telescope', None))
+            image_info['astrometry_warm'] = solve_astrometry(im,
+                                      image_info.get('telescope', None),
+                                      image_info['target name'],
+                                      image_info['date'],
+                                      tel.pixel_scale,
+                                      cache=wcs_cache,
+                                      **pipeline_parameters)
+            perr = im.calculate_pointing_error()
         try:
             image_info['perr_arcmin']=perr.to(u.arcmin).value
             image_info['header_RA']=im.header_pointing.ra.deg
@@ -119,8 +218,10 @@ def measure_image(file,\
 
 
         ## Determine Typical FWHM
-        im.extract()
-        im.determine_FWHM()
+        with timer('extract'):
+            im.extract()
+        with timer('fwhm'):
+            im.determine_FWHM()
         image_info['FWHM_pix'] = im.FWHM_pix
         image_info['ellipticity'] = im.ellipticity
 
@@ -151,69 +252,27 @@ def measure_image(file,\
         image_info['analyzed']=True
         image_info['SIDREversion']=SIDRE.version.version
 
-        if nographics is True:
-            fulljpeg = None
-            cropjpeg = None
-        else:
-            fulljpeg = 'test_PS.jpg'
-            cropjpeg = None
-            im.render_jpeg(jpegfilename=fulljpeg,
-                           overplot_assoc=False, overplot_pointing=True)
+        ## JPEGs are rendered in the background from the pixels already in
+        ## memory, only the hand off is timed here.
+        if nographics is not True:
+            with timer('render'):
+                basename = image_info['filename'].split('.')[0]
+                outdir = os.path.join(jpegdir, image_info.get('telescope', ''))
+                image_info['jpegs'] = renderer.submit(im.ccd.data, basename,
+                                                      outdir)
+
+        image_info['timings'] = timer.as_dict()
     
         if record:
-            im.log.info('Connecting to mongo db at 192.168.1.101')
-            try:
-                client = pymongo.MongoClient('192.168.1.101', 27017)
-                db = client.vysos
-                images = db['images']
-            except:
-                im.log.error('Could not connect to mongo db')
-                raise Exception('Failed to connect to mongo')
-            else:
-                # Remove old entries for this image file
-                deletion = images.delete_many( {'filename': os.path.basename(file)} )
-                im.log.info(f'  Deleted {deletion.deleted_count} previous entries for {os.path.basename(file)}')
-                # Save JPEG to MongoDB
-    #             if nographics is False:
-    #                 if fulljpeg is not None:
-    #                     im.log.info('  Saving full frame JPEG')
-    #                     with open(fulljpeg, 'rb') as imageData:
-    #                         image_bytes = imageData.read()
-    #                         with tempfile.TemporaryFile() as f:
-    #                             f.write(bytearray(image_bytes))
-    #                             f.flush()
-    #                             f.seek(0)
-    #                             image_info.full_field_jpeg.put(f)
-    #                 if cropjpeg is not None:
-    #                     im.log.info('  Saving crop frame JPEG')
-    #                     with open(cropjpeg, 'rb') as imageData:
-    #                         image_bytes = imageData.read()
-    #                         with tempfile.TemporaryFile() as f:
-    #                             f.write(bytearray(image_bytes))
-    #                             f.flush()
-    #                             f.seek(0)
-    #                             image_info.cropped_jpeg.put(f)
-
-                # Save new entry for this image file
-                im.log.debug('Adding image info to mongo database')
-                ## Save document
-                try:
-                    inserted_id = images.insert_one(image_info).inserted_id
-                    im.log.info("  Inserted document id: {}".format(inserted_id))
-                except:
-                    e = sys.exc_info()[0]
-                    im.log.error('Failed to add new document')
-                    im.log.error(e)
-                client.close()
-
-
-
-        else:
-            print(image_info)
+            record_image_info(image_info, writer, log=im.log)
 
         tock = dt.utcnow()
         elapsed = (tock-tick).total_seconds()
         im.log.info(f'Processing time = {elapsed:.1f} s')
+        for stage, seconds in image_info['timings'].items():
+            im.log.debug(f'  {stage:>12s} = {seconds:.2f} s')
+
+    return image_info
 
 
 def main():
@@ -237,10 +296,12 @@ def main():
         help="File Name of Input Image File")
     args = parser.parse_args()
 
-    measure_image(args.filename,
-                  nographics=args.nographics,
-                  record=not args.printonly,
-                  verbose=args.verbose)
+    image_info = measure_image(args.filename,
+                               nographics=args.nographics,
+                               record=not args.printonly,
+                               verbose=args.verbose)
+    if args.printonly:
+        print(image_info)
 
 
 if __name__ == '__main__':
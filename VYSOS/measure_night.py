@@ -7,20 +7,132 @@ import re
 import fnmatch
 import numpy
 from datetime import datetime as dt
+from datetime import timedelta as tdelta
 import glob
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 import astropy.io.fits as fits
 
 import IQMon
-from measure_image import measure_image
+from measure_image import measure_image, pipeline_parameters
+from VYSOS.calibration_cache import master_cache
+from VYSOS.timing import rollup, night_timings, format_rollup
+from VYSOS.result_writer import ResultWriter
+from VYSOS.result_cache import split_unchanged, pipeline_key, content_hash
+import SIDRE
 
 
-def measure_night(date=None, telescope=None):
+##-------------------------------------------------------------------------
+## Sort Key: Observation Time from File Name
+##-------------------------------------------------------------------------
+def file_time_key(file):
+    '''Sort key which orders files by the timestamp in the file name (e.g.
+    V20_Target-20181201at101010.fts), falling back to the file name itself.
+    '''
+    filename = os.path.basename(file)
+    finddate = re.search('(\d{8})at(\d{6})', filename)
+    if finddate is not None:
+        return (finddate.group(1), finddate.group(2), filename)
+    return ('', '', filename)
+
+
+##-------------------------------------------------------------------------
+## Limit Memory Used by Cached Master Calibrations (runs in each worker)
+##-------------------------------------------------------------------------
+def set_cache_limit(cache_mb):
+    if cache_mb is not None:
+        master_cache.maxbytes = int(cache_mb*1024*1024)
+
+
+##-------------------------------------------------------------------------
+## Measure a Single File (runs in a worker process when jobs > 1)
+##-------------------------------------------------------------------------
+def measure_file(file, data_hash=None):
+    '''Run measure_image on a single file, trapping any failure so that one
+    bad file does not kill the batch.  The file's content_hash (computed
+    here unless it is passed in) is stored with the results, so later runs
+    can skip it.  Results are not recorded here, the caller writes them in
+    batches.  Returns (file, status, elapsed, image_info).
+    '''
+    tick = dt.utcnow()
+    image_info = None
+    try:
+        if data_hash is None:
+            try:
+                data_hash = content_hash(file)
+            except OSError:
+                pass
+        image_info = measure_image(file, nographics=True, record=False,
+                                   data_hash=data_hash)
+        if image_info is None:
+            status = 'skipped'
+        elif image_info.get('analyzed', False) is False:
+            status = image_info.get('prescreen', 'not analyzed')
+        else:
+            status = 'ok'
+    except:
+        status = f'failed ({sys.exc_info()[0].__name__})'
+    elapsed = (dt.utcnow() - tick).total_seconds()
+    return (file, status, elapsed, image_info)
+
+
+def measure_files(files, jobs=1, cache_mb=None, hashes=None):
+    '''Generator which measures files, in a pool of jobs worker processes if
+    jobs > 1, and yields the measure_file results in the order of files.
+    hashes holds any content hashes which are already known.
+    '''
+    set_cache_limit(cache_mb)
+    if hashes is None:
+        hashes = {}
+    if jobs <= 1:
+        for file in files:
+            yield measure_file(file, hashes.get(file, None))
+        return
+    ## Each worker process imports SIDRE itself and so keeps its own state.
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=set_cache_limit,
+                             initargs=(cache_mb,)) as executor:
+        futures = [executor.submit(measure_file, file, hashes.get(file, None))
+                   for file in files]
+        for file, future in zip(files, futures):
+            try:
+                yield future.result()
+            except:
+                ## The worker itself died (e.g. BrokenProcessPool)
+                yield (file, 'worker died', 0.0, None)
+
+
+def print_summary(results, by_version=None):
+    '''Print the status of each file and the time spent per stage on them.
+    by_version is the output of night_timings, which covers all images
+    recorded for the night, including those skipped as up to date.
+    '''
+    nfailed = len([r for r in results if r[1].startswith('failed')
+                                        or r[1] == 'worker died'])
+    nok = len([r for r in results if r[1] == 'ok'])
+    print(f"Summary: {nok:d} analyzed, {len(results)-nok-nfailed:d} pre-screened"
+          f" or skipped, {nfailed:d} failed")
+    for file, status, elapsed, image_info in results:
+        print(f"  {status:>20s} {elapsed:7.1f} s  {os.path.basename(file)}")
+    summary = rollup([r[3].get('timings', None) for r in results
+                      if r[3] is not None])
+    if len(summary) > 0:
+        print("Time spent per pipeline stage:")
+        for line in format_rollup(summary):
+            print(line)
+    for version, summary in sorted((by_version or {}).items()):
+        print(f"Time spent per pipeline stage for the whole night (SIDRE {version}):")
+        for line in format_rollup(summary):
+            print(line)
+
+
+def measure_night(date=None, telescope=None, jobs=1, cache_mb=None,
+                  batch_size=50, force=False):
     ##-------------------------------------------------------------------------
     ## Set date to tonight if not specified
     ##-------------------------------------------------------------------------
     now = dt.utcnow()
-    if date is None:
+    if not date:
         date = now.strftime("%Y%m%dUT")
     
     ## Set Path to Data for this night
@@ -37,19 +149,44 @@ def measure_night(date=None, telescope=None):
             location = path
     if location is None:
         print('Could not find data path for {}'.format(telescope))
-    else:
-        print("Analyzing data for night of "+date)
-        print("Found data at: {}".format(location))
-    
-        files = glob.glob(os.path.join(location, '*.fts'))
-        files.extend(glob.glob(os.path.join(location, '*.fts.fz')))
-        print(f"Found {len(files):d} files in images directory")
-        for file in files:
-            try:
-                measure_image(file, nographics=True)
-            except:
+        return []
+
+    print("Analyzing data for night of "+date)
+    print("Found data at: {}".format(location))
+
+    files = glob.glob(os.path.join(location, '*.fts'))
+    files.extend(glob.glob(os.path.join(location, '*.fts.fz')))
+    files.sort(key=file_time_key)
+    print(f"Found {len(files):d} files in images directory")
+
+    results = []
+    hashes = {}
+    with ResultWriter(batch_size=batch_size) as writer:
+        if force is False:
+            key = pipeline_key(SIDRE.version.version, pipeline_parameters)
+            files, unchanged, hashes = split_unchanged(writer.collection, files, key)
+            print(f"Skipping {len(unchanged):d} files with up to date results")
+        if jobs > 1:
+            print(f"Measuring images using {jobs:d} worker processes")
+        for result in measure_files(files, jobs=jobs, cache_mb=cache_mb,
+                                    hashes=hashes):
+            results.append(result)
+            file, status, elapsed, image_info = result
+            if image_info is not None:
+                writer.write(image_info)
+            elif status != 'skipped':
                 print(f"Measure image failed on {file}")
 
+    try:
+        start = dt.strptime(date, '%Y%m%dUT')
+        by_version = night_timings(writer.collection, telescope,
+                                   start, start + tdelta(1))
+    except:
+        print('Could not read stored timings for this night')
+        by_version = None
+    print_summary(results, by_version=by_version)
+    return results
+
 
 if __name__ == "__main__":
     ##-------------------------------------------------------------------------
@@ -69,7 +206,16 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--date", 
         dest="date", required=False, default="", type=str,
         help="UT date of night to analyze. (i.e. '20130805UT')")
+    parser.add_argument("-j", "--jobs",
+        dest="jobs", required=False, default=1, type=int,
+        help="Number of worker processes to use. (default = 1)")
+    parser.add_argument("--cache-mb",
+        dest="cache_mb", required=False, default=None, type=float,
+        help="Memory cap (MB) for cached master calibrations per process.")
+    parser.add_argument("-f", "--force",
+        dest="force", action="store_true", default=False,
+        help="Measure all files, even those with up to date results.")
     args = parser.parse_args()
 
-    measure_night(date=args.date, telescope=args.telescope)
-
+    measure_night(date=args.date, telescope=args.telescope, jobs=args.jobs,
+                  cache_mb=args.cache_mb, force=args.force)
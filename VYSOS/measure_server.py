@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Resident measurement server.  SIDRE, astropy, matplotlib, and pymongo are
+imported once when the server starts and jobs are then taken over a local
+socket (see measure_client.py), so the per-frame cost is only the analysis.
+"""
+
+import sys
+import os
+from argparse import ArgumentParser
+import logging
+from multiprocessing.connection import Listener
+
+from measure_image import measure_image
+from measure_client import server_address, server_authkey
+
+
+##-------------------------------------------------------------------------
+## Serve Measurement Jobs
+##-------------------------------------------------------------------------
+def serve(logger, address=server_address):
+    logger.info(f'Listening for measurement jobs on {address[0]}:{address[1]}')
+    with Listener(address, authkey=server_authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f'Rejected connection: {e}')
+                continue
+            with conn:
+                try:
+                    job = conn.recv()
+                except EOFError:
+                    continue
+                except Exception as e:
+                    logger.warning(f'Could not read job: {e}')
+                    continue
+                if not isinstance(job, dict) or (job.get('command') != 'shutdown'
+                   and not isinstance(job.get('filename', None), str)):
+                    logger.warning(f'Rejected malformed job: {job!r:.200}')
+                    try:
+                        conn.send({'status': 'failed', 'error': 'malformed job'})
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    continue
+                if job.get('command') == 'shutdown':
+                    logger.info('Received shutdown command')
+                    conn.send({'status': 'ok', 'image_info': None})
+                    break
+                logger.info(f"Measuring {job['filename']}")
+                try:
+                    image_info = measure_image(job['filename'],
+                                               nographics=job.get('nographics', False),
+                                               record=job.get('record', True),
+                                               verbose=job.get('verbose', False))
+                except:
+                    e = sys.exc_info()
+                    logger.warning(f"  MeasureImage failed on {job['filename']}")
+                    logger.error(e)
+                    reply = {'status': 'failed', 'error': repr(e[1])}
+                else:
+                    reply = {'status': 'ok', 'image_info': image_info}
+                try:
+                    conn.send(reply)
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.warning('  Client went away before the result was sent')
+
+
+def main():
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    parser = ArgumentParser(description="Resident image measurement server")
+    ## add flags
+    parser.add_argument("-v", "--verbose",
+        action="store_true", dest="verbose",
+        default=False, help="Be verbose! (default = False)")
+    ## add arguments
+    parser.add_argument("--port",
+        dest="port", required=False, default=server_address[1], type=int,
+        help=f"Port to listen on (default = {server_address[1]})")
+    args = parser.parse_args()
+
+    ##-------------------------------------------------------------------------
+    ## Create Logger Object
+    ##-------------------------------------------------------------------------
+    logger = logging.getLogger('measure_server')
+    logger.setLevel(logging.DEBUG)
+    ## Set up console output
+    LogConsoleHandler = logging.StreamHandler()
+    if args.verbose:
+        LogConsoleHandler.setLevel(logging.DEBUG)
+    else:
+        LogConsoleHandler.setLevel(logging.INFO)
+    LogFormat = logging.Formatter('%(asctime)23s %(levelname)8s: %(message)s')
+    LogConsoleHandler.setFormatter(LogFormat)
+    logger.addHandler(LogConsoleHandler)
+
+    serve(logger, address=(server_address[0], args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cheap pre-screen of a frame before the full SIDRE pipeline runs.  Only the
+header and a strided subsample of the pixels are read, which is enough to
+tell science frames from calibrations, empty (e.g. clouded out) frames, and
+unusable (e.g. saturated) ones.
+"""
+
+import os
+import re
+from datetime import datetime as dt
+
+import numpy as np
+
+from VYSOS.fits_io import read_subsample, read_region
+
+
+## What to do with each class of frame: run the full pipeline, write a
+## light-weight record built from the header, or skip it entirely.
+routes = {'science': 'full',
+          'calibration': 'light',
+          'empty': 'light',
+          'unusable': 'light',
+          'unreadable': 'skip',
+         }
+
+## Calibrations are named e.g. V5_Bias-..., V20_Dark-..., V20_AutoFlat-...
+## (a science target may well be called e.g. DarkNebula, so only these
+## prefixes count)
+calibration_filename = re.compile('V[25]0?_(Bias|Dark|AutoFlat|DomeFlat|SkyFlat)[\-_\.\d].*\.fts')
+calibration_imagetyp = re.compile('.*(Bias|Dark|Flat).*', re.IGNORECASE)
+empty_filename = re.compile('.*\-Empty\-.*\.fts')
+
+
+##-------------------------------------------------------------------------
+## Classify a Frame
+##-------------------------------------------------------------------------
+def calibration_reason(file, header):
+    '''Return the reason a frame is a calibration (bias, dark, or flat)
+    based on its file name and header, or None if it is not one.
+    '''
+    filename = os.path.basename(file)
+    imagetyp = str(header.get('IMAGETYP', '')).strip()
+    ## IMAGETYP is authoritative when present, the file name is only used
+    ## when it is missing
+    if imagetyp != '':
+        if calibration_imagetyp.match(imagetyp):
+            return imagetyp
+    elif calibration_filename.match(filename):
+        return 'calibration file name'
+    if float(header.get('EXPTIME', -1)) == 0:
+        return 'zero exposure time'
+    return None
+
+
+def count_bright(values, nsigma=5.):
+    '''Return the number of values more than nsigma (robust) standard
+    deviations above the median, or None if the values do not vary.
+    '''
+    median = np.median(values)
+    sigma = 1.4826*np.median(np.abs(values - median))
+    if sigma <= 0:
+        return None
+    return int(np.sum(values > median + nsigma*sigma))
+
+
+def band_is_empty(file, header, min_sources=3, nsigma=5., nrows=256):
+    '''Check a band of nrows full resolution rows across the middle of the
+    frame for bright pixels.  Returns True only if the band was read and
+    has fewer than min_sources of them.
+    '''
+    ny = header.get('NAXIS2', 0)
+    y0 = max(int(ny/2 - nrows/2), 0)
+    try:
+        header, band = read_region(file, slice(y0, y0+nrows), slice(None))
+    except:
+        return False
+    band = band[np.isfinite(band)]
+    if len(band) == 0:
+        return False
+    nbright = count_bright(band, nsigma=nsigma)
+    return nbright is not None and nbright < min_sources
+
+
+def classify(file, header, subsample, saturation=60000., max_saturated=0.05,
+             min_sources=3, nsigma=5.):
+    '''Classify a frame as science, calibration, empty, or unusable.
+    Returns (classification, reason).  When in doubt a frame is called
+    science, so that it gets the full pipeline.
+    '''
+    filename = os.path.basename(file)
+    reason = calibration_reason(file, header)
+    if reason is not None:
+        return 'calibration', reason
+    if empty_filename.match(filename):
+        return 'empty', 'empty field file name'
+
+    good = np.isfinite(subsample)
+    if np.sum(good) == 0:
+        return 'unusable', 'no finite pixels'
+    values = subsample[good]
+    saturated = np.sum(values >= saturation)/len(values)
+    if saturated > max_saturated:
+        return 'unusable', f'{100*saturated:.0f}% of pixels saturated'
+
+    ## Count pixels well above the sky.  The subsample only has one pixel in
+    ## a few hundred, so a sparse field can have few there; only call the
+    ## frame empty if a full resolution band across it has none either.
+    nbright = count_bright(values, nsigma=nsigma)
+    if nbright is None:
+        return 'unusable', 'no variation in pixel values'
+    if nbright < min_sources and band_is_empty(file, header,
+                                               min_sources=min_sources,
+                                               nsigma=nsigma):
+        return 'empty', f'only {nbright} bright pixels in subsample and too few in central band'
+    return 'science', ''
+
+
+def prescreen(file, stride=16):
+    '''Pre-screen a frame.  Returns (classification, reason, route, header)
+    where route is one of 'full', 'light', or 'skip'.
+    '''
+    try:
+        header, subsample = read_subsample(file, stride=stride)
+    except Exception as e:
+        return 'unreadable', str(e), routes['unreadable'], None
+    classification, reason = classify(file, header, subsample)
+    return classification, reason, routes[classification], header
+
+
+##-------------------------------------------------------------------------
+## Light-weight Record Built from the Header
+##-------------------------------------------------------------------------
+def light_record(image_info, header, classification, reason):
+    '''Fill in image_info from the header alone, for frames which do not go
+    through the full pipeline.
+    '''
+    image_info['analyzed'] = False
+    image_info['prescreen'] = classification
+    image_info['prescreen_reason'] = reason
+    image_info['target name'] = header.get('OBJECT', '')
+    image_info['imagetyp'] = header.get('IMAGETYP', '')
+    image_info['exptime'] = float(header.get('EXPTIME', '-1'))
+    try:
+        image_info['date'] = dt.strptime(header.get('DATE-OBS', 'unknown')[:19],
+                                         '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        pass
+    if image_info.get('telescope', None) == 'V5':
+        image_info['filter'] = 'PSr'
+    else:
+        image_info['filter'] = header.get('FILTER', 'unknown')
+    try:
+        image_info['az'] = float(header.get('AZIMUTH'))
+        image_info['alt'] = float(header.get('ALTITUDE'))
+        image_info['airmass'] = float(header.get('AIRMASS'))
+    except:
+        pass
+    return image_info
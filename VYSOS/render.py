@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Render JPEGs of measured frames off the measurement's critical path.  A small
+pool of threads takes pixel arrays which are already in memory and writes a
+full frame JPEG, a JPEG of the central region at full resolution, and a
+thumbnail for each file.
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
+from matplotlib import image as mpimg
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def jpeg_names(basename):
+    '''File names of the cropped, thumbnail, and full frame JPEGs.  The full
+    frame is last because the image list links the file name to the last
+    JPEG (and the others as extra links).
+    '''
+    return [f'{basename}_crop.jpg', f'{basename}_thumb.jpg', f'{basename}_full.jpg']
+
+
+def rebin(data, max_size):
+    '''Block average data so that neither axis is larger than max_size.'''
+    factor = int(np.ceil(max(data.shape)/max_size))
+    if factor <= 1:
+        return data
+    ny, nx = (data.shape[0]//factor)*factor, (data.shape[1]//factor)*factor
+    return data[:ny,:nx].reshape(ny//factor, factor, nx//factor, factor).mean(axis=(1,3))
+
+
+def stretch(data, vmin, vmax):
+    '''Scale data to 0-255 with an asinh stretch between vmin and vmax.'''
+    scaled = np.clip((data - vmin)/(vmax - vmin), 0, 1)
+    scaled = np.arcsinh(10*scaled)/np.arcsinh(10)
+    return (255*scaled).astype(np.uint8)
+
+
+##-------------------------------------------------------------------------
+## Render JPEGs
+##-------------------------------------------------------------------------
+def render_jpegs(data, basename, outdir, full_size=1024, crop_size=800,
+                 thumb_size=200, quality=85):
+    '''Write full frame, cropped, and thumbnail JPEGs of data to outdir.
+    Returns the list of file names written.
+    '''
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    data = np.asarray(data, dtype=np.float32)
+    ## Display range from a subsample of the frame
+    sample = data[::8,::8]
+    sample = sample[np.isfinite(sample)]
+    vmin, vmax = np.percentile(sample, [0.5, 99.5]) if len(sample) > 0 else (0, 1)
+    if vmax <= vmin:
+        vmax = vmin + 1
+
+    ny, nx = data.shape
+    y0 = max(int(ny/2 - crop_size/2), 0)
+    x0 = max(int(nx/2 - crop_size/2), 0)
+    images = [data[y0:y0+crop_size, x0:x0+crop_size],
+              rebin(data, thumb_size),
+              rebin(data, full_size),
+             ]
+    names = jpeg_names(basename)
+    for name, image in zip(names, images):
+        mpimg.imsave(os.path.join(outdir, name), stretch(image, vmin, vmax),
+                     cmap='gray', vmin=0, vmax=255, origin='lower',
+                     format='jpg', pil_kwargs={'quality': quality})
+    return names
+
+
+class RenderPool(object):
+    '''Renders JPEGs in background threads.  submit() copies the pixel array
+    (so the caller may go on modifying or freeing it) and returns the names
+    of the JPEGs which will be written, without waiting for them.  A render
+    which fails is reported to logger (the 'render' logger by default).
+    '''
+    def __init__(self, max_workers=2, logger=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='render')
+        self.logger = logger if logger is not None else logging.getLogger('render')
+        self.futures = []
+
+    def submit(self, data, basename, outdir, **kwargs):
+        data = np.array(data, dtype=np.float32, copy=True)
+        future = self.executor.submit(render_jpegs, data, basename, outdir,
+                                      **kwargs)
+        future.add_done_callback(lambda f: self.report(f, basename))
+        self.futures = [f for f in self.futures if not f.done()] + [future]
+        return jpeg_names(basename)
+
+    def report(self, future, basename):
+        '''Log the failure, if any, of the render of basename.'''
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self.logger.error(f'Failed to render JPEGs for {basename}: {e!r}')
+
+    def wait(self):
+        '''Block until all submitted renders are written.'''
+        for future in self.futures:
+            future.exception()
+        self.futures = []
+
+
+## Shared by measure_image and the tools which call it.
+render_pool = RenderPool()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Skip re-measuring frames whose results are already up to date.  Each images
+record stores a hash of the FITS data and a key made from the SIDRE version
+and the pipeline parameters.  A frame only needs to be measured again if
+either of those has changed.
+"""
+
+import os
+import json
+import hashlib
+
+from astropy.io import fits
+
+
+##-------------------------------------------------------------------------
+## Hash of the FITS Data
+##-------------------------------------------------------------------------
+def content_hash(file, chunk_size=4*1024*1024):
+    '''Hash the data units (not the headers) of every HDU in a FITS file, so
+    that header-only edits (e.g. adding a CHECKSUM) do not count as a change.
+    The bytes are hashed as stored, so a file and its fpack'ed copy differ.
+    '''
+    with fits.open(file, memmap=True) as hdul:
+        locations = [hdul.fileinfo(i) for i in range(len(hdul))]
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as FO:
+        for info in locations:
+            FO.seek(info['datLoc'])
+            remaining = info['datSpan']
+            while remaining > 0:
+                chunk = FO.read(min(chunk_size, remaining))
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+                remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def pipeline_key(version, parameters):
+    '''String identifying the SIDRE version and pipeline parameters.'''
+    return f"{version} {json.dumps(parameters, sort_keys=True)}"
+
+
+##-------------------------------------------------------------------------
+## Find Frames Which Need Measuring
+##-------------------------------------------------------------------------
+def split_unchanged(images, files, key):
+    '''Split files in to (changed, unchanged) lists by comparing them with
+    their records in the images collection.  All records are fetched with a
+    single projected query, and files are only hashed if their record was
+    made with the same pipeline key.  Returns (changed, unchanged, hashes)
+    where hashes holds the content_hash of each changed file which was
+    hashed, so it need not be computed again.
+    '''
+    names = [os.path.basename(file) for file in files]
+    projection = {'_id': False, 'filename': True, 'content_hash': True,
+                  'pipeline_key': True}
+    records = {}
+    for entry in images.find({'filename': {'$in': names}}, projection):
+        records[entry['filename']] = entry
+
+    changed = []
+    unchanged = []
+    hashes = {}
+    for file, name in zip(files, names):
+        entry = records.get(name, None)
+        if entry is None or entry.get('pipeline_key', None) != key\
+           or 'content_hash' not in entry:
+            changed.append(file)
+            continue
+        try:
+            hashes[file] = content_hash(file)
+        except OSError:
+            changed.append(file)
+            continue
+        if hashes[file] == entry['content_hash']:
+            unchanged.append(file)
+            del hashes[file]
+        else:
+            changed.append(file)
+    return changed, unchanged, hashes
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Write measure_image results to the mongo images collection.  One MongoClient
+(which pools its own connections) is kept per server for the life of the
+process and each result is written with a single upsert keyed on filename.
+In batch mode the upserts are buffered and sent with bulk_write.
+"""
+
+import threading
+
+import pymongo
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+
+##-------------------------------------------------------------------------
+## Pooled Clients
+##-------------------------------------------------------------------------
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(address='192.168.1.101', port=27017):
+    '''Return the shared MongoClient for this server, creating it on first
+    use.  The filename index the upserts rely on is created by ResultWriter.
+    '''
+    with clients_lock:
+        if (address, port) not in clients:
+            clients[(address, port)] = pymongo.MongoClient(address, port)
+        return clients[(address, port)]
+
+
+##-------------------------------------------------------------------------
+## Result Writer
+##-------------------------------------------------------------------------
+class ResultWriter(object):
+    '''Upserts image_info documents keyed on filename.
+
+    If batch_size is None each write goes straight to the database, otherwise
+    writes are buffered and flushed with bulk_write once batch_size of them
+    have accumulated (and on flush() or leaving a with block).  A batch which
+    fails to write is logged and dropped, so one bad document does not stop
+    the rest of the night from being recorded.
+    '''
+    indexed = set()
+
+    def __init__(self, address='192.168.1.101', port=27017, db='vysos',
+                 collection='images', batch_size=None, logger=None):
+        self.client = get_client(address, port)
+        self.collection = self.client[db][collection]
+        self.batch_size = batch_size
+        self.logger = logger
+        self.pending = []
+        self.lock = threading.Lock()
+        key = (address, port, db, collection)
+        if key not in ResultWriter.indexed:
+            self.collection.create_index('filename')
+            ResultWriter.indexed.add(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def write(self, image_info):
+        filter = {'filename': image_info['filename']}
+        if self.batch_size is None:
+            result = self.collection.replace_one(filter, image_info,
+                                                 upsert=True)
+            if self.logger:
+                action = 'Updated' if result.matched_count > 0 else 'Inserted'
+                self.logger.info(f"  {action} document for {image_info['filename']}")
+            return
+        with self.lock:
+            self.pending.append(ReplaceOne(filter, image_info, upsert=True))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            operations, self.pending = self.pending, []
+        if len(operations) == 0:
+            return
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            ## Unordered, so everything except the failed documents was written
+            if self.logger:
+                errors = e.details.get('writeErrors', [])
+                self.logger.error(f"  Failed to write {len(errors)} of "
+                                  f"{len(operations)} documents")
+                for error in errors:
+                    self.logger.error(f"    {error.get('errmsg', error)}")
+            return
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"  Failed to write batch of "
+                                  f"{len(operations)} documents")
+                self.logger.error(f"    {e!r}")
+            return
+        if self.logger:
+            self.logger.info(f"  Wrote {len(operations)} documents "
+                             f"({result.upserted_count} new, "
+                             f"{result.modified_count} updated)")
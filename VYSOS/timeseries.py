@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Load time series (weather, telescope status, image measurements) from mongo
+as columns.  Only the requested fields are fetched (via a projection) and the
+cursor is streamed straight in to preallocated numpy arrays: dates as
+datetime64, missing floats as NaN.  This avoids building a table one row at
+a time, which dominates the cost of plotting long date ranges.
+
+Series are decimated before plotting: a panel a few hundred pixels wide
+cannot show more than the highest and lowest point in each column of pixels,
+so only those are handed to matplotlib.
+
+Processes which redraw the same recent window over and over keep it in a
+RollingBuffer, which only fetches the documents added since the last update.
+"""
+
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import numpy as np
+
+
+## Values used where a document lacks a field
+missing_values = {'M': np.datetime64('NaT'),
+                  'f': np.nan,
+                  'i': 0,
+                  'b': False,
+                  'O': '',
+                 }
+
+
+##-------------------------------------------------------------------------
+## Helper Functions
+##-------------------------------------------------------------------------
+def column_dtype(dtype):
+    '''Normalize a column type.  Strings are collected in object arrays and
+    converted at the end, dates are stored as datetime64[us].
+    '''
+    if dtype in [str, bytes, 'str']:
+        return np.dtype(object)
+    dtype = np.dtype(dtype)
+    if dtype.kind in ['U', 'S']:
+        return np.dtype(object)
+    if dtype.kind == 'M':
+        return np.dtype('datetime64[us]')
+    return dtype
+
+
+def empty_column(dtype, n):
+    return np.full(n, missing_values[dtype.kind], dtype=dtype)
+
+
+##-------------------------------------------------------------------------
+## Load Columns
+##-------------------------------------------------------------------------
+def load_columns(collection, query, names, dtypes, sort=None):
+    '''Return a dict of numpy arrays, one per name, holding the named fields
+    of the documents in collection which match query.  dtypes gives the type
+    of each column (e.g. 'datetime64', float, int, bool, str).  If sort is
+    the name of a column, the rows are ordered by it.
+    '''
+    dtypes = [column_dtype(dtype) for dtype in dtypes]
+    projection = {name: 1 for name in names}
+    projection['_id'] = 0
+
+    size = collection.count_documents(query)
+    columns = [empty_column(dtype, size) for dtype in dtypes]
+    n = 0
+    for entry in collection.find(query, projection):
+        if n == size:
+            ## Documents were added since they were counted
+            grow = max(size, 16)
+            columns = [np.concatenate([column, empty_column(dtype, grow)])
+                       for column, dtype in zip(columns, dtypes)]
+            size += grow
+        for name, column in zip(names, columns):
+            value = entry.get(name, None)
+            if value is None:
+                continue
+            try:
+                column[n] = value
+            except (ValueError, TypeError):
+                pass
+        n += 1
+
+    result = {}
+    for name, column, dtype in zip(names, columns, dtypes):
+        column = column[:n]
+        if dtype.kind == 'O':
+            column = np.array([x.decode() if isinstance(x, bytes) else str(x)
+                               for x in column], dtype=str)
+        result[name] = column
+    if sort is not None and n > 0:
+        order = np.argsort(result[sort], kind='stable')
+        result = {name: column[order] for name, column in result.items()}
+    return result
+
+
+##-------------------------------------------------------------------------
+## Decimate a Series for Plotting
+##-------------------------------------------------------------------------
+def as_seconds(x, start):
+    '''Return the times x (datetimes or datetime64) as float seconds after
+    start, with NaN for missing times.
+    '''
+    x = np.asarray(x)
+    if x.dtype.kind != 'M':
+        x = x.astype('datetime64[us]')
+    return (x - np.datetime64(start, 'us'))/np.timedelta64(1, 's')
+
+
+def decimate_indices(x, y, start, end, npixels):
+    '''Return the indices (in time order) of the points of the series (x, y)
+    to plot on an axis which runs from start to end and is npixels wide.
+
+    The window is split in to npixels buckets of equal duration and only the
+    lowest and highest point in each bucket are kept, so spikes (e.g. wind
+    gusts) survive while the number of points is at most 2*npixels.  Points
+    outside the window are dropped, except for the nearest one on each side
+    so that lines run to the edges.  Points with a missing time or value are
+    dropped.
+    '''
+    t = as_seconds(x, start)
+    y = np.asarray(y, dtype=float)
+    span = as_seconds([end], start)[0]
+    good = np.isfinite(t) & np.isfinite(y)
+    inside = good & (t >= 0) & (t <= span)
+    index = np.nonzero(inside)[0]
+    if npixels > 0 and span > 0 and len(index) > 2*npixels:
+        bucket = np.minimum((t[index]/span*npixels).astype(int), npixels-1)
+        order = np.lexsort((y[index], bucket))
+        bucket = bucket[order]
+        edge = bucket[1:] != bucket[:-1]
+        lowest = np.concatenate([[True], edge])
+        highest = np.concatenate([edge, [True]])
+        index = index[order[lowest | highest]]
+    neighbors = []
+    before = np.nonzero(good & (t < 0))[0]
+    if len(before) > 0:
+        neighbors.append(before[np.argmax(t[before])])
+    after = np.nonzero(good & (t > span))[0]
+    if len(after) > 0:
+        neighbors.append(after[np.argmin(t[after])])
+    index = np.concatenate([index, np.array(neighbors, dtype=index.dtype)])
+    return index[np.argsort(t[index], kind='stable')]
+
+
+def decimate(x, y, start, end, npixels):
+    '''Return (x, y) reduced for plotting on an axis which runs from start to
+    end and is npixels wide (see decimate_indices).
+    '''
+    index = decimate_indices(x, y, start, end, npixels)
+    return x[index], y[index]
+
+
+##-------------------------------------------------------------------------
+## Rolling Buffer of Recent Documents
+##-------------------------------------------------------------------------
+class RollingBuffer(object):
+    '''Columns (as from load_columns) holding the last span of documents in
+    collection which match query, for processes which plot the same recent
+    window over and over.
+
+    Each update() only asks the database for documents newer than the newest
+    one already held (the high water mark), appends them, and trims rows
+    which have aged out of the window.  Collections whose documents can be
+    written late (e.g. image measurements, which are recorded after the
+    frame is analyzed) can set overlap to fetch that much of the recent past
+    again each time.  names must include 'date'.
+    '''
+    def __init__(self, collection, names, dtypes, query=None,
+                 span=tdelta(1), overlap=tdelta(0)):
+        self.collection = collection
+        self.names = names
+        self.dtypes = dtypes
+        self.query = query if query is not None else {}
+        self.span = span
+        self.overlap = overlap
+        self.columns = None
+        self.high_water = None
+
+    def __len__(self):
+        return 0 if self.columns is None else len(self.columns['date'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def update(self, end=None):
+        '''Bring the buffer up to end (by default now).  Returns the number of
+        documents fetched.
+        '''
+        if end is None:
+            end = dt.utcnow()
+        start = end - self.span
+        since = start
+        if self.high_water is not None:
+            since = max(start, self.high_water - self.overlap)
+        query = dict(self.query)
+        query['date'] = {'$gt': since, '$lt': end}
+        new = load_columns(self.collection, query, self.names, self.dtypes,
+                           sort='date')
+
+        if self.columns is None:
+            columns = new
+        else:
+            ## Drop what was fetched again, then append the new documents
+            n = np.searchsorted(self.columns['date'], np.datetime64(since),
+                                side='right')
+            columns = {name: np.concatenate([self.columns[name][:n], new[name]])
+                       for name in self.names}
+        i0 = np.searchsorted(columns['date'], np.datetime64(start), side='right')
+        self.columns = {name: column[i0:] for name, column in columns.items()}
+        if len(self) > 0:
+            self.high_water = max(since, self.columns['date'][-1].astype(dt))
+        else:
+            self.high_water = since
+        return len(new['date'])
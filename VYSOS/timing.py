@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per-stage timing for the measurement pipeline.  measure_image stores the
+stage times as a 'timings' sub-document in each images record and the
+functions here roll them up per night.
+"""
+
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+##-------------------------------------------------------------------------
+## Stage Timer
+##-------------------------------------------------------------------------
+class StageTimer(object):
+    '''Accumulates wall clock time (in seconds) spent in named stages.
+
+    Use as:
+        timer = StageTimer()
+        with timer('astrometry'):
+            im.solve_astrometry()
+    '''
+    def __init__(self):
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def __call__(self, stage):
+        tick = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - tick)
+
+    def add(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def as_dict(self, total=True):
+        '''Copy of the timings suitable for storing in a mongo document.'''
+        timings = {stage: float(f'{t:.4f}') for stage, t in self.timings.items()}
+        if total is True:
+            timings['total'] = float(f'{self.elapsed():.4f}')
+        return timings
+
+
+##-------------------------------------------------------------------------
+## Roll Up Timings
+##-------------------------------------------------------------------------
+def rollup(timings_list):
+    '''Summarize a list of timings dicts (one per image) in to a dict of
+    {stage: {'n', 'total', 'mean', 'median', 'max'}}.
+    '''
+    stages = {}
+    for timings in timings_list:
+        if not timings:
+            continue
+        for stage, t in timings.items():
+            stages.setdefault(stage, []).append(t)
+    summary = {}
+    for stage, values in stages.items():
+        values = np.array(values, dtype=float)
+        summary[stage] = {'n': len(values),
+                          'total': float(np.sum(values)),
+                          'mean': float(np.mean(values)),
+                          'median': float(np.median(values)),
+                          'max': float(np.max(values)),
+                         }
+    return summary
+
+
+def night_timings(images, telescope, start, end):
+    '''Roll up the stored timings for all images from one telescope taken
+    between start and end, grouped by SIDRE version so that a regression
+    from a new version stands out.  images is the mongo images collection.
+    Returns {SIDREversion: rollup}.
+    '''
+    query = {'date': {'$gt': start, '$lt': end}, 'telescope': telescope,
+             'timings': {'$exists': True}}
+    projection = {'_id': False, 'SIDREversion': True, 'timings': True}
+    by_version = {}
+    for entry in images.find(query, projection):
+        version = entry.get('SIDREversion', 'unknown')
+        by_version.setdefault(version, []).append(entry['timings'])
+    return {version: rollup(timings) for version, timings in by_version.items()}
+
+
+def format_rollup(summary):
+    lines = [f"  {'Stage':>14s} {'N':>5s} {'Mean':>8s} {'Median':>8s} {'Max':>8s} {'Total':>9s}"]
+    for stage, s in sorted(summary.items(), key=lambda x: -x[1]['total']):
+        lines.append(f"  {stage:>14s} {s['n']:5d} {s['mean']:7.2f}s {s['median']:7.2f}s"
+                     f" {s['max']:7.2f}s {s['total']:8.1f}s")
+    return lines
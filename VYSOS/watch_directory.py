@@ -2,7 +2,8 @@
 # encoding: utf-8
 """
 Script to watch a directory of images and when a new one appears, run
-MeasureImage.py on it.
+MeasureImage.py on it.  New files are picked up from inotify close-after-write
+events where available, otherwise the directory is polled every few seconds.
 """
 
 from __future__ import division, print_function
@@ -21,9 +22,22 @@ from astropy import units as u
 from astropy.io import fits
 
 from VYSOS import Telescope
+from VYSOS.directory_events import DirectoryWatcher
+from VYSOS.fits_io import read_header
+from VYSOS.result_writer import ResultWriter
+from VYSOS.work_queue import MeasurementQueue
 from measure_image import measure_image
 
 
+def known_files(images, files):
+    '''Return the set of files which already have a record in the images
+    collection, using a single projected query.
+    '''
+    cursor = images.find({'filename': {'$in': list(files)}},
+                         {'filename': 1, '_id': 0})
+    return set([x['filename'] for x in cursor])
+
+
 def main():
     ##-------------------------------------------------------------------------
     ## Parse Command Line Arguments
@@ -39,6 +53,18 @@ def main():
         dest="telescope", required=True, type=str,
         choices=["V5", "V20"],
         help="Telescope which took the data ('V5' or 'V20')")
+    parser.add_argument("--poll",
+        action="store_true", dest="poll",
+        default=False, help="Poll the directory instead of using inotify events")
+    parser.add_argument("--settle",
+        dest="settle", required=False, type=float, default=5.,
+        help="Seconds a file must be unchanged before it is analyzed when no close event is seen (default = 5)")
+    parser.add_argument("-j", "--jobs",
+        dest="jobs", required=False, type=int, default=2,
+        help="Number of frames to measure at once (default = 2)")
+    parser.add_argument("--max-backlog",
+        dest="max_backlog", required=False, type=int, default=20,
+        help="Queue length beyond which calibration frames only get a header-only record (default = 20)")
     args = parser.parse_args()
     telescope = args.telescope
 
@@ -79,46 +105,96 @@ def main():
 #     MatchFilename = re.compile("(.*)\-([0-9]{8})at([0-9]{6})\.fts")
     MatchFilename = re.compile("(.*)\.fts")
     MatchEmpty = re.compile(".*\-Empty\-.*\.fts")
-    while Operate:
-        ## Set date to tonight
-        now = dt.utcnow()
-        date_string = now.strftime("%Y%m%dUT")
-        DataPath = os.path.join(os.path.expanduser("~"), f"{args.telescope}Data", "Images", date_string)
-        
-        logger.info('Examining directory {}'.format(DataPath))
-        ## Look for files
-        if os.path.exists(DataPath):
-            files = os.listdir(DataPath)
-        else:
-            files = []
-        logger.info('  Found {} files'.format(len(files)))
-        time.sleep(1)
-        images_to_analyze = {}
-        for file in files:
-            IsMatch = MatchFilename.match(file)
-            IsEmpty = MatchEmpty.match(file)
-            if IsMatch and not IsEmpty:
-                analyzed = [x for x in images.find( {"filename" : file} )]
-                if (len(analyzed) == 0):
-                    target = IsMatch.group(1)
-#                     filetime = IsMatch.group(3)
-                    hdr = fits.getheader(os.path.join(DataPath, file))
-                    DATEOBS = hdr.get('DATEOBS', '')
-                    filetime = DATEOBS.replace('-', '').replace(':', '').replace('T', 'at')
-                    images_to_analyze[filetime] = file
-        logger.debug('  Found {} files to analyze'.format(len(images_to_analyze)))
-        for filetime in sorted(images_to_analyze.keys()):
-            file = images_to_analyze[filetime]
-            try:
-                measure_image(os.path.join(DataPath, file), nographics=True)
-            except OSError:
-                raise
-            except:
-                logger.warning('  MeasureImage failed on {}.'.format(file))
-                logger.error(sys.exc_info())
+    queue = MeasurementQueue(measure_image, jobs=args.jobs,
+                             max_backlog=args.max_backlog,
+                             writer=ResultWriter(), logger=logger,
+                             nographics=True)
+    last_stats = None
+    watcher = None
+    known = set()
+    ## Files to look at again on the next pass (their header could not be
+    ## read or the measurement failed) and the attempts made on each
+    retry = set()
+    attempts = {}
+    max_attempts = 3
+    try:
+        while Operate:
+            ## Set date to tonight
+            now = dt.utcnow()
+            date_string = now.strftime("%Y%m%dUT")
+            DataPath = os.path.join(os.path.expanduser("~"), f"{args.telescope}Data", "Images", date_string)
+
+            ## Start watching tonight's directory once it exists
+            if watcher is not None and watcher.path != DataPath:
+                watcher.close()
+                watcher = None
+                retry = set()
+            if watcher is None and os.path.exists(DataPath):
+                logger.info('Examining directory {}'.format(DataPath))
+                watcher = DirectoryWatcher(DataPath, MatchFilename,
+                                           settle=args.settle,
+                                           use_inotify=not args.poll,
+                                           logger=logger)
+                ## Files analyzed (or attempted) tonight, seeded from the
+                ## database once and then kept up to date as frames are
+                ## queued and measured
+                known = known_files(images, watcher.scan().keys())
+                logger.info('  {} files already analyzed'.format(len(known)))
 
-        time.sleep(30)
+            ## Wait for files which have been completely written (briefly if
+            ## measurements are in progress, so results are picked up promptly)
+            busy = len(queue) > 0 or len(queue.running) > 0
+            if watcher is not None:
+                files = watcher.wait(timeout=1 if busy else 5)
+            else:
+                time.sleep(1 if busy else 5)
+                files = []
+            if len(files) > 0:
+                logger.info('  Found {} new files'.format(len(files)))
+            files += sorted(retry - set(files))
+            retry = set()
+            for file in files:
+                if file in known:
+                    continue
+                IsMatch = MatchFilename.match(file)
+                IsEmpty = MatchEmpty.match(file)
+                if IsMatch and not IsEmpty:
+                    attempts[file] = attempts.get(file, 0) + 1
+                    try:
+                        hdr = read_header(os.path.join(DataPath, file))
+                    except:
+                        logger.warning('  Could not read header of {}'.format(file))
+                        if attempts[file] < max_attempts:
+                            retry.add(file)
+                        continue
+                    queue.put(os.path.join(DataPath, file), hdr)
+                    known.add(file)
 
+            ## Hand queued frames to idle workers and report finished ones
+            queue.dispatch()
+            for file, status, elapsed in queue.collect():
+                if status.startswith('failed') or status == 'worker died':
+                    logger.warning('  MeasureImage failed on {}: {}'.format(os.path.basename(file), status))
+                    ## Try again on the next pass, up to max_attempts times
+                    name = os.path.basename(file)
+                    if os.path.dirname(file) == DataPath:
+                        known.discard(name)
+                        if attempts.get(name, 0) < max_attempts:
+                            retry.add(name)
+                        else:
+                            logger.warning(f'  Giving up on {name} after {max_attempts} attempts')
+                else:
+                    logger.info('  Measured {} in {:.1f} s ({})'.format(os.path.basename(file), elapsed, status))
+            stats = queue.stats()
+            if (stats['depth'], stats['running']) != last_stats:
+                logger.debug('  Queue: {depth} waiting, {running} running, oldest {oldest:.0f} s, '
+                             'median wait {median_wait:.1f} s, max wait {max_wait:.1f} s, '
+                             '{shed} shed'.format(**stats))
+                last_stats = (stats['depth'], stats['running'])
+    finally:
+        if watcher is not None:
+            watcher.close()
+        queue.close(wait=False)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Queue of frames waiting to be measured by the live watcher.  Frames are
+served in order of DATE-OBS to a bounded pool of worker processes, so a slow
+frame (e.g. a hard astrometry solve) only ties up one worker and the watcher
+keeps discovering new files meanwhile.  When the backlog grows beyond
+max_backlog, calibration frames are shed: they get a header-only record
+instead of a place in the queue.
+"""
+
+import sys
+import os
+import re
+import time
+import heapq
+import multiprocessing
+from collections import deque
+from datetime import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from VYSOS.prescreen import calibration_reason, light_record
+
+
+##-------------------------------------------------------------------------
+## Measure a Single Frame (runs in a worker process)
+##-------------------------------------------------------------------------
+def run_measurement(measure, file, kwargs):
+    '''Run measure(file, **kwargs), trapping any failure.  Returns (file,
+    status, elapsed).
+    '''
+    tick = dt.utcnow()
+    try:
+        image_info = measure(file, **kwargs)
+        if image_info is None:
+            status = 'skipped'
+        elif image_info.get('analyzed', False) is False:
+            status = image_info.get('prescreen', 'not analyzed')
+        else:
+            status = 'ok'
+    except:
+        status = f'failed ({sys.exc_info()[0].__name__})'
+    elapsed = (dt.utcnow() - tick).total_seconds()
+    return (file, status, elapsed)
+
+
+##-------------------------------------------------------------------------
+## Measurement Queue
+##-------------------------------------------------------------------------
+class MeasurementQueue(object):
+    '''Priority queue (by DATE-OBS) of frames served by jobs worker processes
+    running measure (normally measure_image, with kwargs passed through).
+
+    The owner calls put() as frames are found and dispatch() and collect()
+    regularly; none of these block on a measurement.  writer is used to
+    record the header-only results of frames which are shed.
+
+    Workers are started with the spawn method by default, so they do not
+    inherit the owner's database clients (which are not fork safe).
+    '''
+    def __init__(self, measure, jobs=2, max_backlog=20, writer=None,
+                 logger=None, mp_context='spawn', **kwargs):
+        self.measure = measure
+        self.jobs = jobs
+        self.max_backlog = max_backlog
+        self.writer = writer
+        self.logger = logger
+        self.kwargs = kwargs
+        self.mp_context = multiprocessing.get_context(mp_context)
+        self.pool = self.new_pool()
+        ## (DATE-OBS, file name, full path, time queued)
+        self.heap = []
+        ## future: (full path, pool it was submitted to)
+        self.running = {}
+        ## Time spent in the queue by recently dispatched frames
+        self.waits = deque(maxlen=200)
+        self.nshed = 0
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.jobs,
+                                   mp_context=self.mp_context)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, file, header):
+        '''Add a frame to the queue, or shed it if the backlog is too long.
+        Returns 'queued' or 'shed'.
+        '''
+        if len(self.heap) >= self.max_backlog:
+            reason = calibration_reason(file, header)
+            if reason is not None:
+                self.shed(file, header, reason)
+                return 'shed'
+        heapq.heappush(self.heap, (str(header.get('DATE-OBS', '')),
+                                   os.path.basename(file), file, time.time()))
+        return 'queued'
+
+    def shed(self, file, header, reason):
+        '''Record a header-only result for a frame instead of measuring it.'''
+        image_info = {'filename': os.path.basename(file),
+                      'compressed': file.endswith('.fz'),
+                     }
+        try:
+            image_info['telescope'] = re.match('(V[25]0?)_.+', image_info['filename']).group(1)
+        except:
+            pass
+        light_record(image_info, header, 'calibration',
+                     f'{reason} (shed with {len(self.heap)} frames queued)')
+        self.nshed += 1
+        if self.logger: self.logger.info(f'  Backlog of {len(self.heap)} frames: '
+                                         f'header-only record for {image_info["filename"]}')
+        if self.writer is not None:
+            try:
+                self.writer.write(image_info)
+            except:
+                if self.logger: self.logger.error(f'  Failed to record {image_info["filename"]}')
+
+    def dispatch(self):
+        '''Hand the earliest queued frames to idle workers.'''
+        while len(self.running) < self.jobs and len(self.heap) > 0:
+            entry = heapq.heappop(self.heap)
+            dateobs, filename, file, queued = entry
+            try:
+                future = self.pool.submit(run_measurement, self.measure, file,
+                                          self.kwargs)
+            except BrokenProcessPool:
+                ## A worker died since the last collect(); put the frame back
+                ## and try once more with a new pool
+                if self.logger: self.logger.warning('  Worker pool died, restarting it')
+                self.pool = self.new_pool()
+                try:
+                    future = self.pool.submit(run_measurement, self.measure,
+                                              file, self.kwargs)
+                except BrokenProcessPool:
+                    heapq.heappush(self.heap, entry)
+                    return
+            self.waits.append(time.time() - queued)
+            self.running[future] = (file, self.pool)
+
+    def collect(self):
+        '''Return (file, status, elapsed) for each measurement which has
+        finished since the last call.
+        '''
+        results = []
+        broken = False
+        for future in [f for f in self.running if f.done()]:
+            file, pool = self.running.pop(future)
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                results.append((file, 'worker died', 0))
+                broken = broken or (pool is self.pool)
+        if broken:
+            if self.logger: self.logger.warning('  Worker pool died, restarting it')
+            self.pool = self.new_pool()
+        return results
+
+    def stats(self):
+        '''Return queue depth, busy workers, and wait times (in seconds).'''
+        now = time.time()
+        waits = list(self.waits)
+        return {'depth': len(self.heap),
+                'running': len(self.running),
+                'oldest': max([now - x[3] for x in self.heap]) if self.heap else 0.,
+                'median_wait': float(np.median(waits)) if waits else 0.,
+                'max_wait': max(waits) if waits else 0.,
+                'shed': self.nshed,
+               }
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait)
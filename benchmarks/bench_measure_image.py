@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark the measurement pipeline on synthetic frames.
+
+Synthetic V5 and V20 frames are written in both .fts and .fts.fz form and
+measure_image is run on each, recording to a local mongo stand-in (a mongod
+on localhost by default, or mongomock with --mongomock).  Per-stage and
+end-to-end throughput are reported and can be written as JSON so that runs
+from different commits can be compared.
+"""
+
+import sys
+import os
+import json
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime as dt
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+sys.path.insert(0, os.path.join(repo_path, 'VYSOS'))
+
+from synthetic_images import make_frames
+from VYSOS.timing import rollup, format_rollup
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=repo_path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+##-------------------------------------------------------------------------
+## Run the Benchmark
+##-------------------------------------------------------------------------
+def run_benchmark(telescopes=['V5', 'V20'], nframes=4, mongo_address='localhost',
+                  mongo_port=27017, workdir=None):
+    '''Measure synthetic frames for each telescope and compression setting.
+    Returns a dict of results keyed by e.g. "V20 .fts.fz".
+    '''
+    from measure_image import measure_image
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='vysos_bench_', dir=workdir) as tmpdir:
+        logdir = os.path.join(tmpdir, 'logs')
+        for telescope in telescopes:
+            for compressed in [False, True]:
+                name = f"{telescope} {'.fts.fz' if compressed else '.fts'}"
+                framedir = os.path.join(tmpdir, name.replace(' ', '_'))
+                os.makedirs(framedir)
+                print(f"Writing {nframes} synthetic {name} frames")
+                files = make_frames(framedir, telescope, nframes=nframes,
+                                    compressed=compressed)
+                timings = []
+                failures = 0
+                tick = dt.utcnow()
+                for file in files:
+                    try:
+                        image_info = measure_image(file, nographics=True,
+                                                   mongo_address=mongo_address,
+                                                   mongo_port=mongo_port,
+                                                   logdir=logdir)
+                        if image_info is not None:
+                            timings.append(image_info.get('timings', {}))
+                    except Exception as e:
+                        print(f"  Measure image failed on {os.path.basename(file)}: {e}")
+                        failures += 1
+                elapsed = (dt.utcnow() - tick).total_seconds()
+                summary = rollup(timings)
+                results[name] = {'nframes': len(files),
+                                 'failures': failures,
+                                 'elapsed': elapsed,
+                                 'frames_per_minute': 60.*len(files)/elapsed,
+                                 'stages': summary,
+                                }
+                print(f"{name}: {len(files)} frames in {elapsed:.1f} s "
+                      f"({results[name]['frames_per_minute']:.1f} frames/min, "
+                      f"{failures} failures)")
+                for line in format_rollup(summary):
+                    print(line)
+    return results
+
+
+def main():
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    parser = ArgumentParser(description="Benchmark measure_image on synthetic frames")
+    ## add flags
+    parser.add_argument("--mongomock",
+        action="store_true", dest="mongomock",
+        default=False, help="Use mongomock instead of a local mongod")
+    ## add arguments
+    parser.add_argument("-t", "--telescope",
+        dest="telescopes", required=False, type=str, nargs='+',
+        default=['V5', 'V20'], choices=["V5", "V20"],
+        help="Telescopes whose frames to benchmark")
+    parser.add_argument("-n", "--nframes",
+        dest="nframes", required=False, type=int, default=4,
+        help="Number of frames per telescope and format (default = 4)")
+    parser.add_argument("--mongo",
+        dest="mongo_address", required=False, type=str, default='localhost',
+        help="Address of the mongo stand-in (default = localhost)")
+    parser.add_argument("-o", "--output",
+        dest="output", required=False, type=str, default=None,
+        help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.mongomock is True:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    results = run_benchmark(telescopes=args.telescopes, nframes=args.nframes,
+                            mongo_address=args.mongo_address)
+
+    if args.output is not None:
+        with open(args.output, 'w') as FO:
+            json.dump({'revision': git_revision(),
+                       'date': dt.utcnow().isoformat(),
+                       'results': results,
+                      }, FO, indent=2)
+        print(f"Wrote results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Generate synthetic V5- and V20-shaped FITS frames (star field, sky noise, and
+the header keywords measure_image reads) for benchmarking the measurement
+pipeline without real telescope data.
+"""
+
+import os
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import numpy as np
+from astropy import units as u
+from astropy import coordinates as c
+from astropy.io import fits
+
+
+##-------------------------------------------------------------------------
+## Nominal Detector and Frame Properties
+##-------------------------------------------------------------------------
+frame_properties = {'V5': {'shape': (2672, 4008),
+                           'filter': 'PSr',
+                           'fwhm_pix': 2.5,
+                           'exptime': 60.,
+                           'nstars': 800,
+                          },
+                    'V20': {'shape': (4096, 4096),
+                            'filter': 'PSi',
+                            'fwhm_pix': 4.5,
+                            'exptime': 60.,
+                            'nstars': 400,
+                           },
+                   }
+
+
+##-------------------------------------------------------------------------
+## Make a Synthetic Star Field
+##-------------------------------------------------------------------------
+def star_field(shape, nstars, fwhm_pix, sky=1000., read_noise=10., seed=None):
+    '''Return a uint16 image of Gaussian stars on a noisy sky background.'''
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    image = np.full(shape, sky, dtype=np.float32)
+
+    sigma = fwhm_pix/2.355
+    half = int(np.ceil(4*sigma))
+    yy, xx = np.mgrid[-half:half+1, -half:half+1]
+    ## Fluxes drawn from a power law so there are many faint and a few bright
+    ## (some saturated) stars
+    fluxes = 2e3*(1. - rng.random(nstars))**(-1.5)
+    xs = rng.uniform(half, nx-half-1, nstars)
+    ys = rng.uniform(half, ny-half-1, nstars)
+    for x, y, flux in zip(xs, ys, fluxes):
+        ix, iy = int(x), int(y)
+        dx, dy = x - ix, y - iy
+        stamp = np.exp(-((xx-dx)**2 + (yy-dy)**2)/(2*sigma**2))
+        stamp *= flux/stamp.sum()
+        image[iy-half:iy+half+1, ix-half:ix+half+1] += stamp
+
+    image = rng.poisson(image).astype(np.float32)
+    image += rng.normal(0, read_noise, shape).astype(np.float32)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def synthetic_header(telescope, date, target, pointing, airmass, exptime,
+                     filter):
+    hdr = fits.Header()
+    hdr['OBJECT'] = target
+    hdr['IMAGETYP'] = 'Light Frame'
+    hdr['EXPTIME'] = exptime
+    hdr['DATE-OBS'] = date.strftime('%Y-%m-%dT%H:%M:%S')
+    hdr['RA'] = pointing.ra.to_string(unit=u.hourangle, sep=' ', precision=2)
+    hdr['DEC'] = pointing.dec.to_string(unit=u.deg, sep=' ', precision=1,
+                                        alwayssign=True)
+    hdr['EQUINOX'] = 2000.0
+    hdr['AIRMASS'] = airmass
+    hdr['ALTITUDE'] = float(90. - np.degrees(np.arccos(1./airmass)))
+    hdr['AZIMUTH'] = 180.0
+    hdr['FILTER'] = filter
+    hdr['OBSERVAT'] = {'V5': 'VYSOS-5', 'V20': 'VYSOS-20'}[telescope]
+    hdr['SITELAT'] = '+19 32 09.66'
+    hdr['SITELONG'] = '-155 34 33.9'
+    return hdr
+
+
+def make_frames(outdir, telescope, nframes=4, compressed=False,
+                target='SyntheticField', start=dt(2018, 12, 1, 10, 0, 0),
+                seed=0):
+    '''Write nframes synthetic frames for one telescope to outdir and return
+    the list of file names.  Frames are named the way ACP names them (e.g.
+    V20_SyntheticField-20181201at100000.fts) so that the telescope and UT date
+    are parsed from the file name as for real data.
+    '''
+    props = frame_properties[telescope]
+    pointing = c.SkyCoord(83.82, -5.39, unit=u.deg)
+    files = []
+    for i in range(nframes):
+        date = start + tdelta(0, i*(props['exptime']+30))
+        ## Small dithers between frames of the same target
+        dither = c.SkyCoord(pointing.ra + (i % 3)*5*u.arcsec,
+                            pointing.dec + (i % 2)*5*u.arcsec)
+        airmass = 1.0 + 0.02*i
+        hdr = synthetic_header(telescope, date, target, dither, airmass,
+                               props['exptime'], props['filter'])
+        data = star_field(props['shape'], props['nstars'], props['fwhm_pix'],
+                          seed=seed+i)
+        filename = f"{telescope}_{target}-{date.strftime('%Y%m%dat%H%M%S')}.fts"
+        file = os.path.join(outdir, filename)
+        if compressed is True:
+            file += '.fz'
+            hdul = fits.HDUList([fits.PrimaryHDU(),
+                                 fits.CompImageHDU(data=data, header=hdr,
+                                                   compression_type='RICE_1')])
+        else:
+            hdul = fits.HDUList([fits.PrimaryHDU(data=data, header=hdr)])
+        hdul.writeto(file, overwrite=True)
+        files.append(file)
+    return files
+
+
+def main():
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    parser = ArgumentParser(description="Write synthetic VYSOS frames")
+    ## add flags
+    parser.add_argument("-z", "--compressed",
+        action="store_true", dest="compressed",
+        default=False, help="Write fpack compressed (.fts.fz) frames")
+    ## add arguments
+    parser.add_argument("-t", "--telescope",
+        dest="telescope", required=False, type=str, default='V20',
+        choices=["V5", "V20"],
+        help="Telescope whose frames to imitate ('V5' or 'V20')")
+    parser.add_argument("-n", "--nframes",
+        dest="nframes", required=False, type=int, default=4,
+        help="Number of frames to write (default = 4)")
+    parser.add_argument("outdir",
+        type=str,
+        help="Directory to write frames in to")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    for file in make_frames(args.outdir, args.telescope, nframes=args.nframes,
+                            compressed=args.compressed):
+        print(file)
+
+
+if __name__ == '__main__':
+    main()
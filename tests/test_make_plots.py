@@ -0,0 +1,54 @@
+import os
+import time
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from VYSOS import make_plots
+
+
+def fill(db, now, n=1200):
+    rng = np.random.default_rng(0)
+    db['weather'].insert_many([{'date': now - tdelta(0, 60*i),
+                                'temp': 10 + rng.normal(), 'clouds': -40 + rng.normal(0, 5),
+                                'wind': abs(rng.normal(0, 20)), 'gust': 7.,
+                                'rain': 2800, 'safe': bool(i % 500 > 100)}
+                               for i in range(1, n)])
+    db['V5status'].insert_many([{'date': now - tdelta(0, 60*i + 5),
+                                 'dome_shutterstatus': (i//200) % 5}
+                                for i in range(1, n)])
+    db['images'].insert_many([{'date': now - tdelta(0, 300*i), 'telescope': 'V5',
+                               'filename': ['V5_Bias-1.fts', 'V5_AutoFlat-1.fts',
+                                            'V5_M42-1.fts'][i % 3],
+                               'airmass': 1.2}
+                              for i in range(1, 100)])
+
+
+def test_loop_weather_refreshes_and_renders(tmp_path, monkeypatch):
+    db = mongomock.MongoClient()['vysos']
+    fill(db, dt.utcnow())
+
+    ## Insert a new weather document between the first and second refresh
+    plot_weather = make_plots.plot_weather
+    calls = []
+    def plot_and_insert(**kwargs):
+        plot_weather(**kwargs)
+        calls.append(os.path.getmtime(tmp_path / 'weather.png'))
+        if len(calls) == 1:
+            time.sleep(0.01)
+            db['weather'].insert_one({'date': dt.utcnow(), 'temp': 11.,
+                                      'clouds': -30., 'wind': 3., 'gust': 4.,
+                                      'rain': 2800, 'safe': True})
+            time.sleep(0.01)
+    monkeypatch.setattr(make_plots, 'plot_weather', plot_and_insert)
+
+    buffers = make_plots.loop_weather(db, interval=0, ncycles=2,
+                                      destination_path=str(tmp_path))
+    assert len(calls) == 2
+    assert (tmp_path / 'weather.png').stat().st_size > 0
+    assert len(buffers['weather']) == db['weather'].count_documents({})
+    assert len(buffers['V5status']) == db['V5status'].count_documents({})
@@ -0,0 +1,38 @@
+import logging
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+from bson.errors import InvalidDocument
+from pymongo.results import BulkWriteResult
+
+from VYSOS import result_writer
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    monkeypatch.setattr(result_writer.pymongo, 'MongoClient', mongomock.MongoClient)
+    monkeypatch.setattr(result_writer, 'clients', {})
+    monkeypatch.setattr(result_writer.ResultWriter, 'indexed', set())
+    return result_writer.ResultWriter(batch_size=2,
+                                      logger=logging.getLogger('test_result_writer'))
+
+
+def test_failed_batch_is_logged_and_later_batches_are_written(writer, monkeypatch, caplog):
+    calls = []
+    written = []
+    def fail_once(operations, **kwargs):
+        calls.append(len(operations))
+        if len(calls) == 1:
+            raise InvalidDocument('cannot encode object')
+        written.extend(op._doc['filename'] for op in operations)
+        return BulkWriteResult({'nUpserted': len(operations), 'nModified': 0}, True)
+    monkeypatch.setattr(writer.collection, 'bulk_write', fail_once)
+
+    with caplog.at_level(logging.INFO), writer:
+        for i in range(5):
+            writer.write({'filename': f'V5_M42-{i}.fts', 'analyzed': True})
+
+    assert calls == [2, 2, 1]
+    assert 'Failed to write batch of 2 documents' in caplog.text
+    assert written == ['V5_M42-2.fts', 'V5_M42-3.fts', 'V5_M42-4.fts']
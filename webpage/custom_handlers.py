@@ -18,10 +18,10 @@ import tornado.log as tlog
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-import ephem
 
 import IQMon
 from VYSOS import weather_limits
+from VYSOS.ephemeris import sun_and_moon
 
 
 ##-------------------------------------------------------------------------
@@ -103,46 +103,9 @@ class Status(RequestHandler):
         db = client['vysos']
 
         ##------------------------------------------------------------------------
-        ## Use pyephem determine sunrise and sunset times
+        ## Look up sunrise and sunset times in the precomputed ephemeris
         ##------------------------------------------------------------------------
-        Observatory = ephem.Observer()
-        Observatory.lon = "-155:34:33.9"
-        Observatory.lat = "+19:32:09.66"
-        Observatory.elevation = 3400.0
-        Observatory.temp = 10.0
-        Observatory.pressure = 680.0
-        Observatory.horizon = '0.0'
-
-        Observatory.date = nowut
-        TheSun = ephem.Sun()
-        TheSun.compute(Observatory)
-        sun = {}
-        sun['alt'] = float(TheSun.alt) * 180. / ephem.pi
-        sun['set'] = Observatory.next_setting(TheSun).datetime()
-        sun['rise'] = Observatory.next_rising(TheSun).datetime()
-        if sun['alt'] <= -18:
-            sun['now'] = 'night'
-        elif sun['alt'] > -18 and sun['alt'] <= -12:
-            sun['now'] = 'astronomical twilight'
-        elif sun['alt'] > -12 and sun['alt'] <= -6:
-            sun['now'] = 'nautical twilight'
-        elif sun['alt'] > -6 and sun['alt'] <= 0:
-            sun['now'] = 'civil twilight'
-        elif sun['alt'] > 0:
-            sun['now'] = 'day'
-
-        TheMoon = ephem.Moon()
-        Observatory.date = nowut
-        TheMoon.compute(Observatory)
-        moon = {}
-        moon['phase'] = TheMoon.phase
-        moon['alt'] = TheMoon.alt * 180. / ephem.pi
-        moon['set'] = Observatory.next_setting(TheMoon).datetime()
-        moon['rise'] = Observatory.next_rising(TheMoon).datetime()
-        if moon['alt'] > 0:
-            moon['now'] = 'up'
-        else:
-            moon['now'] = 'down'
+        sun, moon = sun_and_moon(nowut)
 
         tlog.app_log.info('  Ephem data calculated')
 